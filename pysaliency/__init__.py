@@ -11,6 +11,7 @@ from .datasets import (
     FixationTrains,
     Stimuli,
     FileStimuli,
+    PackedStimuli,
     create_nonfixations,
     create_subset,
     remove_out_of_stimulus_fixations,
@@ -1,20 +1,25 @@
 from __future__ import print_function, unicode_literals, division, absolute_import
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numba
 import numpy as np
 from scipy.special import logsumexp
-from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage.filters import gaussian_filter, gaussian_filter1d
+import scipy.fft
 
 from sklearn.neighbors import KernelDensity
 from sklearn.model_selection import BaseCrossValidator
 from sklearn.base import BaseEstimator
 
+from boltons.iterutils import chunked
 from tqdm import tqdm
 
+from .datasets import Stimulus
 from .precomputed_models import get_image_hash
 from .roc import general_roc
 from .numba_utils import fill_fixation_map
-from .utils import inter_and_extrapolate
+from .utils import inter_and_extrapolate, average_values
 from . import Model, UniformModel
 
 
@@ -59,6 +64,221 @@ def normalize_fixations(stimuli, fixations, keep_aspect=False, add_shape=False,
     return xs, ys
 
 
+# kernel radius (in pixels) above which `blur_fixation_maps` uses FFT convolutions
+FFT_BLUR_MIN_RADIUS = 30
+
+
+def _gaussian_kernel_1d(sigma, radius):
+    # same kernel as used by scipy.ndimage.gaussian_filter
+    x = np.arange(-radius, radius + 1)
+    phi = np.exp(-0.5 / sigma**2 * x**2)
+    return phi / phi.sum()
+
+
+def _blur_radius(sigma, truncate=4.0):
+    # kernel radius as used by scipy.ndimage.gaussian_filter
+    return int(truncate * float(sigma) + 0.5)
+
+
+def _window_counts(counts, radius, axis):
+    """ number of nonzero entries within `radius` along `axis`, using reflected boundaries """
+    pad_width = [(0, 0)] * counts.ndim
+    pad_width[axis] = (radius + 1, radius)
+    cumulative_counts = np.cumsum(np.pad(counts, pad_width, mode='symmetric'), axis=axis)
+    size = counts.shape[axis]
+    upper = np.take(cumulative_counts, np.arange(2 * radius + 1, 2 * radius + 1 + size), axis=axis)
+    lower = np.take(cumulative_counts, np.arange(0, size), axis=axis)
+    return upper - lower
+
+
+def _fft_gaussian_filter(fixation_maps, sigmas, truncate):
+    result = fixation_maps
+    support = fixation_maps != 0
+    for axis, sigma in zip((-2, -1), sigmas):
+        if sigma <= 1e-15:
+            continue
+        radius = _blur_radius(sigma, truncate)
+        size = result.shape[axis]
+
+        # reflecting the map and discarding the first 2*radius outputs of the
+        # circular convolution yields exactly the same result as gaussian_filter
+        pad_width = [(0, 0)] * result.ndim
+        pad_width[axis] = (radius, radius)
+        padded = np.pad(result, pad_width, mode='symmetric')
+        fft_size = scipy.fft.next_fast_len(padded.shape[axis], real=True)
+
+        kernel_shape = [1] * result.ndim
+        kernel_shape[axis] = -1
+        kernel_spectrum = scipy.fft.rfft(_gaussian_kernel_1d(sigma, radius), n=fft_size).reshape(kernel_shape)
+
+        spectrum = scipy.fft.rfft(padded, n=fft_size, axis=axis)
+        spectrum *= kernel_spectrum
+        result = scipy.fft.irfft(spectrum, n=fft_size, axis=axis)
+        result = np.take(result, np.arange(2 * radius, 2 * radius + size), axis=axis)
+
+        support = _window_counts(support.astype(np.int64), radius, axis) > 0
+
+    # remove numerical noise of the FFT outside of the kernel support
+    result = np.maximum(result, 0)
+    result[~support] = 0
+    return result
+
+
+def blur_fixation_maps(fixation_maps, sigmas, truncate=4.0, method='auto'):
+    """ Blur one fixation map of shape (height, width) or a batch of fixation maps
+    of shape (batch_size, height, width) with a gaussian kernel.
+
+    The result is the same as from `scipy.ndimage.gaussian_filter` (reflecting
+    boundary conditions, kernel truncated at `truncate` standard deviations).
+
+    Parameters
+    ----------
+    sigmas : float or pair of floats
+        standard deviation of the gaussian kernel in y and x direction
+    method : one of 'auto', 'direct', 'fft'
+        'direct' uses `gaussian_filter`, 'fft' uses FFT convolutions, which is faster
+        for large kernels. 'auto' chooses 'fft' if the kernel radius is larger
+        than `FFT_BLUR_MIN_RADIUS`.
+    """
+    fixation_maps = np.asarray(fixation_maps, dtype=float)
+    sigmas = np.broadcast_to(np.asarray(sigmas, dtype=float), (2, ))
+
+    if method == 'auto':
+        method = 'fft' if truncate * sigmas.max() > FFT_BLUR_MIN_RADIUS else 'direct'
+
+    if method == 'direct':
+        full_sigmas = [0] * (fixation_maps.ndim - 2) + list(sigmas)
+        return gaussian_filter(fixation_maps, full_sigmas, truncate=truncate)
+    elif method == 'fft':
+        return _fft_gaussian_filter(fixation_maps, sigmas, truncate)
+    else:
+        raise ValueError(method)
+
+
+def _fixation_counts_in_kernel_support(fixation_map, sigmas, truncate=4.0):
+    """ number of fixations within the support of the blurring kernel for each pixel """
+    counts = np.asarray(fixation_map).astype(np.int64)
+    for axis, sigma in zip((-2, -1), sigmas):
+        counts = _window_counts(counts, _blur_radius(sigma, truncate), axis)
+    return counts
+
+
+def _blur_local_fixation_map(fixation_map, sigmas, truncate=4.0, method='auto'):
+    """ blur a sparse fixation map by only blurring the bounding box of the fixations
+    (extended by the kernel radius). The result equals `blur_fixation_maps(fixation_map, sigmas)`.
+    """
+    result = np.zeros(fixation_map.shape)
+    ys, xs = np.nonzero(fixation_map)
+    if not len(ys):
+        return result
+
+    window = []
+    for axis, (indices, sigma) in enumerate(zip((ys, xs), sigmas)):
+        radius = _blur_radius(sigma, truncate)
+        # the window has to contain `radius` empty pixels next to each boundary
+        # that is not a boundary of the map, such that reflecting at the window
+        # boundaries doesn't change the result
+        window.append(slice(max(indices.min() - radius, 0),
+                            min(indices.max() + radius + 1, fixation_map.shape[axis])))
+    window = tuple(window)
+
+    result[window] = blur_fixation_maps(fixation_map[window], sigmas, truncate=truncate, method=method)
+    return result
+
+
+def _fixation_maps_to_log_densities(fixation_maps, sigmas, eps, method='auto'):
+    """ blur fixation maps and convert them into log densities regularized with a uniform component """
+    ZZ = blur_fixation_maps(fixation_maps, sigmas, method=method)
+    return _blurred_maps_to_log_densities(ZZ, eps)
+
+
+def _blurred_maps_to_log_densities(ZZ, eps):
+    height, width = ZZ.shape[-2:]
+    ZZ = ZZ * (1-eps)
+    ZZ += eps * 1.0/(height*width)
+    ZZ = np.log(ZZ)
+
+    ZZ -= logsumexp(ZZ, axis=(-2, -1), keepdims=True)
+
+    return ZZ
+
+
+def _linear_binning(coordinates, size):
+    """ distribute each coordinate linearly onto the two closest pixel centers.
+
+    The grid has one additional bin on each side (centers at -0.5 and size + 0.5) such that
+    coordinates close to the image boundary are binned without truncation.
+    Returns the (extended) bin indices and weights.
+    """
+    positions = np.clip(np.asarray(coordinates, dtype=float) - 0.5, -1, size)
+    lower = np.floor(positions)
+    upper_weights = positions - lower
+    lower = lower.astype(int) + 1
+    upper = np.minimum(lower + 1, size + 1)
+
+    return np.concatenate((lower, upper)), np.concatenate((1 - upper_weights, upper_weights))
+
+
+def _gaussian_kernel_matrix(size, centers, sigma):
+    # kernel between the pixel centers and the given centers
+    distances = (np.arange(size)[:, np.newaxis] + 0.5) - centers[np.newaxis, :]
+    return np.exp(-0.5 * (distances / sigma)**2)
+
+
+def binned_kde_log_density(xs, ys, shape, sigmas, binning='auto'):
+    """ Unnormalized log density of a gaussian KDE with kernel standard deviations `sigmas` (y, x)
+    evaluated at the pixel centers of an image of the given shape. All values are in pixels.
+
+    The fixations are linearly binned onto the pixel grid, which is then convolved
+    with the (untruncated) separable gaussian kernel. Up to the binning error, which is
+    of order (1 pixel / sigma)**2, this is the same as evaluating the KDE at each pixel.
+    For few fixations it is cheaper to evaluate the separable kernel exactly, which
+    `binning='auto'` does automatically.
+    """
+    height, width = shape
+    sigma_y, sigma_x = sigmas
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+
+    y_bins, y_weights = _linear_binning(ys, height)
+    x_bins, x_weights = _linear_binning(xs, width)
+    rows, row_indices = np.unique(y_bins, return_inverse=True)
+    columns, column_indices = np.unique(x_bins, return_inverse=True)
+
+    if binning == 'auto':
+        exact_cost = len(xs) * height * width
+        binned_cost = height * min(len(rows), len(columns)) * (max(len(rows), len(columns)) + width)
+        binning = binned_cost < exact_cost
+
+    if not binning:
+        y_kernel = _gaussian_kernel_matrix(height, ys, sigma_y)
+        x_kernel = _gaussian_kernel_matrix(width, xs, sigma_x)
+        density = y_kernel @ x_kernel.T
+    else:
+        # each fixation is split onto (up to) four bins. Only the rows and
+        # columns of the binned map which contain fixations are used.
+        fixation_count = len(xs)
+        binned_map = np.zeros((len(rows), len(columns)))
+        for y_part in range(2):
+            for x_part in range(2):
+                y_slice = slice(y_part * fixation_count, (y_part + 1) * fixation_count)
+                x_slice = slice(x_part * fixation_count, (x_part + 1) * fixation_count)
+                np.add.at(binned_map, (row_indices[y_slice], column_indices[x_slice]),
+                          y_weights[y_slice] * x_weights[x_slice])
+
+        # bin i of the extended grid is centered at i - 0.5
+        y_kernel = _gaussian_kernel_matrix(height, rows - 0.5, sigma_y)
+        x_kernel = _gaussian_kernel_matrix(width, columns - 0.5, sigma_x)
+
+        if len(rows) <= len(columns):
+            density = (y_kernel @ binned_map) @ x_kernel.T
+        else:
+            density = y_kernel @ (binned_map @ x_kernel.T)
+
+    with np.errstate(divide='ignore'):
+        return np.log(density)
+
+
 def fixations_to_scikit_learn(fixations, normalize=None, keep_aspect=False, add_shape=False,
                               add_stimulus_number=False,
                               add_fixation_number=False,
@@ -240,30 +460,38 @@ class AUCKernelDensityEstimator(BaseEstimator):
         return np.sum(self.score_samples(X))
 
 
+def _get_stimulus_indices(stimuli):
+    """ mapping from stimulus ids to the (first) index of the stimulus """
+    stimulus_indices = {}
+    for n, stimulus_id in enumerate(stimuli.stimulus_ids):
+        stimulus_indices.setdefault(stimulus_id, n)
+    return stimulus_indices
+
+
 class GoldModel(Model):
-    def __init__(self, stimuli, fixations, bandwidth, eps = 1e-20, keep_aspect=False, verbose=False, **kwargs):
+    """ Gold standard model: blurred fixation map of the fixations on each image.
+
+    Use `log_densities(stimuli, batch_size=...)` to compute the predictions of many stimuli
+    at once, which blurs all fixation maps of the same shape in batches.
+    """
+    def __init__(self, stimuli, fixations, bandwidth, eps = 1e-20, keep_aspect=False, verbose=False, blur_method='auto', **kwargs):
         super(GoldModel, self).__init__(**kwargs)
         self.stimuli = stimuli
         self.fixations = fixations
         self.bandwidth = bandwidth
         self.eps = eps
         self.keep_aspect = keep_aspect
+        self.blur_method = blur_method
         self.xs, self.ys = normalize_fixations(stimuli, fixations, keep_aspect=self.keep_aspect, verbose=verbose)
         self.shape_cache = {}
+        self._stimulus_indices = None
 
-    def _log_density(self, stimulus):
-        shape = stimulus.shape[0], stimulus.shape[1]
-
-        stimulus_id = get_image_hash(stimulus)
-        stimulus_index = self.stimuli.stimulus_ids.index(stimulus_id)
-
-        #fixations = self.fixations[self.fixations.n == stimulus_index]
-        inds = self.fixations.n == stimulus_index
+    def _get_stimulus_index(self, stimulus_id):
+        if self._stimulus_indices is None:
+            self._stimulus_indices = _get_stimulus_indices(self.stimuli)
+        return self._stimulus_indices[stimulus_id]
 
-        if not inds.sum():
-            return UniformModel().log_density(stimulus)
-
-        ZZ = np.zeros(shape)
+    def _get_factors(self, shape):
         if self.keep_aspect:
             height, width = shape
             max_size = max(width, height)
@@ -272,42 +500,133 @@ class GoldModel(Model):
         else:
             x_factor = shape[1]
             y_factor = shape[0]
-        _fixations = np.array([self.ys[inds]*y_factor, self.xs[inds]*x_factor]).T
-        fill_fixation_map(ZZ, _fixations)
-        ZZ = gaussian_filter(ZZ, [self.bandwidth*y_factor, self.bandwidth*x_factor])
-        ZZ *= (1-self.eps)
-        ZZ += self.eps * 1.0/(shape[0]*shape[1])
-        ZZ = np.log(ZZ)
+        return y_factor, x_factor
 
-        ZZ -= logsumexp(ZZ)
-        #ZZ -= np.log(np.exp(ZZ).sum())
+    def _fill_fixation_map(self, fixation_map, stimulus_index):
+        """ returns False if there are no fixations for the stimulus """
+        inds = self.fixations.n == stimulus_index
 
-        return ZZ
+        if not inds.sum():
+            return False
+
+        y_factor, x_factor = self._get_factors(fixation_map.shape)
+        _fixations = np.array([self.ys[inds]*y_factor, self.xs[inds]*x_factor]).T
+        fill_fixation_map(fixation_map, _fixations)
+        return True
+
+    def _log_density(self, stimulus):
+        stimulus_id = get_image_hash(stimulus)
+        return self._log_densities([Stimulus(stimulus, stimulus_id=stimulus_id)])[0]
+
+    def _log_densities(self, stimuli, verbose=False, batch_size=16):
+        log_densities = [None] * len(stimuli)
+        indices_by_shape = {}
+        for i, stimulus in enumerate(stimuli):
+            indices_by_shape.setdefault(stimulus.size, []).append(i)
+
+        with tqdm(total=len(stimuli), disable=not verbose) as pbar:
+            for shape, indices in indices_by_shape.items():
+                y_factor, x_factor = self._get_factors(shape)
+                for batch_indices in chunked(indices, batch_size):
+                    fixation_maps = np.zeros((len(batch_indices), ) + shape)
+                    has_fixations = np.array([
+                        self._fill_fixation_map(fixation_map, self._get_stimulus_index(stimuli[i].stimulus_id))
+                        for i, fixation_map in zip(batch_indices, fixation_maps)
+                    ])
+
+                    if has_fixations.any():
+                        batch_log_densities = _fixation_maps_to_log_densities(
+                            fixation_maps[has_fixations],
+                            [self.bandwidth*y_factor, self.bandwidth*x_factor],
+                            eps=self.eps,
+                            method=self.blur_method,
+                        )
+                        batch_log_densities = iter(batch_log_densities)
+
+                    for i, _has_fixations in zip(batch_indices, has_fixations):
+                        if _has_fixations:
+                            log_densities[i] = next(batch_log_densities)
+                        else:
+                            log_densities[i] = UniformModel().log_density(stimuli[i].stimulus_data)
+
+                    pbar.update(len(batch_indices))
+
+        return log_densities
 
 
 class KDEGoldModel(Model):
-    def __init__(self, stimuli, fixations, bandwidth, eps=1e-20, keep_aspect=False, verbose=False, grid_spacing=1, **kwargs):
+    """ Gold standard model using a gaussian KDE of the fixations on each image.
+
+    Parameters
+    ----------
+    method : one of 'sklearn', 'binned'
+        'sklearn' evaluates a `sklearn.neighbors.KernelDensity` at each pixel (or
+        every `grid_spacing` pixels, interpolating in between). 'binned' bins the fixations
+        onto the pixel grid and convolves with the gaussian kernel (see `binned_kde_log_density`),
+        which is much faster for large images and gives the same result up to a small
+        binning error. `grid_spacing` is ignored for 'binned'.
+    """
+    def __init__(self, stimuli, fixations, bandwidth, eps=1e-20, keep_aspect=False, verbose=False, grid_spacing=1, method='sklearn', **kwargs):
         super(KDEGoldModel, self).__init__(**kwargs)
+        if method not in ['sklearn', 'binned']:
+            raise ValueError(method)
         self.stimuli = stimuli
         self.fixations = fixations
         self.bandwidth = bandwidth
         self.eps = eps
         self.keep_aspect = keep_aspect
         self.grid_spacing = grid_spacing
+        self.method = method
         self.xs, self.ys = normalize_fixations(stimuli, fixations, keep_aspect=self.keep_aspect, verbose=verbose)
         self.shape_cache = {}
+        self._stimulus_indices = None
 
     def _log_density(self, stimulus):
         shape = stimulus.shape[0], stimulus.shape[1]
 
         stimulus_id = get_image_hash(stimulus)
-        stimulus_index = self.stimuli.stimulus_ids.index(stimulus_id)
+        if self._stimulus_indices is None:
+            self._stimulus_indices = _get_stimulus_indices(self.stimuli)
+        stimulus_index = self._stimulus_indices[stimulus_id]
 
         inds = self.fixations.n == stimulus_index
 
         if not inds.sum():
             return UniformModel().log_density(stimulus)
 
+        if self.method == 'binned':
+            scores = self._binned_scores(shape, inds)
+        else:
+            scores = self._sklearn_scores(shape, inds)
+
+        height, width = shape
+
+        scores -= logsumexp(scores)
+        ZZ = scores
+
+        if self.eps:
+            ZZ = np.logaddexp(
+                np.log(1 - self.eps) + scores,
+                np.log(self.eps) - np.log(height * width)
+            )
+
+        ZZ -= logsumexp(ZZ)
+
+        return ZZ
+
+    def _binned_scores(self, shape, inds):
+        height, width = shape
+        if self.keep_aspect:
+            x_factor = y_factor = max(height, width)
+        else:
+            x_factor = width
+            y_factor = height
+
+        return binned_kde_log_density(
+            self.xs[inds] * x_factor, self.ys[inds] * y_factor, shape,
+            [self.bandwidth * y_factor, self.bandwidth * x_factor])
+
+    def _sklearn_scores(self, shape, inds):
         X = fixations_to_scikit_learn(
             self.fixations[inds], normalize=self.stimuli,
             keep_aspect=self.keep_aspect, add_shape=False, verbose=False)
@@ -350,64 +669,81 @@ class KDEGoldModel(Model):
             score_grid = inter_and_extrapolate(score_grid)
             scores = score_grid
 
-        scores -= logsumexp(scores)
-        ZZ = scores
-
-        if self.eps:
-            ZZ = np.logaddexp(
-                np.log(1 - self.eps) + scores,
-                np.log(self.eps) - np.log(height * width)
-            )
-
-        ZZ -= logsumexp(ZZ)
-
-        return ZZ
+        return scores
 
 
 
 class CrossvalidatedBaselineModel(Model):
-    def __init__(self, stimuli, fixations, bandwidth, eps = 1e-20, **kwargs):
+    """ Leave-one-image-out baseline model: blurred fixation map of the fixations on all other images.
+
+    For each image shape, the blurred fixation map of all fixations is computed only once.
+    The prediction for an image is then given by subtracting the blurred fixation map
+    of the image's own fixations.
+    """
+    def __init__(self, stimuli, fixations, bandwidth, eps = 1e-20, blur_method='auto', **kwargs):
         super(CrossvalidatedBaselineModel, self).__init__(**kwargs)
         self.stimuli = stimuli
         self.fixations = fixations
         self.bandwidth = bandwidth
         self.eps = eps
+        self.blur_method = blur_method
         self.xs, self.ys = normalize_fixations(stimuli, fixations)
         #self.kde = KernelDensity(kernel='gaussian', bandwidth=bandwidth).fit(np.vstack([self.xs, self.ys]).T)
         self.shape_cache = {}
+        self._stimulus_indices = None
+
+    def _fixation_map(self, shape, inds=None):
+        ZZ = np.zeros(shape)
+        if inds is None:
+            _fixations = np.array([self.ys*shape[0], self.xs*shape[1]]).T
+        else:
+            _fixations = np.array([self.ys[inds]*shape[0], self.xs[inds]*shape[1]]).T
+        fill_fixation_map(ZZ, _fixations)
+        return ZZ
+
+    def _get_total_maps(self, shape, sigmas):
+        """ blurred fixation map of all fixations and fixation counts in the kernel support """
+        if shape not in self.shape_cache:
+            ZZ = self._fixation_map(shape)
+            self.shape_cache[shape] = (
+                blur_fixation_maps(ZZ, sigmas, method=self.blur_method),
+                _fixation_counts_in_kernel_support(ZZ, sigmas),
+            )
+        return self.shape_cache[shape]
 
     def _log_density(self, stimulus):
         shape = stimulus.shape[0], stimulus.shape[1]
+        sigmas = [self.bandwidth*shape[0], self.bandwidth*shape[1]]
 
         stimulus_id = get_image_hash(stimulus)
-        stimulus_index = self.stimuli.stimulus_ids.index(stimulus_id)
+        if self._stimulus_indices is None:
+            self._stimulus_indices = _get_stimulus_indices(self.stimuli)
+        stimulus_index = self._stimulus_indices[stimulus_id]
 
-        #fixations = self.fixations[self.fixations.n == stimulus_index]
-        inds = self.fixations.n != stimulus_index
+        total_blurred_map, total_counts = self._get_total_maps(shape, sigmas)
 
-        ZZ = np.zeros(shape)
+        own_map = self._fixation_map(shape, inds=self.fixations.n == stimulus_index)
+        own_blurred_map = _blur_local_fixation_map(own_map, sigmas, method=self.blur_method)
+        own_counts = _fixation_counts_in_kernel_support(own_map, sigmas)
 
-        _fixations = np.array([self.ys[inds]*shape[0], self.xs[inds]*shape[1]]).T
-        fill_fixation_map(ZZ, _fixations)
-        ZZ = gaussian_filter(ZZ, [self.bandwidth*shape[0], self.bandwidth*shape[1]])
-        ZZ *= (1-self.eps)
-        ZZ += self.eps * 1.0/(shape[0]*shape[1])
-        ZZ = np.log(ZZ)
+        ZZ = total_blurred_map - own_blurred_map
+        # blurring is linear, but the difference is only exact up to rounding errors.
+        # Pixels without any fixation of other images in reach of the kernel are exactly zero.
+        np.maximum(ZZ, 0, out=ZZ)
+        ZZ[total_counts == own_counts] = 0
 
-        ZZ -= logsumexp(ZZ)
-        #ZZ -= np.log(np.exp(ZZ).sum())
-
-        return ZZ
+        return _blurred_maps_to_log_densities(ZZ, eps=self.eps)
 
 
 class BaselineModel(Model):
-    def __init__(self, stimuli, fixations, bandwidth, eps = 1e-20, keep_aspect=False, **kwargs):
+    def __init__(self, stimuli, fixations, bandwidth, eps = 1e-20, keep_aspect=False, blur_method='auto', **kwargs):
         super(BaselineModel, self).__init__(**kwargs)
         self.stimuli = stimuli
         self.fixations = fixations
         self.bandwidth = bandwidth
         self.eps = eps
         self.keep_aspect = keep_aspect
+        self.blur_method = blur_method
         self.xs, self.ys = normalize_fixations(stimuli, fixations, keep_aspect=keep_aspect)
         self.shape_cache = {}
 
@@ -425,12 +761,193 @@ class BaselineModel(Model):
                 x_factor = width
             _fixations = np.array([self.ys*y_factor, self.xs*x_factor]).T
             fill_fixation_map(ZZ, _fixations)
-            ZZ = gaussian_filter(ZZ, [self.bandwidth*y_factor, self.bandwidth*x_factor])
-            ZZ *= (1-self.eps)
-            ZZ += self.eps * 1.0/(shape[0]*shape[1])
-            ZZ = np.log(ZZ)
-
-            ZZ -= logsumexp(ZZ)
-            self.shape_cache[shape] = ZZ
+            self.shape_cache[shape] = _fixation_maps_to_log_densities(
+                ZZ, [self.bandwidth*y_factor, self.bandwidth*x_factor], eps=self.eps, method=self.blur_method)
 
         return self.shape_cache[shape]
+
+
+def _blur_kernel(sigma, truncate):
+    if sigma <= 1e-15:
+        return np.ones(1), 0
+    radius = _blur_radius(sigma, truncate)
+    return _gaussian_kernel_1d(sigma, radius), radius
+
+
+def _fft_blur_for_sigmas(fixation_map, sigmas_list, truncate=4.0, workers=None):
+    """ blur a fixation map for several kernel sizes, reusing the FFT of the fixation map.
+
+    Yields the same results as `blur_fixation_maps(fixation_map, sigmas, method='fft')` for
+    each sigmas in `sigmas_list`.
+    """
+    height, width = fixation_map.shape
+    max_radius_y = max(_blur_kernel(sigma_y, truncate)[1] for sigma_y, _ in sigmas_list)
+    max_radius_x = max(_blur_kernel(sigma_x, truncate)[1] for _, sigma_x in sigmas_list)
+
+    padded = np.pad(fixation_map, [(max_radius_y, max_radius_y), (max_radius_x, max_radius_x)], mode='symmetric')
+    fft_shape = (scipy.fft.next_fast_len(padded.shape[0]),
+                 scipy.fft.next_fast_len(padded.shape[1], real=True))
+    spectrum = scipy.fft.rfft2(padded, s=fft_shape, workers=workers)
+    support_counts = fixation_map.astype(np.int64)
+
+    for sigma_y, sigma_x in sigmas_list:
+        kernel_y, radius_y = _blur_kernel(sigma_y, truncate)
+        kernel_x, radius_x = _blur_kernel(sigma_x, truncate)
+        kernel_spectrum = (scipy.fft.fft(kernel_y, n=fft_shape[0])[:, np.newaxis]
+                           * scipy.fft.rfft(kernel_x, n=fft_shape[1])[np.newaxis, :])
+        blurred = scipy.fft.irfft2(spectrum * kernel_spectrum, s=fft_shape, workers=workers)
+        offset_y = max_radius_y + radius_y
+        offset_x = max_radius_x + radius_x
+        blurred = blurred[offset_y:offset_y + height, offset_x:offset_x + width]
+
+        counts = _window_counts(_window_counts(support_counts, radius_y, axis=0), radius_x, axis=1)
+        blurred = np.maximum(blurred, 0)
+        blurred[counts == 0] = 0
+
+        yield blurred, counts
+
+
+def _blurred_unit_vectors(size, positions, sigma, truncate=4.0):
+    """ blurred unit vectors (as columns) and the number of positions within the kernel support
+    (both with reflecting boundaries). Column j describes how a fixation at `positions[j]`
+    contributes to the blurred fixation map.
+    """
+    unit_vectors = np.zeros((size, len(positions)), dtype=np.int64)
+    unit_vectors[positions, np.arange(len(positions))] = 1
+    if sigma <= 1e-15:
+        return unit_vectors.astype(float), unit_vectors
+    radius = _blur_radius(sigma, truncate)
+    blurred = gaussian_filter1d(unit_vectors.astype(float), sigma, axis=0, truncate=truncate)
+    return blurred, _window_counts(unit_vectors, radius, axis=0)
+
+
+def _sweep_pool(shape, pool_ys, pool_xs, groups, sigmas_list, eps, truncate=4.0, workers=None):
+    """ leave-one-group-out log likelihoods for all sigmas.
+
+    The prediction for a group is the blurred fixation map of all fixations in the pool
+    except the fixations of the group. Each group is given by the indices of its
+    fixations in the pool and the pixel positions at which the predictions are evaluated.
+    """
+    height, width = shape
+    pool_ys = np.asarray(pool_ys, dtype=int)
+    pool_xs = np.asarray(pool_xs, dtype=int)
+
+    total_map = np.zeros(shape)
+    fill_fixation_map(total_map, np.array([pool_ys, pool_xs]).T)
+
+    rows, row_indices = np.unique(pool_ys, return_inverse=True)
+    columns, column_indices = np.unique(pool_xs, return_inverse=True)
+
+    results = [np.empty((len(sigmas_list), len(eval_ys))) for _, eval_ys, _ in groups]
+
+    blurred_maps = _fft_blur_for_sigmas(total_map, sigmas_list, truncate=truncate, workers=workers)
+    for k, ((sigma_y, sigma_x), (total_blurred, total_counts)) in enumerate(zip(sigmas_list, blurred_maps)):
+        y_blur, y_counts = _blurred_unit_vectors(height, rows, sigma_y, truncate=truncate)
+        x_blur, x_counts = _blurred_unit_vectors(width, columns, sigma_x, truncate=truncate)
+        y_sums = y_blur.sum(axis=0)
+        x_sums = x_blur.sum(axis=0)
+        total_sum = total_blurred.sum()
+
+        for (group_indices, eval_ys, eval_xs), result in zip(groups, results):
+            _rows = row_indices[group_indices]
+            _columns = column_indices[group_indices]
+
+            own_values = (y_blur[eval_ys][:, _rows] * x_blur[eval_xs][:, _columns]).sum(axis=1)
+            own_counts = (y_counts[eval_ys][:, _rows] * x_counts[eval_xs][:, _columns]).sum(axis=1)
+            own_sum = (y_sums[_rows] * x_sums[_columns]).sum()
+
+            values = np.maximum(total_blurred[eval_ys, eval_xs] - own_values, 0)
+            values[total_counts[eval_ys, eval_xs] == own_counts] = 0
+
+            with np.errstate(divide='ignore'):
+                result[k] = (np.log((1 - eps) * values + eps / (height * width))
+                             - np.log((1 - eps) * max(total_sum - own_sum, 0) + eps))
+
+    return results
+
+
+def bandwidth_sweep(stimuli, fixations, bandwidths, model='baseline', eps=1e-20, keep_aspect=False,
+                    average='fixation', num_workers=None, verbose=False):
+    """ Crossvalidated log likelihoods of blurred fixation map models for many bandwidths.
+
+    The fixation maps are built only once and the FFTs of the fixation maps are reused for
+    all bandwidths, which is much faster than building a model for each bandwidth.
+
+    Parameters
+    ----------
+    bandwidths : list of floats
+        bandwidths in the units of `BaselineModel`, `CrossvalidatedBaselineModel` and `GoldModel`
+    model : one of 'baseline', 'gold'
+        'baseline': leave-one-image-out crossvalidation of `BaselineModel` (for `keep_aspect=False`
+        the same predictions as `CrossvalidatedBaselineModel`). 'gold': leave-one-subject-out
+        crossvalidation of `GoldModel` on each image.
+    average : one of 'fixation', 'image', None
+        how to average the log likelihoods (see `Model.log_likelihood`). With `None`, the log likelihoods
+        of all fixations are returned.
+    num_workers : int, optional
+        number of threads used to process images (or image shapes for `model='baseline'`) in parallel.
+
+    Returns
+    -------
+    log likelihoods of shape (len(bandwidths), ) or (len(bandwidths), len(fixations)) for `average=None`.
+    """
+    if model not in ['baseline', 'gold']:
+        raise ValueError(model)
+
+    bandwidths = np.asarray(bandwidths, dtype=float)
+    xs, ys = normalize_fixations(stimuli, fixations, keep_aspect=keep_aspect)
+    eval_xs = fixations.x_int
+    eval_ys = fixations.y_int
+
+    def _get_factors(shape):
+        if keep_aspect:
+            return max(shape), max(shape)
+        return shape
+
+    tasks = []
+    if model == 'baseline':
+        stimulus_indices_by_shape = {}
+        for n, size in enumerate(stimuli.sizes):
+            stimulus_indices_by_shape.setdefault(tuple(size), []).append(n)
+
+        for shape, stimulus_indices in stimulus_indices_by_shape.items():
+            groups = []
+            for n in stimulus_indices:
+                group_indices = np.nonzero(fixations.n == n)[0]
+                if len(group_indices):
+                    groups.append((group_indices, eval_ys[group_indices], eval_xs[group_indices]))
+            if groups:
+                tasks.append((shape, np.arange(len(fixations.n)), groups))
+    else:
+        for n, size in enumerate(stimuli.sizes):
+            pool_indices = np.nonzero(fixations.n == n)[0]
+            if not len(pool_indices):
+                continue
+            groups = []
+            pool_subjects = fixations.subjects[pool_indices]
+            for subject in np.unique(pool_subjects):
+                group_indices = np.nonzero(pool_subjects == subject)[0]
+                groups.append((group_indices, eval_ys[pool_indices[group_indices]], eval_xs[pool_indices[group_indices]]))
+            tasks.append((tuple(size), pool_indices, groups))
+
+    def _process(task):
+        shape, pool_indices, groups = task
+        y_factor, x_factor = _get_factors(shape)
+        sigmas_list = [(bandwidth * y_factor, bandwidth * x_factor) for bandwidth in bandwidths]
+        # use multithreaded FFTs if there are less tasks than threads
+        workers = num_workers if len(tasks) == 1 else None
+        group_results = _sweep_pool(shape, ys[pool_indices] * y_factor, xs[pool_indices] * x_factor,
+                                    groups, sigmas_list, eps=eps, workers=workers)
+        return [(pool_indices[group_indices], result) for (group_indices, _, _), result in zip(groups, group_results)]
+
+    log_likelihoods = np.full((len(bandwidths), len(fixations.n)), np.nan)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for task_results in tqdm(executor.map(_process, tasks), total=len(tasks), disable=not verbose):
+            for fixation_indices, result in task_results:
+                log_likelihoods[:, fixation_indices] = result
+
+    if average is None:
+        return log_likelihoods
+
+    return np.array([average_values(_log_likelihoods, fixations, average=average)
+                     for _log_likelihoods in log_likelihoods])
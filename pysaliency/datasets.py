@@ -5,6 +5,7 @@ from __future__ import absolute_import, print_function, division, unicode_litera
 import os
 from hashlib import sha1
 from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 import json
 from functools import wraps
 from weakref import WeakValueDictionary
@@ -74,6 +75,8 @@ def read_hdf5(source):
         return Stimuli.read_hdf5(source)
     elif data_type == 'FileStimuli':
         return FileStimuli.read_hdf5(source)
+    elif data_type == 'PackedStimuli':
+        return PackedStimuli.read_hdf5(source)
     else:
         raise ValueError("Invalid HDF content type:", data_type)
 
@@ -382,38 +385,25 @@ class FixationTrains(Fixations):
         self.train_ts = train_ts
         self.train_ns = train_ns
         self.train_subjects = train_subjects
-        N_trains = self.train_xs.shape[0] * self.train_xs.shape[1] - np.isnan(self.train_xs).sum()
         max_length_trains = self.train_xs.shape[1]
 
         # Create conditional fixations
-        self.x = np.empty(N_trains)
-        self.y = np.empty(N_trains)
-        self.t = np.empty(N_trains)
-        self.x_hist = np.empty((N_trains, max_length_trains - 1))
-        self.y_hist = np.empty((N_trains, max_length_trains - 1))
-        self.t_hist = np.empty((N_trains, max_length_trains - 1))
-        self.x_hist[:] = np.nan
-        self.y_hist[:] = np.nan
-        self.t_hist[:] = np.nan
-        self.n = np.empty(N_trains, dtype=int)
-        self.lengths = np.empty(N_trains, dtype=int)
-        self.subjects = np.empty(N_trains, dtype=int)
-        self.scanpath_index = np.empty(N_trains, dtype=int)
-        out_index = 0
-        for train_index in range(self.train_xs.shape[0]):
-            fix_length = (1 - np.isnan(self.train_xs[train_index])).sum()
-            for fix_index in range(fix_length):
-                self.x[out_index] = self.train_xs[train_index][fix_index]
-                self.y[out_index] = self.train_ys[train_index][fix_index]
-                self.t[out_index] = self.train_ts[train_index][fix_index]
-                self.n[out_index] = self.train_ns[train_index]
-                self.subjects[out_index] = self.train_subjects[train_index]
-                self.lengths[out_index] = fix_index
-                self.scanpath_index[out_index] = train_index
-                self.x_hist[out_index][:fix_index] = self.train_xs[train_index][:fix_index]
-                self.y_hist[out_index][:fix_index] = self.train_ys[train_index][:fix_index]
-                self.t_hist[out_index][:fix_index] = self.train_ts[train_index][:fix_index]
-                out_index += 1
+        train_lengths = (1 - np.isnan(self.train_xs)).sum(axis=1)
+        fixation_mask = np.arange(max_length_trains)[np.newaxis, :] < train_lengths[:, np.newaxis]
+        train_indices, fixation_indices = np.nonzero(fixation_mask)
+
+        self.x = np.asarray(self.train_xs[fixation_mask], dtype=float)
+        self.y = np.asarray(self.train_ys[fixation_mask], dtype=float)
+        self.t = np.asarray(self.train_ts[fixation_mask], dtype=float)
+        self.n = np.asarray(self.train_ns, dtype=int)[train_indices]
+        self.subjects = np.asarray(self.train_subjects, dtype=int)[train_indices]
+        self.lengths = fixation_indices.astype(int)
+        self.scanpath_index = train_indices.astype(int)
+
+        history_mask = np.arange(max_length_trains - 1)[np.newaxis, :] < fixation_indices[:, np.newaxis]
+        self.x_hist = np.where(history_mask, self.train_xs[train_indices, :max_length_trains - 1], np.nan)
+        self.y_hist = np.where(history_mask, self.train_ys[train_indices, :max_length_trains - 1], np.nan)
+        self.t_hist = np.where(history_mask, self.train_ts[train_indices, :max_length_trains - 1], np.nan)
 
         if scanpath_attributes is not None:
             assert isinstance(scanpath_attributes, dict)
@@ -633,58 +623,31 @@ class FixationTrains(Fixations):
 #        return type(self)(train_xs, train_ys, train_ts, train_ns, train_subjects)
 
     def shuffle_fixations(self, stimuli=None):
-        new_indices = []
-        new_ns = []
-        if stimuli:
-            widths = np.asarray([s[1] for s in stimuli.sizes]).astype(float)
-            heights = np.asarray([s[0] for s in stimuli.sizes]).astype(float)
-            x_factors = []
-            y_factors = []
-        for n in range(self.n.max()+1):
-            inds = np.nonzero(~(self.n == n))[0]
-            new_indices.extend(inds)
-            new_ns.extend([n]*len(inds))
-            if stimuli:
-                other_ns = self.n[inds]
-                x_factors.extend(stimuli.sizes[n][1]/widths[other_ns])
-                y_factors.extend(stimuli.sizes[n][0]/heights[other_ns])
-        new_fixations = self[new_indices]
-        new_fixations.n = np.asarray(new_ns)
-        if stimuli:
-            x_factors = np.asarray(x_factors)
-            y_factors = np.asarray(y_factors)
-            new_fixations.x = x_factors*new_fixations.x
-            new_fixations.x_hist = x_factors[:, np.newaxis]*new_fixations.x_hist
-            new_fixations.y = y_factors*new_fixations.y
-            new_fixations.y_hist = y_factors[:, np.newaxis]*new_fixations.y_hist
-        return new_fixations
+        """ Create nonfixations for each image from the fixations of all other images.
 
-    def shuffle_fixation_trains(self, stimuli=None):
+        The result contains, for every image, all fixations of the other images. If `stimuli`
+        are given, fixations are rescaled to the size of the image. Use `ShuffledNonfixations`
+        to generate the nonfixations of single images on demand instead.
         """
+        return ShuffledNonfixations(self, stimuli=stimuli).to_fixations()
+
+    def _shuffled_fixation_trains(self):
+        train_indices, train_ns = _indices_of_other_images(self.train_ns, self.n.max() + 1)
+        return type(self)(
+            self.train_xs[train_indices],
+            self.train_ys[train_indices],
+            self.train_ts[train_indices],
+            train_ns,
+            self.train_subjects[train_indices]
+        )
 
+    def shuffle_fixation_trains(self, stimuli=None):
         """
-        if not self.consistent_fixation_trains:
-            raise ValueError('Cannot shuffle fixation trains as fixation trains not consistent!')
-        train_xs = []
-        train_ys = []
-        train_ts = []
-        train_ns = []
-        train_subjects = []
-        for n in range(self.n.max()+1):
-            inds = ~(self.train_ns == n)
-            train_xs.append(self.train_xs[inds])
-            train_ys.append(self.train_ys[inds])
-            train_ts.append(self.train_ts[inds])
-            train_ns.append(np.ones(inds.sum(), dtype=int)*n)
-            train_subjects.append(self.train_subjects[inds])
-        train_xs = np.vstack(train_xs)
-        train_ys = np.vstack(train_ys)
-        train_ts = np.vstack(train_ts)
-        train_ns = np.hstack(train_ns)
-        train_subjects = np.hstack(train_subjects)
-        full_nonfixations = type(self)(train_xs, train_ys, train_ts, train_ns, train_subjects)
-        #self.full_nonfixations = full_nonfixations
-        return full_nonfixations
+        Generate nonfixational distribution from this fixation object by
+        using all fixation trains of other images, see `generate_full_nonfixations`.
+        In contrast to `generate_full_nonfixations`, the result is not cached.
+        """
+        return self._shuffled_fixation_trains()
 
     def generate_full_nonfixations(self, stimuli=None):
         """
@@ -701,24 +664,7 @@ class FixationTrains(Fixations):
         if self.full_nonfixations is not None:
             print("Reusing nonfixations!")
             return self.full_nonfixations
-        train_xs = []
-        train_ys = []
-        train_ts = []
-        train_ns = []
-        train_subjects = []
-        for n in range(self.n.max()+1):
-            inds = ~(self.train_ns == n)
-            train_xs.append(self.train_xs[inds])
-            train_ys.append(self.train_ys[inds])
-            train_ts.append(self.train_ts[inds])
-            train_ns.append(np.ones(inds.sum(), dtype=int)*n)
-            train_subjects.append(self.train_subjects[inds])
-        train_xs = np.vstack(train_xs)
-        train_ys = np.vstack(train_ys)
-        train_ts = np.vstack(train_ts)
-        train_ns = np.hstack(train_ns)
-        train_subjects = np.hstack(train_subjects)
-        full_nonfixations = type(self)(train_xs, train_ys, train_ts, train_ns, train_subjects)
+        full_nonfixations = self._shuffled_fixation_trains()
         self.full_nonfixations = full_nonfixations
         return full_nonfixations
 
@@ -737,15 +683,34 @@ class FixationTrains(Fixations):
         train_ns = self.train_ns.copy()
         train_subjects = self.train_subjects.copy()
         rs = np.random.RandomState(seed)
-        for train_index in range(len(train_ns)):
-            n = train_ns[train_index]
-            inds = np.nonzero(self.n != n)[0]
-            length = (1 - np.isnan(train_xs[train_index])).sum()
-            for i in range(length):
-                new_fix_index = rs.choice(inds)
-                train_xs[train_index][i] = self.x[new_fix_index]
-                train_ys[train_index][i] = self.y[new_fix_index]
-                train_ts[train_index][i] = self.t[new_fix_index]
+
+        # For each fixation, draw the rank of its partner among the fixations of all other
+        # images (in the same order of random draws as sampling the partners one by one).
+        # The rank is converted into a fixation index by skipping the fixations of the image
+        # itself: for the sorted fixations of each image, `gaps` counts the fixations of other
+        # images before them, which can be searched for all images at once.
+        fixation_order = np.argsort(self.n, kind='stable')
+        sorted_ns = self.n[fixation_order]
+        counts = np.bincount(self.n, minlength=train_ns.max() + 1)
+        starts = np.cumsum(counts) - counts
+        gaps = fixation_order - (np.arange(len(self.n)) - starts[sorted_ns])
+        block_keys = sorted_ns * (len(self.n) + 1) + gaps
+
+        lengths = (1 - np.isnan(train_xs)).sum(axis=1)
+        fixation_mask = np.arange(train_xs.shape[1])[np.newaxis, :] < lengths[:, np.newaxis]
+        ns = train_ns[np.nonzero(fixation_mask)[0]]
+
+        other_counts = len(self.n) - counts[ns]
+        if np.any(other_counts == 0):
+            raise ValueError("Cannot generate nonfixation partners without fixations on other images")
+
+        ranks = rs.randint(0, other_counts)
+        skipped = np.searchsorted(block_keys, ns * (len(self.n) + 1) + ranks, side='right') - starts[ns]
+        new_fix_indices = ranks + skipped
+
+        train_xs[fixation_mask] = self.x[new_fix_indices]
+        train_ys[fixation_mask] = self.y[new_fix_indices]
+        train_ts[fixation_mask] = self.t[new_fix_indices]
         return type(self)(train_xs, train_ys, train_ts, train_ns, train_subjects)
 
     @hdf5_wrapper(mode='w')
@@ -817,6 +782,82 @@ class FixationTrains(Fixations):
         return fixations
 
 
+def _indices_of_other_images(ns, image_count):
+    """ For each image, the indices of all entries of `ns` that belong to other images.
+
+    Returns the indices for all images concatenated in order of the images and
+    the image each index was selected for.
+    """
+    ns = np.asarray(ns)
+    counts = np.bincount(ns, minlength=image_count)[:image_count]
+    indices = np.concatenate([np.nonzero(ns != n)[0] for n in range(image_count)] or [np.array([], dtype=int)])
+    new_ns = np.repeat(np.arange(image_count), len(ns) - counts)
+    return indices, new_ns
+
+
+class ShuffledNonfixations(object):
+    """
+    Shuffled nonfixations which are generated on demand for each image.
+
+    The nonfixations of an image are the fixations of all other images, rescaled
+    to the size of the image if stimuli are given. The full set of nonfixations
+    for all images grows with the number of images times the number of fixations.
+    This class only computes the nonfixations of the images that are actually needed.
+    """
+    def __init__(self, fixations, stimuli=None):
+        self.fixations = fixations
+        self.stimuli = stimuli
+        # as in previous versions, `to_fixations` covers the images up to the last one with fixations;
+        # the stimuli are only used for rescaling
+        self.image_count = self.fixations.n.max() + 1
+        if stimuli:
+            self.widths = np.asarray([s[1] for s in stimuli.sizes]).astype(float)
+            self.heights = np.asarray([s[0] for s in stimuli.sizes]).astype(float)
+
+    def __len__(self):
+        return self.image_count
+
+    def indices_for_image(self, n):
+        """ indices of the fixations which are used as nonfixations for image `n` """
+        return np.nonzero(self.fixations.n != n)[0]
+
+    def _scale_factors(self, indices, ns):
+        other_ns = self.fixations.n[indices]
+        return self.widths[ns] / self.widths[other_ns], self.heights[ns] / self.heights[other_ns]
+
+    def coordinates_for_image(self, n):
+        """ x and y coordinates of the nonfixations for image `n` """
+        indices = self.indices_for_image(n)
+        xs = self.fixations.x[indices].astype(float)
+        ys = self.fixations.y[indices].astype(float)
+        if self.stimuli:
+            x_factors, y_factors = self._scale_factors(indices, n)
+            xs *= x_factors
+            ys *= y_factors
+        return xs, ys
+
+    def _create_fixations(self, indices, ns):
+        new_fixations = self.fixations[indices]
+        new_fixations.n = np.asarray(ns)
+        if self.stimuli:
+            x_factors, y_factors = self._scale_factors(indices, ns)
+            new_fixations.x = x_factors*new_fixations.x
+            new_fixations.x_hist = x_factors[:, np.newaxis]*new_fixations.x_hist
+            new_fixations.y = y_factors*new_fixations.y
+            new_fixations.y_hist = y_factors[:, np.newaxis]*new_fixations.y_hist
+        return new_fixations
+
+    def nonfixations_for_image(self, n):
+        """ nonfixations for image `n` as `Fixations` object """
+        indices = self.indices_for_image(n)
+        return self._create_fixations(indices, np.full(len(indices), n, dtype=int))
+
+    def to_fixations(self):
+        """ materialize the nonfixations of all images into one `Fixations` object """
+        indices, ns = _indices_of_other_images(self.fixations.n, self.image_count)
+        return self._create_fixations(indices, ns)
+
+
 def get_image_hash(img):
     """
     Calculate a unique hash for the given image.
@@ -990,6 +1031,67 @@ class Stimuli(Sequence):
 
         return stimuli
 
+    @hdf5_wrapper(mode='w')
+    def to_packed_hdf5(self, target, compression=None, compression_opts=None, chunk_size=2**20, verbose=False):
+        """ Write stimuli to hdf5 file or hdf5 group as one packed buffer.
+
+        All stimuli are flattened and concatenated into a single dataset. The
+        offsets and shapes of the stimuli are stored alongside, such that
+        single stimuli can be loaded without reading the other ones, see `PackedStimuli`.
+        Without compression, the buffer is stored contiguously and will be memory mapped
+        when reading it. With compression, the buffer is chunked into chunks of
+        `chunk_size` items. Besides the compression filters of h5py (e.g. `'lzf'`),
+        filters from the `hdf5plugin` package can be used, e.g. `compression=hdf5plugin.LZ4()`.
+        """
+        import h5py
+
+        target.attrs['type'] = np.string_('PackedStimuli')
+        target.attrs['version'] = np.string_('1.0')
+
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        offsets = np.cumsum([0] + sizes).astype(np.int64)
+        total_size = int(offsets[-1])
+        if not total_size:
+            compression = None
+
+        data = None
+        for n, stimulus in enumerate(tqdm(self.stimuli, disable=not verbose)):
+            stimulus = np.asarray(stimulus)
+            if stimulus.shape != tuple(self.shapes[n]):
+                raise ValueError("Shape of stimulus {} does not match: {} != {}".format(n, stimulus.shape, self.shapes[n]))
+
+            if data is None:
+                data = target.create_dataset(
+                    'data',
+                    (total_size, ),
+                    dtype=stimulus.dtype,
+                    chunks=(min(chunk_size, total_size), ) if compression is not None else None,
+                    compression=compression,
+                    compression_opts=compression_opts,
+                )
+            elif not np.can_cast(stimulus.dtype, data.dtype, casting='safe'):
+                raise ValueError("All stimuli need to have the same dtype, got {} and {}".format(data.dtype, stimulus.dtype))
+
+            data[offsets[n]:offsets[n + 1]] = stimulus.ravel()
+
+        if data is None:
+            target.create_dataset('data', (0, ), dtype=np.uint8)
+
+        target.create_dataset('offsets', data=offsets)
+
+        shape_dataset = target.create_dataset(
+            'shapes',
+            (len(self), ),
+            dtype=h5py.special_dtype(vlen=np.dtype('int64'))
+        )
+
+        for n, shape in enumerate(self.shapes):
+            shape_dataset[n] = np.array(shape)
+
+        self._attributes_to_hdf5(target)
+
+        target.attrs['size'] = len(self)
+
     def _attributes_to_hdf5(self, target):
         for attribute_name, attribute_value in self.attributes.items():
             create_hdf5_dataset(target, attribute_name, attribute_value)
@@ -1044,18 +1146,108 @@ class ObjectStimuli(Stimuli):
         raise NotImplementedError()
 
 
+def get_image_shape(filename):
+    """ Read the shape of an image file without decoding the image data.
+
+    Returns (height, width) for single channel images and (height, width, channels)
+    otherwise, which is the shape that `imread` will return for the image.
+    """
+    with Image.open(filename) as img:
+        width, height = img.size
+        if len(img.mode) > 1:
+            # PIL uses (width, height), we use (height, width)
+            return (height, width, len(img.mode))
+        else:
+            return (height, width)
+
+
+def _shape_manifest_key(filename):
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_mtime, stat.st_size
+
+
+def _read_shape_manifest(manifest_filename):
+    if not os.path.exists(manifest_filename):
+        return {}
+
+    with open(manifest_filename) as f:
+        entries = json.load(f)
+
+    return {entry['filename']: entry for entry in entries}
+
+
+def _write_shape_manifest(manifest_filename, manifest):
+    # write to a temporary file first so that concurrent readers never see a partial manifest
+    tmp_filename = '{}.tmp{}'.format(manifest_filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(sorted(manifest.values(), key=lambda entry: entry['filename']), f)
+    os.replace(tmp_filename, manifest_filename)
+
+
+def get_image_shapes(filenames, num_workers=None, shape_manifest=None):
+    """ Read the shapes of many image files.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        image files to inspect
+    num_workers : int, optional
+        number of threads used to open the files. Reading the image headers is
+        IO bound, so using threads speeds up discovery on network filesystems.
+        If `None`, a default depending on the number of cpus is used. With
+        `num_workers=1` all files are opened sequentially.
+    shape_manifest : string, optional
+        filename of a JSON manifest that caches the shapes. Entries are keyed
+        by the absolute path of the image and invalidated if the modification
+        time or the size of the file changed. New shapes are added to the manifest.
+    """
+    manifest = _read_shape_manifest(shape_manifest) if shape_manifest is not None else {}
+
+    shapes = [None] * len(filenames)
+    keys = [None] * len(filenames)
+    missing = []
+    for n, filename in enumerate(filenames):
+        if shape_manifest is not None:
+            keys[n] = _shape_manifest_key(filename)
+            entry = manifest.get(keys[n][0])
+            if entry is not None and (entry['mtime'], entry['size']) == keys[n][1:]:
+                shapes[n] = tuple(entry['shape'])
+                continue
+        missing.append(n)
+
+    missing_filenames = [filenames[n] for n in missing]
+    if num_workers == 1 or len(missing) <= 1:
+        missing_shapes = [get_image_shape(filename) for filename in missing_filenames]
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            missing_shapes = list(executor.map(get_image_shape, missing_filenames))
+
+    for n, shape in zip(missing, missing_shapes):
+        shapes[n] = shape
+        if shape_manifest is not None:
+            filename, mtime, size = keys[n]
+            manifest[filename] = {'filename': filename, 'mtime': mtime, 'size': size, 'shape': list(shape)}
+
+    if shape_manifest is not None and missing:
+        _write_shape_manifest(shape_manifest, manifest)
+
+    return shapes
+
+
 class FileStimuli(Stimuli):
     """
     Manage a list of stimuli that are saved as files.
     """
-    def __init__(self, filenames, cache=True, shapes=None, attributes=None):
+    def __init__(self, filenames, cache=True, shapes=None, attributes=None,
+                 lazy_shapes=False, shape_manifest=None, num_workers=None, max_cache_bytes=None):
         """
         Create a stimuli object that reads it's stimuli from files.
 
         The stimuli are loaded lazy: each stimulus will be opened not
         before it is accessed. At creation time, all files are opened
         to read their dimensions, however the actual image data won't
-        be read.
+        be read. Opening the files happens in parallel threads and
+        can be avoided with a shape manifest or with `lazy_shapes`.
 
         .. note ::
 
@@ -1071,20 +1263,29 @@ class FileStimuli(Stimuli):
             filenames of the stimuli
         cache : bool, defaults to True
             whether loaded stimuli should be cached. The cache is excluded from pickling.
+        max_cache_bytes : int, optional
+            if given, only the least recently used stimuli are kept in the cache up
+            to this total size in bytes. Use `stimuli.stimuli.cache_info()` to inspect
+            the cache statistics.
+        lazy_shapes : bool, defaults to False
+            if True, the shape of a stimulus is read only once it is accessed
+            for the first time instead of at creation time.
+        shape_manifest : string, optional
+            JSON file in which image shapes are cached between runs, see `get_image_shapes`.
+        num_workers : int, optional
+            number of threads used for reading the image shapes, see `get_image_shapes`.
         """
         self.filenames = filenames
-        self.stimuli = LazyList(self.load_stimulus, len(self.filenames), cache=cache)
+        self.stimuli = LazyList(self.load_stimulus, len(self.filenames), cache=cache,
+                                max_cache_bytes=max_cache_bytes)
         if shapes is None:
-            self.shapes = []
-            for f in filenames:
-                img = Image.open(f)
-                size = img.size
-                if len(img.mode) > 1:
-                    # PIL uses (width, height), we use (height, width)
-                    self.shapes.append((size[1], size[0], len(img.mode)))
-                else:
-                    self.shapes.append((size[1], size[0]))
-                del img
+            if lazy_shapes:
+                self.shapes = LazyList(lambda n: get_image_shape(self.filenames[n]),
+                                       length=len(self.filenames),
+                                       pickle_cache=True)
+            else:
+                self.shapes = get_image_shapes(filenames, num_workers=num_workers,
+                                               shape_manifest=shape_manifest)
         else:
             self.shapes = shapes
 
@@ -1111,9 +1312,13 @@ class FileStimuli(Stimuli):
 
         if isinstance(index, list):
             filenames = [self.filenames[i] for i in index]
-            shapes = [self.shapes[i] for i in index]
+            if isinstance(self.shapes, LazyList):
+                shapes = LazyList(lambda n: self.shapes[index[n]], length=len(index), pickle_cache=True)
+            else:
+                shapes = [self.shapes[i] for i in index]
             attributes = {key: [value[i] for i in index] for key, value in self.attributes.items()}
-            return type(self)(filenames=filenames, shapes=shapes, attributes=attributes)
+            return type(self)(filenames=filenames, shapes=shapes, attributes=attributes,
+                              cache=self.stimuli.cache, max_cache_bytes=self.stimuli.max_cache_bytes)
         else:
             return self.stimulus_objects[index]
 
@@ -1156,7 +1361,7 @@ class FileStimuli(Stimuli):
 
     @classmethod
     @hdf5_wrapper(mode='r')
-    def read_hdf5(cls, source, cache=True):
+    def read_hdf5(cls, source, cache=True, max_cache_bytes=None):
         """ Read FileStimuli from hdf5 file or hdf5 group """
 
         data_type = decode_string(source.attrs['type'])
@@ -1182,35 +1387,158 @@ class FileStimuli(Stimuli):
 
         __attributes__, attributes = cls._get_attributes_from_hdf5(source, data_version, '2.1')
 
-        stimuli = cls(filenames=filenames, cache=cache, shapes=shapes, attributes=attributes)
+        stimuli = cls(filenames=filenames, cache=cache, shapes=shapes, attributes=attributes,
+                      max_cache_bytes=max_cache_bytes)
 
         return stimuli
 
 
+class PackedStimuli(Stimuli):
+    """
+    Manage a list of stimuli that are packed into a single buffer of a hdf5 file.
+
+    The stimuli are loaded lazy: each stimulus is read from the file not before
+    it is accessed. If the buffer is stored uncompressed, the file is memory mapped
+    and accessing a stimulus doesn't copy any data. Otherwise, only the chunks
+    belonging to the stimulus are read and decompressed.
+
+    `PackedStimuli` are usually created by reading a file written with
+    `Stimuli.to_packed_hdf5` using `read_hdf5`.
+    """
+    def __init__(self, filename, group_name, shapes, offsets, attributes=None,
+                 data_offset=None, dtype=None, cache=True, max_cache_bytes=None):
+        """
+        Parameters
+        ----------
+        filename : string
+            name of the hdf5 file
+        group_name : string
+            name of the hdf5 group containing the packed stimuli
+        shapes : list of tuples
+            shapes of the stimuli
+        offsets : array of ints
+            start offsets of the stimuli in the packed buffer, followed by the total size of the buffer
+        data_offset : int, optional
+            byte offset of the uncompressed and contiguous buffer in the file. If given,
+            the buffer will be memory mapped.
+        dtype : numpy dtype, optional
+            dtype of the buffer, needed for memory mapping
+        cache : bool, defaults to True
+            whether loaded stimuli should be cached. The cache is excluded from pickling.
+        max_cache_bytes : int, optional
+            bound for the size of the stimulus cache, see `FileStimuli`.
+        """
+        self.filename = filename
+        self.group_name = group_name
+        self.offsets = np.asarray(offsets)
+        self.data_offset = data_offset
+        self.dtype = dtype
+        self._hdf5_file = None
+        self._memmap = None
+
+        self.stimuli = LazyList(self.load_stimulus, len(shapes), cache=cache, max_cache_bytes=max_cache_bytes)
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.stimulus_ids = LazyList(lambda n: get_image_hash(self.stimuli[n]),
+                                     length=len(self.stimuli),
+                                     pickle_cache=True)
+        self.stimulus_objects = [StimuliStimulus(self, n) for n in range(len(self.stimuli))]
+        self.sizes = LazyList(lambda n: (self.shapes[n][0], self.shapes[n][1]),
+                              length = len(self.stimuli))
+
+        if attributes is not None:
+            assert isinstance(attributes, dict)
+            self.attributes = attributes
+            self.__attributes__ = list(attributes.keys())
+        else:
+            self.attributes = {}
+
+    def _get_data(self):
+        if self.data_offset is not None:
+            if self._memmap is None:
+                self._memmap = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                                         offset=self.data_offset, shape=(int(self.offsets[-1]), ))
+            return self._memmap
+
+        if self._hdf5_file is None:
+            import h5py
+            self._hdf5_file = h5py.File(self.filename, 'r')
+        return self._hdf5_file[self.group_name]['data']
+
+    def load_stimulus(self, n):
+        data = self._get_data()[self.offsets[n]:self.offsets[n + 1]]
+        return np.asarray(data).reshape(self.shapes[n])
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_hdf5_file'] = None
+        state['_memmap'] = None
+        return state
+
+    def to_hdf5(self, target, **kwargs):
+        """ Write stimuli to hdf5 file or hdf5 group, see `Stimuli.to_packed_hdf5` """
+        return self.to_packed_hdf5(target, **kwargs)
+
+    @classmethod
+    @hdf5_wrapper(mode='r')
+    def read_hdf5(cls, source, cache=True, max_cache_bytes=None):
+        """ Read PackedStimuli from hdf5 file or hdf5 group """
+
+        data_type = decode_string(source.attrs['type'])
+        data_version = decode_string(source.attrs['version'])
+
+        if data_type != 'PackedStimuli':
+            raise ValueError("Invalid type! Expected 'PackedStimuli', got", data_type)
+
+        if data_version != '1.0':
+            raise ValueError("Invalid version! Expected '1.0', got", data_version)
+
+        data = source['data']
+        if data.compression is None and data.chunks is None:
+            data_offset = data.id.get_offset()
+        else:
+            data_offset = None
+
+        shapes = [tuple(shape) for shape in source['shapes'][...]]
+        offsets = source['offsets'][...]
+
+        __attributes__, attributes = cls._get_attributes_from_hdf5(source, data_version, '1.0')
+
+        return cls(
+            filename=os.path.abspath(source.file.filename),
+            group_name=source.name,
+            shapes=shapes,
+            offsets=offsets,
+            attributes=attributes,
+            data_offset=data_offset,
+            dtype=data.dtype,
+            cache=cache,
+            max_cache_bytes=max_cache_bytes,
+        )
+
+
 def create_subset(stimuli, fixations, stimuli_indices):
     """Create subset of stimuli and fixations using only stimuli
     with given indices.
     """
     new_stimuli = stimuli[stimuli_indices]
+
+    # lookup table mapping old stimulus indices to new ones, the first occurence wins
+    stimuli_indices = np.asarray(stimuli_indices, dtype=int)
+    table_size = max(len(stimuli), stimuli_indices.max() + 1 if len(stimuli_indices) else 0, fixations.n.max() + 1 if len(fixations.n) else 0)
+    new_pos = np.full(table_size, -1, dtype=int)
+    new_pos[stimuli_indices[::-1]] = np.arange(len(stimuli_indices))[::-1]
+
     if isinstance(fixations, FixationTrains):
-        fix_inds = np.in1d(fixations.train_ns, stimuli_indices)
+        fix_inds = new_pos[fixations.train_ns] >= 0
         new_fixations = fixations.filter_fixation_trains(fix_inds)
 
-        index_list = list(stimuli_indices)
-        new_pos = {i: index_list.index(i) for i in index_list}
-
-        new_fixation_train_ns = [new_pos[i] for i in new_fixations.train_ns]
-        new_fixations.train_ns = np.array(new_fixation_train_ns)
-        new_fixation_ns = [new_pos[i] for i in new_fixations.n]
-        new_fixations.n = np.array(new_fixation_ns)
+        new_fixations.train_ns = new_pos[new_fixations.train_ns]
+        new_fixations.n = new_pos[new_fixations.n]
     else:
-        fix_inds = np.in1d(fixations.n, stimuli_indices)
+        fix_inds = new_pos[fixations.n] >= 0
         new_fixations = fixations[fix_inds]
 
-        index_list = list(stimuli_indices)
-        new_pos = {i: index_list.index(i) for i in index_list}
-        new_fixation_ns = [new_pos[i] for i in new_fixations.n]
-        new_fixations.n = np.array(new_fixation_ns)
+        new_fixations.n = new_pos[new_fixations.n]
 
     return new_stimuli, new_fixations
 
@@ -20,10 +20,13 @@ def test_split(stimuli, fixations, crossval_folds, fold_no, val_folds=1, test_fo
 
 
 def crossval_splits(stimuli, fixations, crossval_folds, fold_no, val_folds=1, test_folds=1, random=True, stratified_attributes=None):
+    train_folds, val_folds, test_folds = get_crossval_folds(crossval_folds, fold_no, test_folds=test_folds, val_folds=val_folds)
+    chunks = _get_crossval_chunks(stimuli, crossval_folds, random=random, stratified_attributes=stratified_attributes)
+
     return (
-        crossval_split(stimuli, fixations, crossval_folds, fold_no, val_folds=val_folds, test_folds=test_folds, random=random, split='train', stratified_attributes=stratified_attributes),
-        crossval_split(stimuli, fixations, crossval_folds, fold_no, val_folds=val_folds, test_folds=test_folds, random=random, split='val', stratified_attributes=stratified_attributes),
-        crossval_split(stimuli, fixations, crossval_folds, fold_no, val_folds=val_folds, test_folds=test_folds, random=random, split='test', stratified_attributes=stratified_attributes),
+        _get_crossval_split(stimuli, fixations, crossval_folds, included_splits=train_folds, random=random, stratified_attributes=stratified_attributes, chunks=chunks),
+        _get_crossval_split(stimuli, fixations, crossval_folds, included_splits=val_folds, random=random, stratified_attributes=stratified_attributes, chunks=chunks),
+        _get_crossval_split(stimuli, fixations, crossval_folds, included_splits=test_folds, random=random, stratified_attributes=stratified_attributes, chunks=chunks),
     )
 
 
@@ -42,9 +45,10 @@ def crossval_split(stimuli, fixations, crossval_folds, fold_no, val_folds=1, tes
     return _get_crossval_split(stimuli, fixations, crossval_folds, included_splits=folds, random=random, stratified_attributes=stratified_attributes)
 
 
-def _get_crossval_split(stimuli, fixations, split_count, included_splits, random=True, stratified_attributes=None):
+def _get_crossval_chunks(stimuli, split_count, random=True, stratified_attributes=None):
+    """ returns the stimulus indices of each crossvalidation split """
     if stratified_attributes is not None:
-        return _get_stratified_crossval_split(stimuli, fixations, split_count, included_splits, random=random, stratified_attributes=stratified_attributes)
+        return _get_stratified_crossval_chunks(stimuli, split_count, random=random, stratified_attributes=stratified_attributes)
 
     inds = list(range(len(stimuli)))
     if random:
@@ -53,7 +57,16 @@ def _get_crossval_split(stimuli, fixations, split_count, included_splits, random
         rst.shuffle(inds)
         inds = list(inds)
     size = int(np.ceil(len(inds) / split_count))
-    chunks = chunked(inds, size=size)
+    return chunked(inds, size=size)
+
+
+def _get_crossval_split(stimuli, fixations, split_count, included_splits, random=True, stratified_attributes=None, chunks=None):
+    if chunks is None:
+        chunks = _get_crossval_chunks(stimuli, split_count, random=random, stratified_attributes=stratified_attributes)
+
+    if stratified_attributes is not None:
+        # stratified splits are always concatenated in order of the splits
+        included_splits = [split_nr for split_nr in range(len(chunks)) if split_nr in included_splits]
 
     inds = []
     for split_nr in included_splits:
@@ -63,7 +76,7 @@ def _get_crossval_split(stimuli, fixations, split_count, included_splits, random
     return stimuli, fixations
 
 
-def _get_stratified_crossval_split(stimuli, fixations, split_count, included_splits, random=True, stratified_attributes=None):
+def _get_stratified_crossval_chunks(stimuli, split_count, random=True, stratified_attributes=None):
     from sklearn.model_selection import StratifiedKFold
     labels = []
     for attribute_name in stratified_attributes:
@@ -89,14 +102,8 @@ def _get_stratified_crossval_split(stimuli, fixations, split_count, included_spl
 
     rst = np.random.RandomState(42)
 
-    inds = []
     k_fold = StratifiedKFold(n_splits=split_count, shuffle=random, random_state=rst)
-    for i, (train_index, test_index) in enumerate(k_fold.split(X, labels)):
-        if i in included_splits:
-            inds.extend(test_index)
-
-    stimuli, fixations = create_subset(stimuli, fixations, inds)
-    return stimuli, fixations
+    return [list(test_index) for train_index, test_index in k_fold.split(X, labels)]
 
 
 def create_train_folds(crossval_folds, val_folds, test_folds):
@@ -132,26 +139,30 @@ def iterate_crossvalidation(stimuli, fixations, crossval_folds, val_folds=1, tes
     """iterate over crossvalidation folds. Each fold will yield
           train_stimuli, train_fixations, val_, test_stimuli, test_fixations
     """
+    # the splits are computed only once for all folds
+    chunks = _get_crossval_chunks(stimuli, crossval_folds, random=random, stratified_attributes=stratified_attributes)
+
     kwargs = {
-        'crossval_folds': crossval_folds,
-        'val_folds': val_folds,
-        'test_folds': test_folds,
+        'split_count': crossval_folds,
         'random': random,
         'stratified_attributes': stratified_attributes,
+        'chunks': chunks,
     }
 
     for fold_no in range(crossval_folds):
-        train_stimuli, train_fixations = train_split(
+        train_folds, _val_folds, _test_folds = get_crossval_folds(crossval_folds, fold_no, test_folds=test_folds, val_folds=val_folds)
+
+        train_stimuli, train_fixations = _get_crossval_split(
             stimuli, fixations,
-            fold_no=fold_no,
+            included_splits=train_folds,
             **kwargs)
-        val_stimuli, val_fixations = validation_split(
+        val_stimuli, val_fixations = _get_crossval_split(
             stimuli, fixations,
-            fold_no=fold_no,
+            included_splits=_val_folds,
             **kwargs)
-        test_stimuli, test_fixations = test_split(
+        test_stimuli, test_fixations = _get_crossval_split(
             stimuli, fixations,
-            fold_no=fold_no,
+            included_splits=_test_folds,
             **kwargs)
 
         yield train_stimuli, train_fixations, val_stimuli, val_fixations, test_stimuli, test_fixations
@@ -6,12 +6,17 @@ from torch.optim.optimizer import required
 import torch.nn as nn
 from tqdm import tqdm
 
-from .models import sample_from_logdensity
+from .models import CDFSampler, LogCDFSampler
 from .torch_utils import gaussian_filter
 
 
 def sample_batch_fixations(log_density, fixations_per_image, batch_size, rst=None):
-    xs, ys = sample_from_logdensity(log_density, fixations_per_image * batch_size, rst=rst)
+    """ `log_density` can also be a sampler (e.g. `LogCDFSampler`) to avoid setting it up for each batch """
+    if isinstance(log_density, CDFSampler):
+        sampler = log_density
+    else:
+        sampler = LogCDFSampler(log_density)
+    xs, ys = sampler.sample(fixations_per_image * batch_size, rst=rst)
     ns = np.repeat(np.arange(batch_size, dtype=int), repeats=fixations_per_image)
 
     return xs, ys, ns
@@ -129,11 +134,12 @@ def _eval_metric(log_density, test_samples, fn, seed=42, fixation_count=120, bat
     count = 0
 
     rst = np.random.RandomState(seed=seed)
+    sampler = LogCDFSampler(log_density)
 
     with tqdm(total=test_samples, leave=False, disable=not verbose) as t:
         while count < test_samples:
             this_count = min(batch_size, test_samples - count)
-            xs, ys, ns = sample_batch_fixations(log_density, fixations_per_image=fixation_count, batch_size=this_count, rst=rst)
+            xs, ys, ns = sample_batch_fixations(sampler, fixations_per_image=fixation_count, batch_size=this_count, rst=rst)
 
             values.append(fn(ns, ys, xs, this_count))
             weights.append(this_count)
@@ -246,6 +252,7 @@ def maximize_expected_sim(log_density, kernel_size,
     val_scores = [val_loss()]
     learning_rate_relevant_scores = list(val_scores)
     train_rst = np.random.RandomState(seed=train_seed)
+    train_sampler = LogCDFSampler(log_density)
 
     with tqdm(disable=not verbose) as outer_t:
 
@@ -277,7 +284,7 @@ def maximize_expected_sim(log_density, kernel_size,
                     optimizer.zero_grad()
                     this_count = min(batch_size, train_samples_per_epoch - count)
 
-                    xs, ys, ns = sample_batch_fixations(log_density, fixations_per_image=fixation_count, batch_size=this_count, rst=train_rst)
+                    xs, ys, ns = sample_batch_fixations(train_sampler, fixations_per_image=fixation_count, batch_size=this_count, rst=train_rst)
 
                     Ns = torch.tensor(ns).to(device)
                     Ys = torch.tensor(ys).to(device)
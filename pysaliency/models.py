@@ -5,9 +5,9 @@ from abc import ABCMeta, abstractmethod
 from itertools import combinations
 
 from boltons.cacheutils import LRU
+from boltons.iterutils import chunked
 import numpy as np
 from scipy.ndimage import zoom
-from scipy.special import logsumexp
 from tqdm import tqdm
 
 from .generics import progressinfo
@@ -17,78 +17,141 @@ from .saliency_map_models import (SaliencyMapModel, handle_stimulus,
                                   DisjointUnionMixin,
                                   GaussianSaliencyMapModel,
                                   )
-from .datasets import FixationTrains, get_image_hash, as_stimulus
+from .datasets import FixationTrains, Stimuli, get_image_hash, as_stimulus
 from .metrics import probabilistic_image_based_kl_divergence, convert_saliency_map_to_density
 from .sampling_models import SamplingModelMixin
-from .utils import Cache, average_values, deprecated_class, remove_trailing_nans
+from .numba_utils import build_alias_table
+from .utils import (Cache, SizeBoundedLRU, average_values, deprecated_class, remove_trailing_nans, LogSumExpAccumulator,
+                    resize_log_density, cached_resize)
 
 
-def sample_from_logprobabilities(log_probabilities, size=1, rst=None):
-    """ Sample from log probabilities (robust to many bins and small probabilities).
+class CDFSampler(object):
+    """ Samples pixels from a (normalized) density using its cumulative distribution.
 
-        +-np.inf and np.nan will be interpreted as zero probability
+    Setting up the sampler takes O(P) for P pixels, drawing a sample O(log P).
     """
-    if rst is None:
-        rst = np.random
-    log_probabilities = np.asarray(log_probabilities)
+    def __init__(self, densities):
+        self.shape = densities.shape
+        self.cumsums = np.cumsum(densities.flatten(order='C'))
+
+    @property
+    def nbytes(self):
+        return self.cumsums.nbytes
+
+    def _sample_indices(self, count, rst):
+        tmps = rst.rand(count)
+        js = np.searchsorted(self.cumsums, tmps)
+        # rounding errors might let the cumulative sum end slightly below 1
+        return np.minimum(js, len(self.cumsums) - 1)
+
+    def sample_indices(self, count=1, rst=None):
+        """ sample flat pixel indices """
+        if rst is None:
+            rst = np.random
+        return self._sample_indices(count, rst)
+
+    def sample(self, count=None, rst=None):
+        """ sample pixel positions. Returns x, y for `count=None`, otherwise arrays of xs and ys """
+        indices = self.sample_indices(1 if count is None else count, rst=rst)
+        width = self.shape[-1]
+        sample_xs = indices % width
+        sample_ys = indices // width
+        if count is None:
+            return sample_xs[0], sample_ys[0]
+        return sample_xs, sample_ys
+
+
+class LogCDFSampler(CDFSampler):
+    """ Samples from log probabilities (robust to many bins and small probabilities).
+
+    +-np.inf and np.nan will be interpreted as zero probability
+    """
+    def __init__(self, log_probabilities):
+        log_probabilities = np.asarray(log_probabilities)
+        self.shape = log_probabilities.shape
+        flat_log_probabilities = log_probabilities.flatten(order='C')
 
-    valid_indices = np.nonzero(np.isfinite(log_probabilities))[0]
-    valid_log_probabilities = log_probabilities[valid_indices]
+        valid_indices = np.nonzero(np.isfinite(flat_log_probabilities))[0]
+        valid_log_probabilities = flat_log_probabilities[valid_indices]
 
-    ndxs = valid_log_probabilities.argsort()
-    sorted_log_probabilities = valid_log_probabilities[ndxs]
-    cumsums = np.logaddexp.accumulate(sorted_log_probabilities)
-    cumsums -= cumsums[-1]
+        ndxs = valid_log_probabilities.argsort()
+        sorted_log_probabilities = valid_log_probabilities[ndxs]
+        cumsums = np.logaddexp.accumulate(sorted_log_probabilities)
+        cumsums -= cumsums[-1]
 
-    tmps = -rst.exponential(size=size)
-    js = np.searchsorted(cumsums, tmps)
-    valid_values = ndxs[js]
-    values = valid_indices[valid_values]
+        self.cumsums = cumsums
+        self.indices = valid_indices[ndxs]
 
-    return values
+    @property
+    def nbytes(self):
+        return self.cumsums.nbytes + self.indices.nbytes
 
+    def _sample_indices(self, count, rst):
+        tmps = -rst.exponential(size=count)
+        js = np.searchsorted(self.cumsums, tmps)
+        return self.indices[js]
 
-def sample_from_logdensity(log_density, count=None, rst=None):
-    if count is None:
-        real_count = 1
-    else:
-        real_count = count
 
-    height, width = log_density.shape
-    flat_log_density = log_density.flatten(order='C')
-    samples = sample_from_logprobabilities(flat_log_density, size=real_count, rst=rst)
-    sample_xs = samples % width
-    sample_ys = samples // width
+class AliasSampler(CDFSampler):
+    """ Samples pixels from a density with Walker's alias method.
 
-    if count is None:
-        return sample_xs[0], sample_ys[0]
-    else:
-        return np.asarray(sample_xs), np.asarray(sample_ys)
+    Setting up the sampler takes O(P) for P pixels, drawing a sample O(1).
+    The density does not need to be normalized.
+    """
+    def __init__(self, densities):
+        densities = np.asarray(densities, dtype=float)
+        self.shape = densities.shape
+        probabilities = densities.flatten(order='C')
+        probabilities = probabilities / probabilities.sum()
+
+        self.thresholds = np.empty(len(probabilities))
+        self.aliases = np.empty(len(probabilities), dtype=np.int64)
+        build_alias_table(probabilities, self.thresholds, self.aliases)
+
+    @property
+    def nbytes(self):
+        return self.thresholds.nbytes + self.aliases.nbytes
+
+    def _sample_indices(self, count, rst):
+        bins = rst.randint(len(self.thresholds), size=count)
+        tmps = rst.rand(count)
+        return np.where(tmps < self.thresholds[bins], bins, self.aliases[bins])
+
+
+def sample_from_logprobabilities(log_probabilities, size=1, rst=None):
+    """ Sample from log probabilities (robust to many bins and small probabilities).
+
+        +-np.inf and np.nan will be interpreted as zero probability
+
+        To sample repeatedly from the same log probabilities, use `LogCDFSampler`.
+    """
+    log_probabilities = np.asarray(log_probabilities)
+    return LogCDFSampler(log_probabilities.flatten()).sample_indices(size, rst=rst)
+
+
+def sample_from_logdensity(log_density, count=None, rst=None):
+    return LogCDFSampler(log_density).sample(count, rst=rst)
 
 
 def sample_from_image(densities, count=None, rst=None):
+    return CDFSampler(densities).sample(count, rst=rst)
+
+
+def sample_from_images(densities, rst=None):
+    """ Sample one position from each of a batch of (not necessarily normalized) densities
+    of shape (batch_size, height, width). Returns arrays of x and y coordinates.
+    """
     if rst is None:
         rst = np.random
-    height, width = densities.shape
-    sorted_densities = densities.flatten(order='C')
-    cumsums = np.cumsum(sorted_densities)
-    if count is None:
-        real_count = 1
-    else:
-        real_count = count
-    sample_xs = []
-    sample_ys = []
-    tmps = rst.rand(real_count)
-    js = np.searchsorted(cumsums, tmps)
-    for j in js:
-        sample_xs.append(j % width)
-        sample_ys.append(j // width)
-    sample_xs = np.asarray(sample_xs)
-    sample_ys = np.asarray(sample_ys)
-    if count is None:
-        return sample_xs[0], sample_ys[0]
-    else:
-        return np.asarray(sample_xs), np.asarray(sample_ys)
+    batch_size, height, width = densities.shape
+    cumsums = np.cumsum(densities.reshape(batch_size, -1), axis=1)
+    cumsums /= cumsums[:, -1:]
+    # shift each row by its index such that one searchsorted call handles all rows
+    cumsums += np.arange(batch_size)[:, np.newaxis]
+    tmps = rst.rand(batch_size) + np.arange(batch_size)
+    js = np.searchsorted(cumsums.flatten(), tmps)
+    js = np.clip(js - np.arange(batch_size) * height * width, 0, height * width - 1)
+    return js % width, js // width
 
 
 class ScanpathModel(SamplingModelMixin, object, metaclass=ABCMeta):
@@ -102,6 +165,21 @@ class ScanpathModel(SamplingModelMixin, object, metaclass=ABCMeta):
     def conditional_log_density(self, stimulus, x_hist, y_hist, t_hist, attributes=None, out=None):
         raise NotImplementedError()
 
+    def conditional_log_densities_batch(self, stimulus, x_hists, y_hists, t_hists, attributes=None):
+        """ Conditional log densities for many histories on the same stimulus.
+
+        `x_hists`, `y_hists` and `t_hists` are lists with one history per scanpath, `attributes`
+        is `None` or a list of attribute dicts. Returns an array of shape (len(x_hists), height, width).
+        Models that can process many histories at once should overwrite this method,
+        the default implementation calls `conditional_log_density` for each history.
+        """
+        if attributes is None:
+            attributes = [None] * len(x_hists)
+        return np.array([
+            self.conditional_log_density(stimulus, x_hist, y_hist, t_hist, attributes=_attributes)
+            for x_hist, y_hist, t_hist, _attributes in zip(x_hists, y_hists, t_hists, attributes)
+        ])
+
     def conditional_log_density_for_fixation(self, stimuli, fixations, fixation_index, out=None):
         return self.conditional_log_density(
             stimuli.stimulus_objects[fixations.n[fixation_index]],
@@ -179,7 +257,7 @@ class ScanpathModel(SamplingModelMixin, object, metaclass=ABCMeta):
 
         return stimuli, train_counts, lengths, stimulus_indices
 
-    def sample(self, stimuli, train_counts, lengths=1, stimulus_indices=None, rst=None, verbose=False):
+    def sample(self, stimuli, train_counts, lengths=1, stimulus_indices=None, rst=None, verbose=False, batched=False):
         """
         Sample fixations for given stimuli
 
@@ -204,6 +282,12 @@ class ScanpathModel(SamplingModelMixin, object, metaclass=ABCMeta):
 
         >>> # Sample 3 fixations from the 20th and the 42th stimuli each
         >>> model.sample(stimuli, 3, stimulus_indices = [20, 42])
+
+        With `batched=True`, the fixation trains of each stimulus are sampled in lockstep with
+        `sample_scanpaths` (unless the model implements its own sampling). This is faster, but
+        uses the random state in a different order: first for the first fixation of all trains,
+        then for the second fixation of all trains and so on. By default, the trains are sampled
+        one by one as in previous versions, which gives the same samples for the same random state.
         """
 
         stimuli, train_counts, lengths, stimulus_indices = self._expand_sample_arguments(stimuli,
@@ -218,8 +302,22 @@ class ScanpathModel(SamplingModelMixin, object, metaclass=ABCMeta):
         subjects = []
         total_count = sum(len(l) for l in lengths)
         pbar = tqdm(total=total_count, disable=not verbose)
+        batched_sampling = (batched and self._uses_default_sampling()
+                            and type(self)._sample_fixation_train is ScanpathModel._sample_fixation_train)
         for stimulus_index, ls in zip(stimulus_indices, lengths):
             stimulus = stimuli[stimulus_index]
+            if batched_sampling:
+                # advance all trains of this stimulus in lockstep
+                empty_hists = [[] for l in ls]
+                this_xs, this_ys, this_ts = self.sample_scanpaths(stimulus, empty_hists, empty_hists, empty_hists, ls, rst=rst)
+                xs.extend(this_xs)
+                ys.extend(this_ys)
+                ts.extend(this_ts)
+                ns.extend([stimulus_index] * len(ls))
+                subjects.extend([0] * len(ls))
+                pbar.update(len(ls))
+                continue
+
             for l in ls:
                 this_xs, this_ys, this_ts = self._sample_fixation_train(stimulus, l, rst=rst)
                 xs.append(this_xs)
@@ -230,6 +328,68 @@ class ScanpathModel(SamplingModelMixin, object, metaclass=ABCMeta):
                 pbar.update(1)
         return FixationTrains.from_fixation_trains(xs, ys, ts, ns, subjects)
 
+    def _uses_default_sampling(self):
+        """ whether sampling is based on `conditional_log_density` """
+        return (type(self).sample_fixation is ScanpathModel.sample_fixation
+                and type(self).sample_scanpath is SamplingModelMixin.sample_scanpath)
+
+    def sample_scanpaths(self, stimulus, x_hists, y_hists, t_hists, samples, attributes=None, batch_size=64, verbose=False, rst=None):
+        """ Continue many scanpaths on the same stimulus.
+
+        All scanpaths are advanced in lockstep: in each step, the conditional densities
+        of up to `batch_size` scanpaths are computed with `conditional_log_densities_batch`
+        and one fixation is sampled for each of them.
+
+        Parameters
+        ----------
+        x_hists, y_hists, t_hists : lists of histories, one for each scanpath
+        samples : int or list of ints
+            number of fixations to sample for each scanpath
+        attributes : list of dicts, optional
+            attributes for each scanpath
+
+        Returns
+        -------
+        xs, ys, ts : lists of lists with histories and sampled fixations for each scanpath
+        """
+        scanpath_count = len(x_hists)
+        if isinstance(samples, int):
+            samples = [samples] * scanpath_count
+        if attributes is None:
+            attributes = [None] * scanpath_count
+
+        if not self._uses_default_sampling():
+            results = [self.sample_scanpath(stimulus, x_hist, y_hist, t_hist, _samples, attributes=_attributes, verbose=verbose, rst=rst)
+                       for x_hist, y_hist, t_hist, _samples, _attributes in zip(x_hists, y_hists, t_hists, samples, attributes)]
+            return [list(r[0]) for r in results], [list(r[1]) for r in results], [list(r[2]) for r in results]
+
+        xs = [list(remove_trailing_nans(x_hist)) for x_hist in x_hists]
+        ys = [list(remove_trailing_nans(y_hist)) for y_hist in y_hists]
+        ts = [list(remove_trailing_nans(t_hist)) for t_hist in t_hists]
+        for x_hist, y_hist, t_hist in zip(xs, ys, ts):
+            if not len(x_hist) == len(y_hist) == len(t_hist):
+                raise ValueError("Histories for x, y and t have to be the same length")
+
+        samples = np.asarray(samples, dtype=int)
+        for step in tqdm(range(samples.max() if scanpath_count else 0), disable=not verbose):
+            active_scanpaths = np.nonzero(samples > step)[0].tolist()
+            for batch in chunked(active_scanpaths, batch_size):
+                log_densities = self.conditional_log_densities_batch(
+                    stimulus,
+                    [xs[i] for i in batch],
+                    [ys[i] for i in batch],
+                    [ts[i] for i in batch],
+                    attributes=[attributes[i] for i in batch],
+                )
+                sample_xs, sample_ys = sample_from_images(np.exp(log_densities), rst=rst)
+                for i, x, y in zip(batch, sample_xs, sample_ys):
+                    # same time convention as `sample_fixation`
+                    ts[i].append(len(ts[i]))
+                    xs[i].append(x)
+                    ys[i].append(y)
+
+        return xs, ys, ts
+
     def _sample_fixation_train(self, stimulus, length, rst=None):
         """Sample one fixation train of given length from stimulus"""
         return self.sample_scanpath(stimulus, [], [], [], length, rst=rst)
@@ -246,8 +406,12 @@ class Model(ScanpathModel):
 
     Inheriting classes have to implement `_log_density`.
     """
+    # maximal memory used for caching samplers (see `sampler`)
+    sampler_cache_bytes = 256 * 2**20
+
     def __init__(self, cache_location=None, caching=True, memory_cache_size=None):
         super(Model, self).__init__()
+        self._sampler_cache = SizeBoundedLRU(self.sampler_cache_bytes)
         self._cache = Cache(cache_location, memory_cache_size=memory_cache_size)
         self.caching = caching
         #self._log_density_cache = Cache(cache_location)
@@ -262,9 +426,46 @@ class Model(ScanpathModel):
     def cache_location(self, value):
         self._cache.cache_location = value
 
+    def __setattr__(self, name, value):
+        super(Model, self).__setattr__(name, value)
+        if name == '_cache':
+            self._watch_cache()
+
+    def _watch_cache(self):
+        # samplers are derived from the log densities and have to be dropped with them
+        if isinstance(self._cache, Cache):
+            self._cache.on_change = self._invalidate_samplers
+        if '_sampler_cache' in self.__dict__:
+            self._sampler_cache.clear()
+
+    def _invalidate_samplers(self, stimulus_id):
+        """ drop the samplers of a stimulus, or of all stimuli if `stimulus_id` is None """
+        if stimulus_id is None:
+            self._sampler_cache.clear()
+            return
+        for key in [key for key in self._sampler_cache if key[0] == stimulus_id]:
+            del self._sampler_cache[key]
+
+    def __getstate__(self):
+        # samplers are derived from the log densities and not pickled
+        state = dict(self.__dict__)
+        state.pop('_sampler_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = dict(state)
+        self._sampler_cache = SizeBoundedLRU(self.sampler_cache_bytes)
+        self._watch_cache()
+
     def conditional_log_density(self, stimulus, x_hist, y_hist, t_hist, attributes=None, out=None):
         return self.log_density(stimulus)
 
+    def conditional_log_densities_batch(self, stimulus, x_hists, y_hists, t_hists, attributes=None):
+        """ The log density does not depend on the history: returns a read-only view
+        broadcasting the log density to all histories. """
+        log_density = self.log_density(stimulus)
+        return np.broadcast_to(log_density, (len(x_hists), ) + log_density.shape)
+
     def log_density(self, stimulus):
         """
         Get log_density for given stimulus.
@@ -280,6 +481,52 @@ class Model(ScanpathModel):
             self._cache[stimulus_id] = self._log_density(stimulus.stimulus_data)
         return self._cache[stimulus_id]
 
+    def log_densities(self, stimuli, verbose=False, **kwargs):
+        """
+        Get log_densities for a list of stimuli or a `Stimuli` object.
+
+        Stimuli that are not yet cached are computed with `_log_densities`,
+        which models can overwrite to process several stimuli at once.
+        Additional keyword arguments (e.g. batch sizes) are passed on to
+        `_log_densities`.
+        """
+        if isinstance(stimuli, Stimuli):
+            stimulus_objects = stimuli.stimulus_objects
+        else:
+            stimulus_objects = [handle_stimulus(stimulus) for stimulus in stimuli]
+
+        if not self.caching:
+            return self._log_densities(stimulus_objects, verbose=verbose, **kwargs)
+
+        results = {}
+        missing_stimuli = []
+        for stimulus in stimulus_objects:
+            stimulus_id = stimulus.stimulus_id
+            if stimulus_id in results:
+                continue
+            if stimulus_id in self._cache:
+                results[stimulus_id] = self._cache[stimulus_id]
+            else:
+                # placeholder to compute duplicated stimuli only once
+                results[stimulus_id] = None
+                missing_stimuli.append(stimulus)
+
+        if missing_stimuli:
+            new_log_densities = self._log_densities(missing_stimuli, verbose=verbose, **kwargs)
+            for stimulus, log_density in zip(missing_stimuli, new_log_densities):
+                self._cache[stimulus.stimulus_id] = log_density
+                results[stimulus.stimulus_id] = log_density
+
+        return [results[stimulus.stimulus_id] for stimulus in stimulus_objects]
+
+    def _log_densities(self, stimuli, verbose=False, **kwargs):
+        """
+        Compute log densities for a list of `Stimulus` objects. Overwrite
+        this to compute several stimuli at once. Additional keyword arguments
+        are ignored by this default implementation.
+        """
+        return [self._log_density(stimulus.stimulus_data) for stimulus in tqdm(stimuli, disable=not verbose)]
+
     @abstractmethod
     def _log_density(self, stimulus):
         """
@@ -305,12 +552,94 @@ class Model(ScanpathModel):
 
         return log_likelihoods
 
+    def sampler(self, stimulus, method='cdf'):
+        """
+        Get a sampler for the density of the given stimulus.
+
+        The sampler is set up only once per stimulus and cached (as long as `caching`
+        is enabled), such that sampling repeatedly from the same stimulus is fast.
+        Clearing, replacing or changing entries of `_cache` also drops the affected samplers.
+
+        Parameters
+        ----------
+        method : one of 'cdf', 'logcdf', 'alias'
+            'cdf': `CDFSampler` (O(log P) per sample, same samples as `sample_from_image`),
+            'logcdf': `LogCDFSampler` (robust for very small probabilities),
+            'alias': `AliasSampler` (O(1) per sample)
+        """
+        stimulus = handle_stimulus(stimulus)
+        key = (stimulus.stimulus_id, method)
+        if self.caching and key in self._sampler_cache:
+            return self._sampler_cache[key]
+
+        log_density = self.log_density(stimulus)
+        if method == 'cdf':
+            sampler = CDFSampler(np.exp(log_density))
+        elif method == 'logcdf':
+            sampler = LogCDFSampler(log_density)
+        elif method == 'alias':
+            sampler = AliasSampler(np.exp(log_density))
+        else:
+            raise ValueError(method)
+
+        if self.caching:
+            self._sampler_cache[key] = sampler
+        return sampler
+
+    def sample_fixation(self, stimulus, x_hist, y_hist, t_hist, attributes=None, verbose=False, rst=None):
+        x, y = self.sampler(stimulus).sample(rst=rst)
+        return x, y, len(t_hist)
+
+    def sample(self, stimuli, train_counts, lengths=1, stimulus_indices=None, rst=None, verbose=False, sampling_method='cdf'):
+        """
+        Sample fixations for given stimuli.
+
+        Since the fixations are independent of each other, all fixations of
+        one stimulus are sampled at once. See `ScanpathModel.sample` for the arguments.
+        `sampling_method` chooses the sampler, see `Model.sampler`.
+        """
+        if type(self)._sample_fixation_train is not Model._sample_fixation_train:
+            return super(Model, self).sample(stimuli, train_counts, lengths=lengths,
+                                             stimulus_indices=stimulus_indices, rst=rst, verbose=verbose)
+
+        stimuli, train_counts, lengths, stimulus_indices = self._expand_sample_arguments(stimuli,
+                                                                                         train_counts,
+                                                                                         lengths,
+                                                                                         stimulus_indices)
+
+        train_lengths = np.array([l for ls in lengths for l in ls], dtype=int)
+        train_ns = np.repeat(np.asarray(stimulus_indices, dtype=int), [len(ls) for ls in lengths])
+        max_length = train_lengths.max() if len(train_lengths) else 0
+
+        # fixations are stored train by train in the order of the mask
+        fixation_mask = np.arange(max_length)[np.newaxis, :] < train_lengths[:, np.newaxis]
+        xs = np.empty(train_lengths.sum())
+        ys = np.empty(train_lengths.sum())
+
+        offset = 0
+        for stimulus_index, ls in zip(tqdm(stimulus_indices, disable=not verbose), lengths):
+            count = sum(ls)
+            if not count:
+                continue
+            sampler = self.sampler(stimuli[stimulus_index], method=sampling_method)
+            xs[offset:offset + count], ys[offset:offset + count] = sampler.sample(count=count, rst=rst)
+            offset += count
+
+        train_xs = np.full((len(train_lengths), max_length), np.nan)
+        train_ys = np.full((len(train_lengths), max_length), np.nan)
+        train_ts = np.full((len(train_lengths), max_length), np.nan)
+        train_xs[fixation_mask] = xs
+        train_ys[fixation_mask] = ys
+        train_ts[fixation_mask] = np.broadcast_to(np.arange(max_length), fixation_mask.shape)[fixation_mask]
+        train_subjects = np.zeros(len(train_lengths), dtype=int)
+
+        return FixationTrains(train_xs, train_ys, train_ts, train_ns, train_subjects)
+
     def _sample_fixation_train(self, stimulus, length, rst=None):
         """Sample one fixation train of given length from stimulus"""
         # We could reuse the implementation from `ScanpathModel`
         # but this implementation is much faster for long trains.
-        log_densities = self.log_density(stimulus)
-        xs, ys = sample_from_image(np.exp(log_densities), count=length, rst=rst)
+        xs, ys = self.sampler(stimulus).sample(count=length, rst=rst)
         ts = np.arange(len(xs))
         return xs, ys, ts
 
@@ -404,13 +733,11 @@ class MixtureModel(Model):
         self.check_norm = check_norm
 
     def _log_density(self, stimulus):
-        log_densities = []
+        accumulator = LogSumExpAccumulator()
         for i, model in enumerate(self.models):
-            log_density = model.log_density(stimulus).copy()
-            log_density += np.log(self.weights[i])
-            log_densities.append(log_density)
+            accumulator.add(model.log_density(stimulus), log_weight=np.log(self.weights[i]))
 
-        log_density = logsumexp(log_densities, axis=0)
+        log_density = accumulator.result()
 
         if self.check_norm:
             np.testing.assert_allclose(np.exp(log_density).sum(), 1.0, rtol=1e-7)
@@ -443,13 +770,12 @@ class MixtureScanpathModel(ScanpathModel):
         self.check_norm = check_norm
 
     def conditional_log_density(self, stimulus, x_hist, y_hist, t_hist, attributes=None, out=None):
-        log_densities = []
+        accumulator = LogSumExpAccumulator()
         for i, model in enumerate(self.models):
-            log_density = model.conditional_log_density(stimulus, x_hist, y_hist, t_hist, attributes=attributes).copy()
-            log_density += np.log(self.weights[i])
-            log_densities.append(log_density)
+            log_density = model.conditional_log_density(stimulus, x_hist, y_hist, t_hist, attributes=attributes)
+            accumulator.add(log_density, log_weight=np.log(self.weights[i]))
 
-        log_density = logsumexp(log_densities, axis=0)
+        log_density = accumulator.result()
         if self.check_norm:
             np.testing.assert_allclose(np.exp(log_density).sum(), 1.0, rtol=1e-7)
         if not log_density.shape == (stimulus.shape[0], stimulus.shape[1]):
@@ -458,12 +784,18 @@ class MixtureScanpathModel(ScanpathModel):
 
 
 class ResizingModel(Model):
-    def __init__(self, parent_model, verbose=True, **kwargs):
+    """ Resizes the log densities of `parent_model` to the stimulus size.
+
+    Resized log densities can be kept in `resize_cache`, a mapping such as `SizeBoundedLRU`
+    which can be shared by several models (see `pysaliency.utils.cached_resize`).
+    """
+    def __init__(self, parent_model, verbose=True, resize_cache=None, **kwargs):
         if 'caching' not in kwargs:
             kwargs['caching'] = False
         self.verbose = verbose
         super(ResizingModel, self).__init__(**kwargs)
         self.parent_model = parent_model
+        self.resize_cache = resize_cache
 
     def _log_density(self, stimulus):
         smap = self.parent_model.log_density(stimulus)
@@ -474,12 +806,11 @@ class ResizingModel(Model):
         if smap.shape != target_shape:
             if self.verbose:
                 print("Resizing saliency map", smap.shape, target_shape)
-            x_factor = target_shape[1] / smap.shape[1]
-            y_factor = target_shape[0] / smap.shape[0]
-
-            smap = zoom(smap, [y_factor, x_factor], order=1, mode='nearest')
-
-            smap -= logsumexp(smap)
+            smap = cached_resize(
+                self.resize_cache,
+                lambda: ('log_density', get_image_hash(stimulus), self.parent_model, target_shape),
+                lambda: resize_log_density(smap, target_shape),
+            )
 
             assert smap.shape == target_shape
 
@@ -501,12 +832,7 @@ class ResizingScanpathModel(ScanpathModel):
         if smap.shape != target_shape:
             if self.verbose:
                 print("Resizing saliency map", smap.shape, target_shape)
-            x_factor = target_shape[1] / smap.shape[1]
-            y_factor = target_shape[0] / smap.shape[0]
-
-            smap = zoom(smap, [y_factor, x_factor], order=1, mode='nearest')
-
-            smap -= logsumexp(smap)
+            smap = resize_log_density(smap, target_shape)
 
             assert smap.shape == target_shape
 
@@ -626,6 +952,19 @@ class ShuffledAUCSaliencyMapModel(SaliencyMapModel):
 
 
 def average_predictions(predictions, library):
+    """ Average log predictions in probability space.
+
+    `predictions` can be any iterable of log predictions. With `library='numpy'`
+    the predictions are accumulated one by one and never held in memory at the
+    same time. The other libraries stack all predictions into one array.
+    """
+    if library == 'numpy':
+        accumulator = LogSumExpAccumulator()
+        for prediction in predictions:
+            accumulator.add(prediction)
+        return accumulator.result() - np.log(accumulator.count)
+
+    predictions = list(predictions)
     predictions = np.array(predictions) - np.log(len(predictions))
 
     if library == 'tensorflow':
@@ -635,28 +974,53 @@ def average_predictions(predictions, library):
         import torch
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         prediction = torch.logsumexp(torch.Tensor(predictions).to(device), dim=0).detach().cpu().numpy()
-    elif library == 'numpy':
-        prediction = logsumexp(predictions, axis=0)
     else:
         raise ValueError(library)
 
     return prediction
 
 
+def _resized_parent_prediction(parent_model, stimuli, index, target_shape, resize_cache):
+    """ log density of `parent_model` for `stimuli[index]`, resized to `target_shape` """
+    log_density = parent_model.log_density(stimuli[index])
+    if log_density.shape == tuple(target_shape):
+        return log_density
+
+    return cached_resize(
+        resize_cache,
+        lambda: ('log_density', stimuli.stimulus_ids[index], parent_model, tuple(target_shape)),
+        lambda: resize_log_density(log_density, target_shape),
+    )
+
+
 class ShuffledBaselineModel(Model):
     """Predicts a mixture of all predictions for other images.
 
     This model will usually be used as baseline model for computing sAUC saliency maps.
 
+    The mixture of all predictions is computed only once. The prediction for
+    an image is then derived by removing the image's own component from the
+    full mixture. To avoid cancellation, for each pixel the largest component
+    is tracked separately from the sum of all other components: where the image
+    itself has the largest component, the sum of the other components is used
+    directly.
+
     use the library parameter to define whether the logsumexp should be computed
-    with torch (default), tensorflow or numpy.
+    with torch (default), tensorflow or numpy. This is only used for images that
+    occur multiple times in the stimuli.
+
+    The predictions of the parent model resized to `compute_size` can be kept in
+    `resize_cache`, e.g. a `SizeBoundedLRU` shared by the baseline models of all
+    crossvalidation folds (see `pysaliency.utils.cached_resize`).
     """
     def __init__(self, parent_model, stimuli, resized_predictions_cache_size=5000,
                  compute_size=(500, 500),
                  library='torch',
+                 resize_cache=None,
                  **kwargs):
         super(ShuffledBaselineModel, self).__init__(**kwargs)
         self.parent_model = parent_model
+        self.resize_cache = resize_cache
         self.stimuli = stimuli
         self.compute_size = compute_size
         self.resized_predictions_cache = LRU(
@@ -666,43 +1030,70 @@ class ShuffledBaselineModel(Model):
         if library not in ['torch', 'tensorflow', 'numpy']:
             raise ValueError(library)
         self.library = library
+        self._mixture_components = None
 
     def _resize_prediction(self, prediction, target_shape):
         if prediction.shape != target_shape:
-            x_factor = target_shape[1] / prediction.shape[1]
-            y_factor = target_shape[0] / prediction.shape[0]
-
-            prediction = zoom(prediction, [y_factor, x_factor], order=1, mode='nearest')
-
-            prediction -= logsumexp(prediction)
+            prediction = resize_log_density(prediction, target_shape)
 
             assert prediction.shape == target_shape
 
         return prediction
 
     def _cache_miss(self, key):
-        stimulus = self.stimuli[key]
-        return self._resize_prediction(self.parent_model.log_density(stimulus), self.compute_size)
+        return _resized_parent_prediction(self.parent_model, self.stimuli, key, self.compute_size, self.resize_cache)
+
+    def _get_mixture_components(self):
+        """ Returns for each pixel the largest log prediction, the index of the stimulus
+        it belongs to and the logsumexp of all other predictions.
+        """
+        if self._mixture_components is None:
+            top_values = None
+            for k in range(len(self.stimuli)):
+                prediction = self.resized_predictions_cache[k]
+                if top_values is None:
+                    top_values = np.array(prediction, dtype=float)
+                    top_indices = np.zeros(prediction.shape, dtype=int)
+                    rest = np.full(prediction.shape, -np.inf)
+                    continue
+
+                new_top = prediction > top_values
+                rest = np.logaddexp(rest, np.where(new_top, top_values, prediction))
+                top_values[new_top] = prediction[new_top]
+                top_indices[new_top] = k
+
+            self._mixture_components = top_values, top_indices, rest
+
+        return self._mixture_components
 
     def _log_density(self, stimulus):
         stimulus_id = get_image_hash(stimulus)
+        target_shape = (stimulus.shape[0], stimulus.shape[1])
 
-        predictions = []
-        prediction = None
+        own_indices = [k for k, other_stimulus_id in enumerate(self.stimuli.stimulus_ids) if other_stimulus_id == stimulus_id]
+        other_count = len(self.stimuli) - len(own_indices)
 
-        target_shape = (stimulus.shape[0], stimulus.shape[1])
+        if len(own_indices) > 1:
+            predictions = (self.resized_predictions_cache[k] for k in range(len(self.stimuli)) if k not in own_indices)
+            prediction = average_predictions(predictions, self.library)
+            return self._resize_prediction(prediction, target_shape)
 
-        for k, other_stimulus in enumerate((self.stimuli)):
-            if other_stimulus.stimulus_id == stimulus_id:
-                continue
-            other_prediction = self.resized_predictions_cache[k]
-            predictions.append(other_prediction)
+        top_values, top_indices, rest = self._get_mixture_components()
+        total = np.logaddexp(top_values, rest)
 
-        prediction = average_predictions(predictions, self.library)
+        if own_indices:
+            own_index, = own_indices
+            own_prediction = self.resized_predictions_cache[own_index]
+            with np.errstate(divide='ignore'):
+                prediction = total + np.log1p(-np.exp(own_prediction - total))
+            own_is_top = top_indices == own_index
+            prediction[own_is_top] = rest[own_is_top]
+        else:
+            prediction = total
 
-        prediction = self._resize_prediction(prediction, target_shape)
+        prediction -= np.log(other_count)
 
-        return prediction
+        return self._resize_prediction(prediction, target_shape)
 
 
 class ShuffledSimpleBaselineModel(Model):
@@ -713,12 +1104,18 @@ class ShuffledSimpleBaselineModel(Model):
 
     use the library parameter to define whether the logsumexp should be computed
     with torch (default), tensorflow or numpy.
+
+    The resized predictions of the parent model and the average prediction resized to
+    the stimulus shapes can be kept in `resize_cache`, a mapping such as `SizeBoundedLRU`
+    which can be shared by several models (see `pysaliency.utils.cached_resize`).
     """
     def __init__(self, parent_model, stimuli,
                  compute_size=(500, 500),
                  library='torch',
+                 resize_cache=None,
                  **kwargs):
         super(ShuffledSimpleBaselineModel, self).__init__(**kwargs)
+        self.resize_cache = resize_cache
         self.parent_model = parent_model
         self.stimuli = stimuli
         self.compute_size = compute_size
@@ -731,11 +1128,10 @@ class ShuffledSimpleBaselineModel(Model):
         if self.prediction is not None:
             return self.prediction
 
-        predictions = []
-        for stimulus in tqdm(self.stimuli, disable=not verbose):
-            predictions.append(
-                self._resize_prediction(self.parent_model.log_density(stimulus), self.compute_size)
-            )
+        predictions = (
+            _resized_parent_prediction(self.parent_model, self.stimuli, k, self.compute_size, self.resize_cache)
+            for k in tqdm(range(len(self.stimuli)), disable=not verbose)
+        )
 
         prediction = average_predictions(predictions, self.library)
 
@@ -744,12 +1140,7 @@ class ShuffledSimpleBaselineModel(Model):
 
     def _resize_prediction(self, prediction, target_shape):
         if prediction.shape != target_shape:
-            x_factor = target_shape[1] / prediction.shape[1]
-            y_factor = target_shape[0] / prediction.shape[0]
-
-            prediction = zoom(prediction, [y_factor, x_factor], order=1, mode='nearest')
-
-            prediction -= logsumexp(prediction)
+            prediction = resize_log_density(prediction, target_shape)
 
             assert prediction.shape == target_shape
 
@@ -759,9 +1150,14 @@ class ShuffledSimpleBaselineModel(Model):
         prediction = self.get_average_prediction()
 
         target_shape = (stimulus.shape[0], stimulus.shape[1])
-        prediction = self._resize_prediction(prediction, target_shape)
+        if prediction.shape == target_shape:
+            return prediction
 
-        return prediction
+        return cached_resize(
+            self.resize_cache,
+            lambda: ('log_density', None, self, target_shape),
+            lambda: self._resize_prediction(prediction, target_shape),
+        )
 
 
 class GaussianModel(Model):
@@ -791,13 +1187,17 @@ class SaliencyMapNormalizingModel(Model):
 
 
 class FixedStimulusSizeModel(Model):
-    """ model which scales images to have a fixed size before handing them to anothet model"""
-    def __init__(self, size, parent_model, verbose=False, **kwargs):
+    """ model which scales images to have a fixed size before handing them to anothet model
+
+    Resized log densities can be kept in `resize_cache` (see `ResizingModel`).
+    """
+    def __init__(self, size, parent_model, verbose=False, resize_cache=None, **kwargs):
         super(FixedStimulusSizeModel, self).__init__(**kwargs)
 
         self.size = size
         self.parent_model = parent_model
         self.verbose = verbose
+        self.resize_cache = resize_cache
 
     def _log_density(self, stimulus):
         stimulus = self.ensure_color(stimulus)
@@ -821,8 +1221,12 @@ class FixedStimulusSizeModel(Model):
         if factor_y != 1.0 or factor_x != 1.0:
             if self.verbose:
                 print("Wrong shape, resizing log densities", stimulus.shape, log_density.shape)
-            log_density = zoom(log_density, [factor_y, factor_x], order=1, mode='nearest')
-            log_density -= logsumexp(log_density)
+            target_shape = (stimulus.shape[0], stimulus.shape[1])
+            log_density = cached_resize(
+                self.resize_cache,
+                lambda: ('log_density', get_image_hash(stimulus), self, target_shape),
+                lambda: resize_log_density(log_density, target_shape),
+            )
 
         assert log_density.shape[0] == stimulus.shape[0]
         assert log_density.shape[1] == stimulus.shape[1]
@@ -840,8 +1244,9 @@ class DVAAwareModel(Model):
 
     - dva: expected image resolution in pixel per dva for this model
     - parent_model_dva: image resolution expected by parent_model
+    - resize_cache: mapping in which resized log densities are kept (see `ResizingModel`)
     """
-    def __init__(self, dva, parent_model, parent_model_dva, verbose=False, **kwargs):
+    def __init__(self, dva, parent_model, parent_model_dva, verbose=False, resize_cache=None, **kwargs):
 
         super(DVAAwareModel, self).__init__(**kwargs)
 
@@ -849,6 +1254,7 @@ class DVAAwareModel(Model):
         self.parent_model = parent_model
         self.parent_model_dva = parent_model_dva
         self.verbose = verbose
+        self.resize_cache = resize_cache
 
         self.factor = self.parent_model_dva / self.dva
 
@@ -870,8 +1276,12 @@ class DVAAwareModel(Model):
         if factor_y != 1.0 or factor_x != 1.0:
             if self.verbose:
                 print("Wrong shape, resizing log densities", stimulus.shape, log_density.shape)
-            log_density = zoom(log_density, [factor_y, factor_x], order=1, mode='nearest')
-            log_density -= logsumexp(log_density)
+            target_shape = (stimulus.shape[0], stimulus.shape[1])
+            log_density = cached_resize(
+                self.resize_cache,
+                lambda: ('log_density', get_image_hash(stimulus), self, target_shape),
+                lambda: resize_log_density(log_density, target_shape),
+            )
 
         assert log_density.shape[0] == stimulus.shape[0]
         assert log_density.shape[1] == stimulus.shape[1]
@@ -47,3 +47,49 @@ def _auc_for_one_positive(positive, negatives):
             count += 0.5
 
     return count / len(negatives)
+
+
+@numba.jit(nopython=True)
+def build_alias_table(probabilities, thresholds, aliases):
+    """ Fill the table for Walker's alias method using Vose's algorithm.
+
+    probabilities: 1d array of normalized probabilities. thresholds: float array
+    and aliases: int array of the same length, which will be overwritten.
+    """
+    count = len(probabilities)
+    scaled_probabilities = probabilities * count
+    small = np.empty(count, dtype=np.int64)
+    large = np.empty(count, dtype=np.int64)
+    small_count = 0
+    large_count = 0
+    for i in range(count):
+        aliases[i] = i
+        if scaled_probabilities[i] < 1.0:
+            small[small_count] = i
+            small_count += 1
+        else:
+            large[large_count] = i
+            large_count += 1
+
+    while small_count and large_count:
+        small_count -= 1
+        small_index = small[small_count]
+        large_count -= 1
+        large_index = large[large_count]
+
+        thresholds[small_index] = scaled_probabilities[small_index]
+        aliases[small_index] = large_index
+
+        scaled_probabilities[large_index] += scaled_probabilities[small_index] - 1.0
+        if scaled_probabilities[large_index] < 1.0:
+            small[small_count] = large_index
+            small_count += 1
+        else:
+            large[large_count] = large_index
+            large_count += 1
+
+    # remaining entries are (up to rounding errors) exactly one
+    for i in range(large_count):
+        thresholds[large[i]] = 1.0
+    for i in range(small_count):
+        thresholds[small[i]] = 1.0
@@ -463,14 +463,14 @@ class SaliencyMapConvertor(Model):
         self._centerbias = self.saliency_map_processing.centerbias_ys.get_value()
         self._alpha = self.saliency_map_processing.alpha.get_value()
         self._blur_radius = self.saliency_map_processing.blur_radius.get_value()
-        state = dict(self.__dict__)
+        state = super(SaliencyMapConvertor, self).__getstate__()
         del state['saliency_map_processing']
         del state['theano_input']
         del state['_f_log_density']
         return state
 
     def __setstate__(self, state):
-        self.__dict__ = dict(state)
+        super(SaliencyMapConvertor, self).__setstate__(state)
         self._build()
 
 
@@ -1,13 +1,16 @@
+from boltons.iterutils import chunked
 import numpy as np
 import torch
 import torch.nn as nn
+from scipy.optimize import OptimizeResult
 from tqdm import tqdm
 
+from .datasets import Stimulus, create_subset
 from .models import Model
 from .optpy import minimize
 from .saliency_map_models import SaliencyMapModel
-from .torch_utils import GaussianFilterNd, Nonlinearity, zero_grad, log_likelihood
-from .torch_datasets import ImageDataset, ImageDatasetSampler, FixationMaskTransform
+from .torch_utils import GaussianFilterNd, Nonlinearity, zero_grad, log_likelihood, log_likelihood_from_indices
+from .torch_datasets import ImageDataset, ImageDatasetSampler, FixationIndicesTransform, collate_fixation_indices, MaterializedBatches
 
 
 class CenterBias(nn.Module):
@@ -19,14 +22,19 @@ class CenterBias(nn.Module):
         self.nonlinearity = Nonlinearity(ys=ys)
         self.alpha = nn.Parameter(torch.tensor(0.5 * np.sqrt(2), dtype=torch.float32), requires_grad=True)
 
-    def forward(self, tensor):
+    def forward(self, tensor, valid_shapes=None):
         _, _, height, width = tensor.shape
 
-        x_coords = torch.linspace(-1.0, 1.0, steps=width, device=tensor.device) + 0.000001
-        y_coords = torch.linspace(-1.0, 1.0, steps=height, device=tensor.device) + 0.000001  # We cannot have zeros in there because of grad
+        if valid_shapes is None:
+            x_coords = torch.linspace(-1.0, 1.0, steps=width, device=tensor.device) + 0.000001
+            y_coords = torch.linspace(-1.0, 1.0, steps=height, device=tensor.device) + 0.000001  # We cannot have zeros in there because of grad
 
-        x_coords = x_coords[None, None, None, :]
-        y_coords = y_coords[None, None, :, None]
+            x_coords = x_coords[None, None, None, :]
+            y_coords = y_coords[None, None, :, None]
+        else:
+            # padded batch: coordinates run from -1 to 1 over the valid part of each image
+            x_coords = _padded_coordinates(width, valid_shapes[:, 1], tensor.device)[:, None, None, :]
+            y_coords = _padded_coordinates(height, valid_shapes[:, 0], tensor.device)[:, None, :, None]
 
         beta_squared = 1.0 - self.alpha**2
         dists = torch.sqrt(
@@ -40,8 +48,23 @@ class CenterBias(nn.Module):
         return centerbias
 
 
+def _padded_coordinates(size, valid_sizes, device):
+    valid_sizes = valid_sizes.to(device=device, dtype=torch.float32)
+    steps = 2.0 / torch.clamp(valid_sizes - 1, min=1)
+    return -1.0 + torch.arange(size, device=device, dtype=torch.float32)[None, :] * steps[:, None] + 0.000001
+
+
+def _valid_mask(tensor, valid_shapes):
+    _, _, height, width = tensor.shape
+    valid_shapes = valid_shapes.to(tensor.device)
+    rows = torch.arange(height, device=tensor.device)[None, :] < valid_shapes[:, 0:1]
+    columns = torch.arange(width, device=tensor.device)[None, :] < valid_shapes[:, 1:2]
+    return (rows[:, :, None] & columns[:, None, :])[:, None, :, :]
+
+
 class SaliencyMapProcessing(nn.Module):
-    def __init__(self, num_nonlinearity=20, num_centerbias=12, blur_radius=1.0, nonlinearity_target='density', nonlinearity_values='density'):
+    def __init__(self, num_nonlinearity=20, num_centerbias=12, blur_radius=1.0, nonlinearity_target='density', nonlinearity_values='density',
+                 blur_method='auto'):
         super().__init__()
 
         if nonlinearity_target not in ['density', 'logdensity']:
@@ -50,7 +73,7 @@ class SaliencyMapProcessing(nn.Module):
         if nonlinearity_values not in ['density', 'logdensity']:
             raise ValueError("nonlinearity values '{}' not allowed".format(nonlinearity_values))
 
-        self.blur = GaussianFilterNd(dims=(2, 3), sigma=blur_radius, trainable=True)
+        self.blur = GaussianFilterNd(dims=(2, 3), sigma=blur_radius, trainable=True, method=blur_method)
 
         self.nonlinearity_target = nonlinearity_target
 
@@ -65,28 +88,56 @@ class SaliencyMapProcessing(nn.Module):
 
         self.centerbias = CenterBias(num_values=num_centerbias)
 
-    def forward(self, tensor):
+    def forward(self, tensor, valid_shapes=None, centerbias=None):
+        """Computes log densities from saliency maps of shape (batch_size, 1, height, width).
+
+        For padded batches, `valid_shapes` of shape (batch_size, 2) contains the unpadded
+        height and width of each saliency map. The saliency maps have to be padded by
+        repeating the last row and column (as done by `torch_datasets.collate_fixation_indices`),
+        then the blur of the valid part is the same as for the unpadded saliency map.
+        The padded part of the resulting log densities is `-inf`.
+
+        A precomputed `centerbias` (from `self.centerbias`) can be passed
+        to avoid recomputing it for saliency maps of the same shape.
+        """
+        if valid_shapes is not None:
+            _, _, height, width = tensor.shape
+            if bool(torch.all(valid_shapes[:, 0] == height)) and bool(torch.all(valid_shapes[:, 1] == width)):
+                valid_shapes = None
+
         tensor = self.blur(tensor)
         tensor = self.nonlinearity(tensor)
 
-        centerbias = self.centerbias(tensor)
+        if centerbias is None:
+            centerbias = self.centerbias(tensor, valid_shapes=valid_shapes)
         if self.nonlinearity_target == 'density':
             tensor *= centerbias
-        elif self.nonlineary_target == 'logdensity':
+        elif self.nonlinearity_target == 'logdensity':
             tensor += centerbias
         else:
             raise ValueError(self.nonlinearity_target)
 
+        if valid_shapes is not None:
+            mask = _valid_mask(tensor, valid_shapes)
+
         if self.nonlinearity_target == 'density':
-            sums = torch.sum(tensor, dim=(2, 3), keepdim=True)
+            if valid_shapes is None:
+                sums = torch.sum(tensor, dim=(2, 3), keepdim=True)
+            else:
+                sums = torch.sum(tensor * mask, dim=(2, 3), keepdim=True)
             tensor = tensor / sums
             tensor = torch.log(tensor)
-        elif self.nonlineary_target == 'logdensity':
+        elif self.nonlinearity_target == 'logdensity':
+            if valid_shapes is not None:
+                tensor = tensor.masked_fill(~mask, -np.inf)
             logsums = torch.logsumexp(tensor, dim=(2, 3), keepdim=True)
             tensor = tensor - logsums
         else:
             raise ValueError(self.nonlinearity_target)
 
+        if valid_shapes is not None:
+            tensor = tensor.masked_fill(~mask, -np.inf)
+
         return tensor
 
 
@@ -114,6 +165,37 @@ class NormalizedSaliencyMapModel(SaliencyMapModel):
         return np.minimum(1, np.maximum(0, normalized_saliency_map))
 
 
+def _batch_loss(model, batch, device):
+    """ negative log likelihood of a batch averaged over all saliency maps, and the batch weights """
+    if 'fixation_indices' in batch:
+        fixation_indices = batch['fixation_indices'].to(device, non_blocking=True)
+        fixation_counts = batch['fixation_counts'].to(device, non_blocking=True)
+    else:
+        fixation_mask = batch['fixation_mask'].to(device)
+    weights = batch['weight'].to(device, non_blocking=True)
+    valid_shapes = batch.get('valid_shape')
+    if valid_shapes is not None:
+        valid_shapes = valid_shapes.to(device, non_blocking=True)
+
+    saliency_maps = []
+    while 'prediction_{:04d}'.format(len(saliency_maps)) in batch:
+        saliency_maps.append(batch['prediction_{:04d}'.format(len(saliency_maps))].to(device, non_blocking=True))
+
+    this_loss = 0
+    for saliency_map in saliency_maps:
+        log_density = model(saliency_map[:, None, :, :], valid_shapes=valid_shapes)[:, 0, :, :]
+
+        if 'fixation_indices' in batch:
+            loss = -log_likelihood_from_indices(
+                log_density, fixation_indices, fixation_counts, weights=weights, valid_shapes=valid_shapes
+            )
+        else:
+            loss = -log_likelihood(log_density, fixation_mask, weights=weights)
+        this_loss += loss / len(saliency_maps)
+
+    return this_loss, weights
+
+
 def run_dataset(model, dataset, device, verbose=True):
     """ processes dataset and accumulate gradients """
     model.train()
@@ -122,22 +204,9 @@ def run_dataset(model, dataset, device, verbose=True):
 
     pbar = tqdm(dataset, disable=not verbose)
     for batch in pbar:
+        loss, weights = _batch_loss(model, batch, device)
 
-        fixation_mask = batch['fixation_mask'].to(device)
-        weights = batch['weight'].to(device)
-
-        saliency_maps = []
-        while 'prediction_{:04d}'.format(len(saliency_maps)) in batch:
-            saliency_maps.append(batch['prediction_{:04d}'.format(len(saliency_maps))].to(device))
-
-        this_loss = 0
-        for saliency_map in saliency_maps:
-            log_density = model(saliency_map[:, None, :, :])[:, 0, :, :]
-
-            loss = -log_likelihood(log_density, fixation_mask, weights=weights)
-            this_loss += loss / len(saliency_maps)
-
-        losses.append(this_loss.detach().cpu().numpy())
+        losses.append(loss.detach().cpu().numpy())
 
         batch_weights.append(weights.detach().cpu().numpy().sum())
 
@@ -172,6 +241,14 @@ def optimize_saliency_map_conversion(
         tol=None,
         maxiter=1000,
         minimize_options=None,
+        num_workers=0,
+        pin_memory=None,
+        bucket_granularity=None,
+        materialize_batches=False,
+        storage_dtype=None,
+        learning_rate=1e-2,
+        validation_ratio=0.1,
+        patience=5,
         return_optimization_result=False):
 
     targets = [([model], stimuli, fixations)]
@@ -205,7 +282,15 @@ def optimize_saliency_map_conversion(
         batch_size=batch_size,
         tol=tol,
         maxiter=maxiter,
-        minimize_options=minimize_options)
+        minimize_options=minimize_options,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        bucket_granularity=bucket_granularity,
+        materialize_batches=materialize_batches,
+        storage_dtype=storage_dtype,
+        learning_rate=learning_rate,
+        validation_ratio=validation_ratio,
+        patience=patience)
 
     return_model = SaliencyMapProcessingModel(
         model,
@@ -241,7 +326,36 @@ def _optimize_saliency_map_conversion_over_multiple_models_and_datasets(
         batch_size=8,
         tol=None,
         maxiter=1000,
-        minimize_options=None):
+        minimize_options=None,
+        num_workers=0,
+        pin_memory=None,
+        bucket_granularity=None,
+        materialize_batches=False,
+        storage_dtype=None,
+        learning_rate=1e-2,
+        validation_ratio=0.1,
+        patience=5):
+    """
+    method: optimization method of `optpy.minimize` which evaluates all data for every function evaluation,
+        or one of `STOCHASTIC_METHODS` ('adam', 'lbfgs'), which optimize on minibatches of `batch_size`
+        images (see `_optimize_saliency_map_processing_stochastic`). Then `maxiter` is the maximal number
+        of epochs, `learning_rate` the learning rate and the optimization stops early if the log likelihood
+        on the held out `validation_ratio` of the stimuli did not improve for `patience` epochs.
+        The `fun` of the optimization result is the loss on the fit data for all methods.
+    num_workers: number of `DataLoader` worker processes used to load the stimuli and compute the
+        saliency maps in parallel with the optimization. With workers, the per-image data is cached
+        in the (persistent) worker processes.
+    pin_memory: whether to load batches into pinned memory. Defaults to using pinned memory
+        if the optimization runs on a GPU.
+    bucket_granularity: batch images of different but similar shapes together by padding them
+        (see `ImageDatasetSampler`).
+    materialize_batches: compute all batches (normalized saliency maps and fixations) once before
+        the optimization and keep them in memory instead of iterating the data loader for every
+        function evaluation (see `MaterializedBatches`). This is faster, but keeps all batches in
+        memory, so it is disabled by default.
+    storage_dtype: torch dtype in which materialized saliency maps are stored, e.g. `torch.float16`
+        to halve the memory. They are converted back for each function evaluation.
+    """
 
     if len(list_of_targets) != 1:
         raise NotImplementedError()
@@ -256,20 +370,50 @@ def _optimize_saliency_map_conversion_over_multiple_models_and_datasets(
         ) for i, model in enumerate(models)
     }
 
-    dataset = ImageDataset(
-        stimuli,
-        fixations,
-        models=models_dict,
-        transform=FixationMaskTransform(),
-        average=average,
-    )
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if pin_memory is None:
+        pin_memory = device.type == 'cuda'
+
+    def make_loader(stimuli, fixations, shuffle=False):
+        dataset = ImageDataset(
+            stimuli,
+            fixations,
+            models=models_dict,
+            transform=FixationIndicesTransform(),
+            average=average,
+            # materialized batches are computed only once, no need to keep the items as well
+            cache_max_bytes=0 if materialize_batches else None,
+        )
 
-    loader = torch.utils.data.DataLoader(
-        dataset,
-        batch_sampler=ImageDatasetSampler(dataset, batch_size=batch_size, shuffle=False),
-        pin_memory=False,
-        num_workers=0,  # doesn't work for sparse tensors yet. Might work soon.
-    )
+        loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=ImageDatasetSampler(
+                dataset, batch_size=batch_size, shuffle=shuffle and not materialize_batches, bucket_granularity=bucket_granularity
+            ),
+            collate_fn=collate_fixation_indices,
+            # materialized batches are pinned after converting them to the storage dtype
+            pin_memory=pin_memory and not materialize_batches,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0 and not materialize_batches,
+        )
+
+        if materialize_batches:
+            loader = MaterializedBatches(
+                loader, storage_dtype=storage_dtype, drop_keys=['image'], shuffle=shuffle, pin_memory=pin_memory, verbose=verbose,
+            )
+
+        return loader
+
+    stochastic = method in STOCHASTIC_METHODS
+    if stochastic:
+        train_indices, validation_indices = _validation_split(len(stimuli), validation_ratio)
+        loader = make_loader(*create_subset(stimuli, fixations, train_indices), shuffle=True)
+        if validation_indices is not None:
+            validation_loader = make_loader(*create_subset(stimuli, fixations, validation_indices))
+        else:
+            validation_loader = loader
+    else:
+        loader = make_loader(stimuli, fixations)
 
     saliency_map_processing = SaliencyMapProcessing(
         nonlinearity_values=nonlinearity_values,
@@ -279,21 +423,34 @@ def _optimize_saliency_map_conversion_over_multiple_models_and_datasets(
         blur_radius=blur_radius,
     )
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     if verbose:
         print("Using device", device)
     saliency_map_processing.to(device)
 
-    optimization_result = _optimize_saliency_map_processing(
-        saliency_map_processing,
-        loader,
-        verbose=verbose,
-        optimize=optimize,
-        method=method,
-        tol=tol,
-        maxiter=maxiter,
-        minimize_options=minimize_options,
-    )
+    if stochastic:
+        optimization_result = _optimize_saliency_map_processing_stochastic(
+            saliency_map_processing,
+            loader,
+            validation_loader,
+            verbose=verbose,
+            optimize=optimize,
+            method=method,
+            learning_rate=learning_rate,
+            max_epochs=maxiter,
+            patience=patience,
+            tol=tol,
+        )
+    else:
+        optimization_result = _optimize_saliency_map_processing(
+            saliency_map_processing,
+            loader,
+            verbose=verbose,
+            optimize=optimize,
+            method=method,
+            tol=tol,
+            maxiter=maxiter,
+            minimize_options=minimize_options,
+        )
 
     return saliency_map_processing, optimization_result
 
@@ -322,7 +479,7 @@ def _optimize_saliency_map_processing(
     nonlinearity_values = saliency_map_processing.nonlinearity.value_scale
     num_nonlinearity = len(saliency_map_processing.nonlinearity.ys)
 
-    initial_params = {key: value.detach().cpu().numpy() for key, value in full_param_dict.items()}
+    initial_params = {key: value.detach().cpu().numpy().copy() for key, value in full_param_dict.items()}
 
     def func(blur_radius, nonlinearity, centerbias, alpha, optimize=None):
         if verbose > 5:
@@ -436,6 +593,175 @@ def _optimize_saliency_map_processing(
     return res
 
 
+STOCHASTIC_METHODS = ['adam', 'lbfgs']
+
+
+def _validation_split(count, validation_ratio):
+    """ splits `count` stimuli randomly (but reproducibly) into training and validation indices """
+    validation_count = int(round(validation_ratio * count))
+    if not validation_count or validation_count >= count:
+        return list(range(count)), None
+
+    indices = np.random.RandomState(seed=42).permutation(count)
+    return sorted(indices[validation_count:].tolist()), sorted(indices[:validation_count].tolist())
+
+
+def _project_parameters(saliency_map_processing, optimize, initial_params):
+    """ projects the parameters onto the bounds and constraints used by `_optimize_saliency_map_processing` """
+    nonlinearity_target = saliency_map_processing.nonlinearity_target
+    nonlinearity_values = saliency_map_processing.nonlinearity.value_scale
+
+    with torch.no_grad():
+        if 'alpha' in optimize:
+            saliency_map_processing.centerbias.alpha.clamp_(1e-4, 1.0 - 1e-4)
+
+        if 'blur_radius' in optimize:
+            # a blur radius of 0 would result in an undefined gaussian kernel
+            saliency_map_processing.blur.sigma.clamp_(1e-2, 1e3)
+
+        if 'nonlinearity' in optimize:
+            ys = saliency_map_processing.nonlinearity.ys
+            # monotonic nonlinearity
+            ys.copy_(torch.cummax(ys, dim=0).values)
+            initial_ys = torch.as_tensor(initial_params['nonlinearity'], dtype=ys.dtype, device=ys.device)
+            if nonlinearity_target == 'density' and nonlinearity_values == 'linear':
+                ys.clamp_(1e-6, 1e7)
+                ys.mul_(initial_ys.sum() / ys.sum())
+            elif nonlinearity_target == 'density' and nonlinearity_values == 'log':
+                ys.clamp_(-100, 100)
+                ys.add_(torch.logsumexp(initial_ys, dim=0) - torch.logsumexp(ys, dim=0))
+            else:
+                ys.sub_(ys[0].clone())
+
+        if 'centerbias' in optimize:
+            ys = saliency_map_processing.centerbias.nonlinearity.ys
+            if nonlinearity_target == 'density':
+                initial_ys = torch.as_tensor(initial_params['centerbias'], dtype=ys.dtype, device=ys.device)
+                ys.clamp_(1e-6, 1000)
+                ys.mul_(initial_ys.sum() / ys.sum())
+            else:
+                ys.sub_(ys[0].clone())
+
+
+def _evaluate_dataset(model, dataset, device):
+    """ weighted average loss over a dataset without computing gradients """
+    losses = []
+    batch_weights = []
+    with torch.no_grad():
+        for batch in dataset:
+            loss, weights = _batch_loss(model, batch, device)
+            losses.append(loss.cpu().numpy())
+            batch_weights.append(weights.cpu().numpy().sum())
+
+    return np.average(losses, weights=batch_weights)
+
+
+def _optimize_saliency_map_processing_stochastic(
+        saliency_map_processing,
+        data_loader,
+        validation_data_loader,
+        optimize=None,
+        verbose=0,
+        method='adam',
+        learning_rate=1e-2,
+        max_epochs=1000,
+        patience=5,
+        tol=None):
+    """optimizes the saliency map processing on minibatches with Adam or L-BFGS.
+
+    After each step the parameters are projected onto the bounds and constraints of
+    `_optimize_saliency_map_processing` (e.g., the nonlinearity is made monotonic).
+    After each epoch, the loss on `validation_data_loader` is evaluated. The optimization
+    stops if it did not improve by more than `tol` for `patience` epochs, and the
+    parameters with the best validation loss are restored.
+
+    As for the full-batch optimization, `fun` of the result is the loss on the fit data
+    (`data_loader`) and `success` is only true if the optimization converged, i.e. not if
+    it ran for `max_epochs` epochs. The best validation loss is returned as `validation_loss`.
+    """
+    if optimize is None:
+        optimize = ['blur_radius', 'nonlinearity', 'centerbias', 'alpha']
+
+    full_param_dict = {
+        'blur_radius': saliency_map_processing.blur.sigma,
+        'nonlinearity': saliency_map_processing.nonlinearity.ys,
+        'centerbias': saliency_map_processing.centerbias.nonlinearity.ys,
+        'alpha': saliency_map_processing.centerbias.alpha,
+    }
+    initial_params = {key: value.detach().cpu().numpy().copy() for key, value in full_param_dict.items()}
+    params = [full_param_dict[param_name] for param_name in optimize]
+
+    requires_grad = {param_name: param.requires_grad for param_name, param in full_param_dict.items()}
+    for param_name, param in full_param_dict.items():
+        param.requires_grad_(param_name in optimize)
+
+    if method == 'adam':
+        optimizer = torch.optim.Adam(params, lr=learning_rate)
+    elif method == 'lbfgs':
+        optimizer = torch.optim.LBFGS(params, lr=learning_rate, max_iter=5, line_search_fn='strong_wolfe')
+    else:
+        raise ValueError(method)
+
+    tol = tol or 0.0
+    device = saliency_map_processing.nonlinearity.ys.device
+
+    def get_state():
+        return {param_name: param.detach().clone() for param_name, param in full_param_dict.items()}
+
+    saliency_map_processing.train()
+    best_loss = _evaluate_dataset(saliency_map_processing, validation_data_loader, device)
+    best_state = get_state()
+    epochs_without_improvement = 0
+    status, message = 9, 'Maximum number of epochs reached'
+
+    for epoch in range(max_epochs):
+        for batch in tqdm(data_loader, disable=verbose <= 4):
+            def closure():
+                # L-BFGS evaluates several points per step, which have to be feasible as well
+                _project_parameters(saliency_map_processing, optimize, initial_params)
+                optimizer.zero_grad()
+                loss, _ = _batch_loss(saliency_map_processing, batch, device)
+                loss.backward()
+                return loss
+
+            optimizer.step(closure)
+            _project_parameters(saliency_map_processing, optimize, initial_params)
+
+        validation_loss = _evaluate_dataset(saliency_map_processing, validation_data_loader, device)
+        if verbose:
+            print('epoch {}: validation loss {:.05f}'.format(epoch + 1, validation_loss))
+
+        if validation_loss < best_loss - tol:
+            best_loss = validation_loss
+            best_state = get_state()
+            epochs_without_improvement = 0
+        else:
+            epochs_without_improvement += 1
+            if epochs_without_improvement >= patience:
+                status, message = 0, 'Validation loss did not improve for {} epochs'.format(patience)
+                break
+
+    with torch.no_grad():
+        for param_name, param in full_param_dict.items():
+            param.copy_(best_state[param_name])
+            param.requires_grad_(requires_grad[param_name])
+
+    if validation_data_loader is data_loader:
+        loss = best_loss
+    else:
+        loss = _evaluate_dataset(saliency_map_processing, data_loader, device)
+
+    return OptimizeResult(
+        x={param_name: value.cpu().numpy() for param_name, value in best_state.items()},
+        fun=loss,
+        validation_loss=best_loss,
+        nit=epoch + 1 if max_epochs else 0,
+        status=status,
+        success=status == 0,
+        message=message,
+    )
+
+
 class SaliencyMapProcessingModel(Model):
     def __init__(
             self,
@@ -449,10 +775,17 @@ class SaliencyMapProcessingModel(Model):
             blur_radius=20.0,
             saliency_map_processing=None,
             device=None,
+            num_threads=None,
             **kwargs):
+        """
+        num_threads: number of torch threads used for computing predictions on the CPU.
+            By default, torch's global setting is used.
+        """
 
         super().__init__(**kwargs)
         self.saliency_map_model = saliency_map_model
+        self.num_threads = num_threads
+        self._centerbias_cache = {}
 
         self.normalized_saliency_map_model = NormalizedSaliencyMapModel(
             saliency_map_model,
@@ -477,7 +810,63 @@ class SaliencyMapProcessingModel(Model):
         saliency_map_processing.to(self.device)
         self.saliency_map_processing = saliency_map_processing
 
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('_centerbias_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        # models pickled before these attributes existed
+        state.setdefault('num_threads', None)
+        super().__setstate__(state)
+        self._centerbias_cache = {}
+
+    def _centerbias(self, shape):
+        # the centerbias depends only on the shape and on the parameters of the centerbias module
+        # (identified by the objects and their versions, which change with every update)
+        centerbias_module = self.saliency_map_processing.centerbias
+        params = list(centerbias_module.parameters())
+        key = (shape, self.device, id(centerbias_module), tuple((id(param), param._version) for param in params))
+        if key not in self._centerbias_cache:
+            self._centerbias_cache.clear()
+            dummy = torch.empty((1, 1) + shape, device=self.device)
+            # keep the module and parameters alive such that their ids are not reused
+            self._centerbias_cache[key] = (centerbias_module, params, centerbias_module(dummy))
+        return self._centerbias_cache[key][-1]
+
     def _log_density(self, stimulus):
-        saliency_map = self.normalized_saliency_map_model.saliency_map(stimulus)
-        saliency_map_tensor = torch.tensor(saliency_map[np.newaxis, np.newaxis, :, :]).to(self.device)
-        return self.saliency_map_processing.forward(saliency_map_tensor).detach().cpu().numpy()[0, 0, :, :]
+        return self._log_densities([Stimulus(stimulus)])[0]
+
+    def _log_densities(self, stimuli, verbose=False, batch_size=8):
+        log_densities = [None] * len(stimuli)
+        indices_by_shape = {}
+        for i, stimulus in enumerate(stimuli):
+            indices_by_shape.setdefault(stimulus.size, []).append(i)
+
+        old_num_threads = torch.get_num_threads()
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+
+        inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+        try:
+            with inference_mode(), tqdm(total=len(stimuli), disable=not verbose) as pbar:
+                for shape, indices in indices_by_shape.items():
+                    for batch_indices in chunked(indices, batch_size):
+                        saliency_maps = np.array([
+                            self.normalized_saliency_map_model.saliency_map(stimuli[i].stimulus_data) for i in batch_indices
+                        ])
+                        saliency_map_tensor = torch.tensor(saliency_maps[:, np.newaxis, :, :]).to(self.device)
+                        centerbias = self._centerbias(tuple(shape))
+                        batch_log_densities = self.saliency_map_processing.forward(
+                            saliency_map_tensor, centerbias=centerbias
+                        ).cpu().numpy()[:, 0, :, :]
+
+                        for i, log_density in zip(batch_indices, batch_log_densities):
+                            log_densities[i] = log_density.copy()
+
+                        pbar.update(len(batch_indices))
+        finally:
+            torch.set_num_threads(old_num_threads)
+
+        return log_densities
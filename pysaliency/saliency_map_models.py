@@ -6,7 +6,7 @@ from abc import ABCMeta, abstractmethod
 import numpy as np
 from scipy.io import loadmat
 from imageio import imsave
-from scipy.ndimage import gaussian_filter, zoom
+from scipy.ndimage import gaussian_filter
 
 from tqdm import tqdm
 from boltons.cacheutils import cached, LRU
@@ -14,8 +14,9 @@ from boltons.cacheutils import cached, LRU
 from .roc import general_roc, general_rocs_per_positive
 from .numba_utils import fill_fixation_map, auc_for_one_positive
 
-from .utils import TemporaryDirectory, run_matlab_cmd, Cache, average_values, deprecated_class, remove_trailing_nans
-from .datasets import Stimulus, Fixations
+from .utils import (TemporaryDirectory, run_matlab_cmd, Cache, average_values, deprecated_class, remove_trailing_nans, resize_saliency_map,
+                    cached_resize)
+from .datasets import Stimulus, Fixations, ShuffledNonfixations, get_image_hash
 from .metrics import CC, NSS, SIM
 from .sampling_models import SamplingModelMixin
 
@@ -53,18 +54,10 @@ class FullShuffledNonfixationProvider(object):
         cache_size = int(max_fixations_in_cache / len(self.fixations.x))
         self.cache = LRU(cache_size)
         self.nonfixations_for_image = cached(self.cache)(self._nonfixations_for_image)
-        self.widths = np.asarray([s[1] for s in stimuli.sizes]).astype(float)
-        self.heights = np.asarray([s[0] for s in stimuli.sizes]).astype(float)
+        self.shuffled_nonfixations = ShuffledNonfixations(fixations, stimuli=stimuli)
 
     def _nonfixations_for_image(self, n):
-        inds = ~(self.fixations.n == n)
-        xs = (self.fixations.x[inds].copy()).astype(float)
-        ys = (self.fixations.y[inds].copy()).astype(float)
-
-        other_ns = self.fixations.n[inds]
-        xs *= self.stimuli.sizes[n][1]/self.widths[other_ns]
-        ys *= self.stimuli.sizes[n][0]/self.heights[other_ns]
-
+        xs, ys = self.shuffled_nonfixations.coordinates_for_image(n)
         return xs.astype(int), ys.astype(int)
 
     def __call__(self, stimuli, fixations, i):
@@ -855,12 +848,18 @@ class FixationMap(SaliencyMapModel):
 
 
 class ResizingSaliencyMapModel(SaliencyMapModel):
-    def __init__(self, parent_model, verbose=True, **kwargs):
+    """ Resizes the saliency maps of `parent_model` to the stimulus size.
+
+    Resized saliency maps can be kept in `resize_cache`, a mapping such as `SizeBoundedLRU`
+    which can be shared by several models (see `pysaliency.utils.cached_resize`).
+    """
+    def __init__(self, parent_model, verbose=True, resize_cache=None, **kwargs):
         if 'caching' not in kwargs:
             kwargs['caching'] = False
         super(ResizingSaliencyMapModel, self).__init__(**kwargs)
         self.parent_model = parent_model
         self.verbose = verbose
+        self.resize_cache = resize_cache
 
     def _saliency_map(self, stimulus):
         smap = self.parent_model.saliency_map(stimulus)
@@ -871,10 +870,11 @@ class ResizingSaliencyMapModel(SaliencyMapModel):
         if smap.shape != target_shape:
             if self.verbose:
                 print("Resizing saliency map", smap.shape, target_shape)
-            x_factor = target_shape[1] / smap.shape[1]
-            y_factor = target_shape[0] / smap.shape[0]
-
-            smap = zoom(smap, [y_factor, x_factor], order=1, mode='nearest')
+            smap = cached_resize(
+                self.resize_cache,
+                lambda: ('saliency_map', get_image_hash(stimulus), self.parent_model, target_shape),
+                lambda: resize_saliency_map(smap, target_shape),
+            )
 
             assert smap.shape == target_shape
 
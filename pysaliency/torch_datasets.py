@@ -1,12 +1,16 @@
+from hashlib import sha1
+import os
 import random
 
 from boltons.iterutils import chunked
 import numpy as np
 import torch
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm
 
 from .models import Model
 from .saliency_map_models import SaliencyMapModel
+from .utils import SizeBoundedLRU, get_nbytes
 
 
 def ensure_color_image(image):
@@ -17,26 +21,36 @@ def ensure_color_image(image):
 
 def x_y_to_sparse_indices(xs, ys):
     # Converts list of x and y coordinates into indices and values for sparse mask
-    x_inds = []
-    y_inds = []
-    values = []
-    pair_inds = {}
-
-    for x, y in zip(xs, ys):
-        key = (x, y)
-        if key not in pair_inds:
-            x_inds.append(x)
-            y_inds.append(y)
-            pair_inds[key] = len(x_inds) - 1
-            values.append(1)
-        else:
-            values[pair_inds[key]] += 1
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    if not len(xs):
+        return np.zeros((2, 0), dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    width = xs.max() + 1
+    linear_indices, values = np.unique(ys * width + xs, return_counts=True)
+    y_inds, x_inds = np.divmod(linear_indices, width)
 
     return np.array([y_inds, x_inds]), values
 
 
 class ImageDataset(torch.utils.data.Dataset):
-    def __init__(self, stimuli, fixations, models=None, transform=None, cached=True, average='fixation'):
+    """Dataset of stimuli with their fixations and model predictions
+
+    Args:
+        cached (bool): cache the images and model predictions in memory.
+        cache_max_bytes (int, optional): bound the size of the memory cache in bytes.
+            Least recently used items are evicted first. By default the cache is unbounded.
+        image_dtype (dtype, optional): dtype in which images are stored, e.g. `np.float16`
+            or `np.uint8` (only for integer images within the range of the dtype). Images are
+            always returned as float32. Defaults to float32.
+        cache_directory (str, optional): directory in which images and model predictions are
+            stored as `.npy` files. Existing files are memory mapped instead of being recomputed,
+            which allows multiple `DataLoader` workers to share one copy via the page cache.
+            The file names contain a hash of the stimulus, the model class and the image dtype.
+            Models of the same class with different parameters need separate directories.
+    """
+    def __init__(self, stimuli, fixations, models=None, transform=None, cached=True, average='fixation',
+                 cache_max_bytes=None, image_dtype=None, cache_directory=None):
         self.stimuli = stimuli
         self.fixations = fixations
 
@@ -47,54 +61,104 @@ class ImageDataset(torch.utils.data.Dataset):
         self.transform = transform
         self.average = average
 
+        self.image_dtype = np.dtype(image_dtype) if image_dtype is not None else np.dtype(np.float32)
+
+        self.cache_directory = cache_directory
+        if cache_directory is not None:
+            os.makedirs(cache_directory, exist_ok=True)
+
         self.cached = cached
         if cached:
-            self._cache = {}
-            print("Populating fixations cache")
-            self._xs_cache = {}
-            self._ys_cache = {}
-
-            for x, y, n in zip(self.fixations.x_int, self.fixations.y_int, tqdm(self.fixations.n)):
-                self._xs_cache.setdefault(n, []).append(x)
-                self._ys_cache.setdefault(n, []).append(y)
+            if cache_max_bytes is None:
+                self._cache = {}
+            else:
+                self._cache = SizeBoundedLRU(cache_max_bytes, get_size=_item_nbytes)
+            # group the fixations by image with one stable sort instead of a python loop
+            ns = np.asarray(self.fixations.n)
+            order = np.argsort(ns, kind='stable')
+            keys, starts = np.unique(ns[order], return_index=True)
+            xs = np.split(np.asarray(self.fixations.x_int, dtype=int)[order], starts[1:])
+            ys = np.split(np.asarray(self.fixations.y_int, dtype=int)[order], starts[1:])
 
-            for key in list(self._xs_cache):
-                self._xs_cache[key] = np.array(self._xs_cache[key], dtype=int)
-            for key in list(self._ys_cache):
-                self._ys_cache[key] = np.array(self._ys_cache[key], dtype=int)
+            self._xs_cache = dict(zip(keys.tolist(), xs))
+            self._ys_cache = dict(zip(keys.tolist(), ys))
 
     def get_shapes(self):
         return list(self.stimuli.sizes)
 
+    def _cache_filename(self, key, name):
+        if name == 'image':
+            identity = self.image_dtype.str
+        else:
+            model = self.models[name]
+            identity = '{}.{}'.format(type(model).__module__, type(model).__qualname__)
+        digest = sha1('{}|{}|{}'.format(self.stimuli.stimulus_ids[key], name, identity).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_directory, '{:06d}_{}_{}.npy'.format(key, name, digest[:16]))
+
+    def _convert_image(self, image):
+        if np.issubdtype(self.image_dtype, np.integer):
+            if not np.issubdtype(image.dtype, np.integer):
+                raise ValueError("Can't store images of dtype {} as {}".format(image.dtype, self.image_dtype))
+            info = np.iinfo(self.image_dtype)
+            if image.size and (image.min() < info.min or image.max() > info.max):
+                raise ValueError("Image values exceed the range of {}".format(self.image_dtype))
+        return image.astype(self.image_dtype)
+
+    def _compute_arrays(self, key):
+        image = np.array(self.stimuli.stimuli[key])
+
+        arrays = {}
+        for model_name, model in self.models.items():
+            if isinstance(model, Model):
+                prediction = model.log_density(image)
+            elif isinstance(model, SaliencyMapModel):
+                prediction = model.saliency_map(image)
+            arrays[model_name] = prediction
+
+        image = self._convert_image(ensure_color_image(image))
+        arrays['image'] = image.transpose(2, 0, 1)
+
+        return arrays
+
+    def _load_arrays(self, key):
+        names = ['image'] + list(self.models)
+        filenames = {name: self._cache_filename(key, name) for name in names}
+        if not all(os.path.exists(filename) for filename in filenames.values()):
+            arrays = self._compute_arrays(key)
+            for name, filename in filenames.items():
+                # write to temporary file first so that concurrent workers never see partial files
+                tmp_filename = '{}.{}.tmp'.format(filename[:-len('.npy')], os.getpid())
+                with open(tmp_filename, 'wb') as f:
+                    np.save(f, arrays[name])
+                os.replace(tmp_filename, filename)
+
+        return {name: np.load(filename, mmap_mode='r') for name, filename in filenames.items()}
+
+    def _get_fixations(self, key):
+        if self.cached:
+            empty = np.array([], dtype=int)
+            return self._xs_cache.get(key, empty), self._ys_cache.get(key, empty)
+
+        inds = self.fixations.n == key
+        xs = np.array(self.fixations.x_int[inds], dtype=int)
+        ys = np.array(self.fixations.y_int[inds], dtype=int)
+        return xs, ys
+
     def __getitem__(self, key):
         if not self.cached or key not in self._cache:
-            image = np.array(self.stimuli.stimuli[key])
-
-            predictions = {}
-            for model_name, model in self.models.items():
-                if isinstance(model, Model):
-                    prediction = model.log_density(image)
-                elif isinstance(model, SaliencyMapModel):
-                    prediction = model.saliency_map(image)
-                predictions[model_name] = prediction
-
-            image = ensure_color_image(image).astype(np.float32)
-            image = image.transpose(2, 0, 1)
-
-            if self.cached:
-                xs = self._xs_cache.pop(key)
-                ys = self._ys_cache.pop(key)
+            if self.cache_directory is not None:
+                arrays = self._load_arrays(key)
             else:
-                inds = self.fixations.n == key
-                xs = np.array(self.fixations.x_int[inds], dtype=int)
-                ys = np.array(self.fixations.y_int[inds], dtype=int)
+                arrays = self._compute_arrays(key)
+
+            xs, ys = self._get_fixations(key)
             data = {
-                "image": image,
+                "image": arrays.pop('image'),
                 "x": xs,
                 "y": ys,
             }
 
-            for prediction_name, prediction in predictions.items():
+            for prediction_name, prediction in arrays.items():
                 data[prediction_name] = prediction
 
             if self.average == 'image':
@@ -107,8 +171,14 @@ class ImageDataset(torch.utils.data.Dataset):
         else:
             data = self._cache[key]
 
+        data = dict(data)
+        for name in ['image'] + list(self.models):
+            value = data[name]
+            if isinstance(value, np.memmap) or (name == 'image' and value.dtype != np.float32):
+                data[name] = np.array(value, dtype=np.float32 if name == 'image' else value.dtype)
+
         if self.transform is not None:
-            return self.transform(dict(data))
+            return self.transform(data)
 
         return data
 
@@ -116,6 +186,14 @@ class ImageDataset(torch.utils.data.Dataset):
         return len(self.stimuli)
 
 
+def _item_nbytes(item):
+    # memory mapped arrays live in the page cache and don't count towards the cache size
+    return sum(
+        get_nbytes(value) for value in item.values()
+        if isinstance(value, np.ndarray) and not isinstance(value, np.memmap)
+    )
+
+
 class FixationMaskTransform(object):
     def __call__(self, item):
         shape = torch.Size([item['image'].shape[1], item['image'].shape[2]])
@@ -126,7 +204,7 @@ class FixationMaskTransform(object):
         inds = np.array([y, x])
         values = np.ones(len(y), dtype=int)
 
-        mask = torch.sparse.IntTensor(torch.tensor(inds), torch.tensor(values), shape)
+        mask = torch.sparse_coo_tensor(torch.tensor(inds), torch.tensor(values, dtype=torch.int32), shape)
         mask = mask.coalesce()
 
         item['fixation_mask'] = mask
@@ -134,22 +212,101 @@ class FixationMaskTransform(object):
         return item
 
 
+class FixationIndicesTransform(object):
+    """Encodes the fixations of an item as flat pixel indices.
+
+    Unlike `FixationMaskTransform`, the resulting item contains only dense
+    tensors, so it can be sent through `DataLoader` worker processes and pinned
+    memory. Use `collate_fixation_indices` as `collate_fn` to batch the items.
+    """
+    def __call__(self, item):
+        width = item['image'].shape[2]
+        x = item.pop('x')
+        y = item.pop('y')
+
+        item['fixation_indices'] = torch.as_tensor(np.asarray(y, dtype=np.int64) * width + np.asarray(x, dtype=np.int64))
+
+        return item
+
+
+def collate_fixation_indices(batch):
+    """Collates items from `FixationIndicesTransform` into a batch.
+
+    The flat fixation indices of all items are padded with zeros into a
+    `fixation_indices` tensor of shape (batch_size, max_fixations), and the number
+    of valid entries per item is stored in `fixation_counts`.
+
+    Items of different shapes (e.g. from `ImageDatasetSampler` with `bucket_granularity`)
+    are padded to the largest height and width in the batch by repeating their last
+    row and column. The shape of each item without padding is stored in `valid_shape`.
+    """
+    batch = [dict(item) for item in batch]
+    indices = [item.pop('fixation_indices') for item in batch]
+    shapes = [tuple(item['image'].shape[-2:]) for item in batch]
+
+    height = max(shape[0] for shape in shapes)
+    width = max(shape[1] for shape in shapes)
+
+    counts = torch.tensor([len(item_indices) for item_indices in indices], dtype=torch.int64)
+    fixation_indices = torch.zeros((len(indices), max(int(counts.max()), 1)), dtype=torch.int64)
+    for k, (item_indices, shape) in enumerate(zip(indices, shapes)):
+        if shape[1] != width:
+            item_indices = item_indices // shape[1] * width + item_indices % shape[1]
+        fixation_indices[k, :len(item_indices)] = item_indices
+
+    for item, shape in zip(batch, shapes):
+        if shape == (height, width):
+            continue
+        for key, value in item.items():
+            if isinstance(value, np.ndarray) and value.ndim >= 2 and value.shape[-2:] == shape:
+                padding = [(0, 0)] * (value.ndim - 2) + [(0, height - shape[0]), (0, width - shape[1])]
+                item[key] = np.pad(value, padding, mode='edge')
+
+    collated = default_collate(batch)
+    collated['fixation_indices'] = fixation_indices
+    collated['fixation_counts'] = counts
+    collated['valid_shape'] = torch.tensor(shapes, dtype=torch.int64)
+
+    return collated
+
+
+def _bucket_shape(shape, granularity):
+    return tuple(int(np.ceil(size / granularity)) * granularity for size in shape)
+
+
 class ImageDatasetSampler(torch.utils.data.Sampler):
-    def __init__(self, data_source, batch_size=1, ratio_used=1.0, shuffle=True):
+    """Batch sampler which batches images of the same shape
+
+    Args:
+        bucket_granularity (int, optional): if given, images whose heights and widths round up
+            to the same multiple of `bucket_granularity` are batched together, which requires
+            padding them (see `collate_fixation_indices`). This avoids tiny batches for datasets
+            with many different image shapes. Within each bucket, images are batched in order of
+            their shapes to keep the padding small.
+    """
+    def __init__(self, data_source, batch_size=1, ratio_used=1.0, shuffle=True, bucket_granularity=None):
         self.ratio_used = ratio_used
         self.shuffle = shuffle
+        self.bucket_granularity = bucket_granularity
 
-        shapes = data_source.get_shapes()
-        unique_shapes = sorted(set(shapes))
+        shapes = [tuple(shape) for shape in data_source.get_shapes()]
+        if bucket_granularity is None:
+            buckets = shapes
+        else:
+            buckets = [_bucket_shape(shape, bucket_granularity) for shape in shapes]
+        unique_buckets = sorted(set(buckets))
+        bucket_numbers = {bucket: k for k, bucket in enumerate(unique_buckets)}
 
-        shape_indices = [[] for shape in unique_shapes]
+        shape_indices = [[] for bucket in unique_buckets]
 
-        for k, shape in enumerate(shapes):
-            shape_indices[unique_shapes.index(shape)].append(k)
+        for k, bucket in enumerate(buckets):
+            shape_indices[bucket_numbers[bucket]].append(k)
 
-        if self.shuffle:
-            for indices in shape_indices:
+        for indices in shape_indices:
+            if self.shuffle:
                 random.shuffle(indices)
+            if bucket_granularity is not None:
+                indices.sort(key=lambda k: shapes[k])
 
         self.batches = sum([chunked(indices, size=batch_size) for indices in shape_indices], [])
 
@@ -166,3 +323,61 @@ class ImageDatasetSampler(torch.utils.data.Sampler):
 
     def __len__(self):
         return int(self.ratio_used * len(self.batches))
+
+
+class MaterializedBatches(object):
+    """Loads all batches of a data loader once and keeps them in memory
+
+    Iterating over it yields the same batches as the data loader (by default in the same
+    order), which is useful when the same batches are needed many times, e.g. once per
+    function evaluation of an optimizer.
+
+    Args:
+        data_loader: iterable of batches (dicts of tensors)
+        storage_dtype (torch.dtype, optional): dtype in which floating point maps (tensors with
+            at least three dimensions) are stored, e.g. `torch.float16`. They are converted back
+            to their original dtype when iterating.
+        drop_keys (list, optional): entries of the batches that are not stored.
+        shuffle (bool, optional): iterate over the batches in random order.
+        pin_memory (bool, optional): keep the tensors in pinned memory for fast (asynchronous)
+            transfers to the GPU, like `DataLoader(pin_memory=True)`. Requires CUDA.
+    """
+    def __init__(self, data_loader, storage_dtype=None, drop_keys=(), shuffle=False, pin_memory=False, verbose=False):
+        self.shuffle = shuffle
+        self.pin_memory = pin_memory
+        self.batches = []
+        self.dtypes = []
+
+        for batch in tqdm(data_loader, disable=not verbose):
+            stored_batch = {}
+            dtypes = {}
+            for key, value in batch.items():
+                if key in drop_keys:
+                    continue
+                if storage_dtype is not None and torch.is_tensor(value) and value.is_floating_point() and value.dim() >= 3:
+                    dtypes[key] = value.dtype
+                    value = value.to(storage_dtype)
+                if torch.is_tensor(value):
+                    value = value.contiguous()
+                    if pin_memory and not value.is_pinned():
+                        value = value.pin_memory()
+                stored_batch[key] = value
+            self.batches.append(stored_batch)
+            self.dtypes.append(dtypes)
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.batches)).tolist()
+        else:
+            indices = range(len(self.batches))
+
+        for index in indices:
+            batch = dict(self.batches[index])
+            dtypes = self.dtypes[index]
+            for key, dtype in dtypes.items():
+                value = batch[key]
+                batch[key] = torch.empty(value.shape, dtype=dtype, pin_memory=self.pin_memory).copy_(value)
+            yield batch
+
+    def __len__(self):
+        return len(self.batches)
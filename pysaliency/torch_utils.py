@@ -124,6 +124,83 @@ def gaussian_filter_1d(tensor, dim, sigma, truncate=4, kernel_size=None, padding
 
 
 
+def gaussian_filter_1d_fft(tensor, dim, sigma, truncate=4, kernel_size=None, padding_mode='replicate', padding_value=0.0):
+    """same as `gaussian_filter_1d`, but convolves via FFT which is faster for large kernels"""
+    sigma = torch.as_tensor(sigma, device=tensor.device, dtype=tensor.dtype)
+
+    if kernel_size is not None:
+        kernel_size_int = int(kernel_size)
+    else:
+        kernel_size_int = int(2 * math.ceil(truncate * float(sigma.detach())) + 1)
+
+    grid = torch.arange(kernel_size_int, device=tensor.device, dtype=tensor.dtype) - (kernel_size_int - 1) / 2
+    kernel = torch.exp(-0.5 * (grid / sigma) ** 2)
+    kernel = kernel / kernel.sum()
+
+    source_shape = tensor.shape
+    length = source_shape[dim]
+
+    tensor = torch.movedim(tensor, dim, len(source_shape) - 1)
+    dim_last_shape = tensor.shape
+    tensor = tensor.reshape(-1, 1, length)
+
+    padding_size = math.ceil((kernel_size_int - 1) / 2)
+    tensor_ = F.pad(tensor, (padding_size, padding_size), padding_mode, padding_value)
+
+    # circular convolution of the padded tensor: the last `length` entries are not affected by wrapping
+    fft_size = tensor_.shape[-1]
+    tensor_ = torch.fft.irfft(
+        torch.fft.rfft(tensor_, n=fft_size) * torch.fft.rfft(kernel, n=fft_size),
+        n=fft_size,
+    )
+    tensor_ = tensor_[..., kernel_size_int - 1:kernel_size_int - 1 + length]
+
+    tensor_ = tensor_.reshape(dim_last_shape)
+    tensor_ = torch.movedim(tensor_, len(source_shape) - 1, dim)
+
+    assert tensor_.shape == source_shape
+
+    return tensor_
+
+
+def gaussian_filter_1d_downsampled(tensor, dim, sigma, factor, truncate=4, padding_mode='replicate', padding_value=0.0):
+    """approximates `gaussian_filter_1d` by blurring at a resolution reduced by `factor`
+
+    The tensor is downsampled by averaging blocks of `factor` entries, blurred and linearly
+    interpolated back to the original size. The sigma of the downsampled blur is chosen such
+    that the total variance of averaging, blur and interpolation matches `sigma**2`.
+    """
+    sigma = torch.as_tensor(sigma, device=tensor.device, dtype=tensor.dtype)
+
+    source_shape = tensor.shape
+    length = source_shape[dim]
+
+    tensor = torch.movedim(tensor, dim, len(source_shape) - 1)
+    dim_last_shape = tensor.shape
+    tensor = tensor.reshape(-1, 1, length)
+
+    padded_length = math.ceil(length / factor) * factor
+    tensor = F.pad(tensor, (0, padded_length - length), 'replicate')
+    tensor = F.avg_pool1d(tensor, factor)
+
+    # block averaging has a variance of (factor**2 - 1) / 12, linear interpolation one of factor**2 / 6
+    low_variance = sigma ** 2 - (factor ** 2 - 1) / 12 - factor ** 2 / 6
+    low_sigma = torch.sqrt(torch.clamp(low_variance, min=0.25)) / factor
+    tensor = gaussian_filter_1d(tensor, dim=2, sigma=low_sigma, truncate=truncate,
+                                padding_mode=padding_mode, padding_value=padding_value)
+
+    tensor = F.interpolate(tensor, scale_factor=factor, mode='linear', align_corners=False)
+    tensor = tensor[..., :length]
+
+    tensor = tensor.reshape(dim_last_shape)
+    return torch.movedim(tensor, len(source_shape) - 1, dim)
+
+
+# kernel size from which FFT convolutions are used by `GaussianFilterNd(method='auto')`.
+# On CPU, they are faster already for small kernels, for 161 entries (sigma 20) about tenfold.
+FFT_MIN_KERNEL_SIZE = 17
+
+
 def gaussian_filter(tensor, dim, sigma, truncate=4, kernel_size=None, padding_mode='replicate', padding_value=0.0):
     if isinstance(dim, int):
         dim = [dim]
@@ -146,7 +223,7 @@ class GaussianFilterNd(nn.Module):
     """A differentiable gaussian filter"""
 
     def __init__(self, dims, sigma, truncate=4, kernel_size=None, padding_mode='replicate', padding_value=0.0,
-                 trainable=False):
+                 trainable=False, method='auto', downsample_sigma=4.0):
         """Creates a 1d gaussian filter
 
         Args:
@@ -157,10 +234,19 @@ class GaussianFilterNd(nn.Module):
             kernel_size (int): size of the gaussian kernel convolved with the input
             padding_mode (string, optional): Padding mode implemented by `torch.nn.functional.pad`.
             padding_value (string, optional): Value used for constant padding.
+            method (string, optional): 'direct' convolves directly, 'fft' convolves via FFT (same result
+                up to numerical precision), 'auto' (default) uses FFT convolutions for kernels of at least
+                `FFT_MIN_KERNEL_SIZE` entries. 'downsample' approximates the blur by blurring a downsampled
+                tensor with a sigma of about `downsample_sigma` and interpolating the result.
+            downsample_sigma (float, optional): target sigma in the downsampled resolution for
+                `method='downsample'`. Smaller values are faster but less accurate.
         """
         # IDEA determine input_dims dynamically for every input
         super(GaussianFilterNd, self).__init__()
 
+        if method not in ['auto', 'direct', 'fft', 'downsample']:
+            raise ValueError("Unknown method '{}'".format(method))
+
         self.dims = dims
         self.sigma = nn.Parameter(torch.tensor(sigma, dtype=torch.float32), requires_grad=trainable)  # default: no optimization
         self.truncate = truncate
@@ -170,26 +256,95 @@ class GaussianFilterNd(nn.Module):
         self.padding_mode = padding_mode
         self.padding_value = padding_value
 
+        self.method = method
+        self.downsample_sigma = downsample_sigma
+
+    def __setstate__(self, state):
+        # filters pickled before `method` and `downsample_sigma` existed
+        state.setdefault('method', 'auto')
+        state.setdefault('downsample_sigma', 4.0)
+        super(GaussianFilterNd, self).__setstate__(state)
+
+    def _filter_1d(self, tensor, dim):
+        sigma = float(self.sigma.detach())
+        method = self.method
+        if method == 'downsample':
+            factor = int(sigma / self.downsample_sigma)
+            if factor >= 2 and self.kernel_size is None:
+                return gaussian_filter_1d_downsampled(
+                    tensor, dim=dim, sigma=self.sigma, factor=factor, truncate=self.truncate,
+                    padding_mode=self.padding_mode, padding_value=self.padding_value,
+                )
+            method = 'auto'
+
+        if method == 'auto':
+            kernel_size = self.kernel_size or 2 * math.ceil(self.truncate * sigma) + 1
+            method = 'fft' if kernel_size >= FFT_MIN_KERNEL_SIZE else 'direct'
+
+        if method == 'fft':
+            filter_1d = gaussian_filter_1d_fft
+        else:
+            filter_1d = gaussian_filter_1d
+
+        return filter_1d(
+            tensor,
+            dim=dim,
+            sigma=self.sigma,
+            truncate=self.truncate,
+            kernel_size=self.kernel_size,
+            padding_mode=self.padding_mode,
+            padding_value=self.padding_value,
+        )
+
     def forward(self, tensor):
         """Applies the gaussian filter to the given tensor"""
         for dim in self.dims:
-            tensor = gaussian_filter_1d(
-                tensor,
-                dim=dim,
-                sigma=self.sigma,
-                truncate=self.truncate,
-                kernel_size=self.kernel_size,
-                padding_mode=self.padding_mode,
-                padding_value=self.padding_value,
-            )
+            tensor = self._filter_1d(tensor, dim)
 
         return tensor
 
 
-def nonlinearity(tensor, xs, ys):
-    # TODO: This could probably be sped up quite a bit with torch.search_sorted
-    assert len(xs) == len(ys)
+def _nonlinearity_segments(tensor, xs):
+    # index of the linear segment of each value and the relative position within the segment
+    segments = torch.bucketize(tensor.detach(), xs[1:-1], right=True)
+    x1 = xs[segments]
+    x2 = xs[segments + 1]
+    weights = (tensor.detach() - x1) / (x2 - x1)
+    return segments, weights
+
+
+class _PiecewiseLinear(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, tensor, xs, ys):
+        segments, weights = _nonlinearity_segments(tensor, xs)
+        clamped_weights = torch.clamp(weights, 0, 1)
+        y1 = ys[segments]
+        output = y1 + clamped_weights * (ys[segments + 1] - y1)
+
+        ctx.save_for_backward(segments, weights, xs, ys)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        segments, weights, xs, ys = ctx.saved_tensors
+        grad_tensor = grad_ys = None
+
+        if ctx.needs_input_grad[0]:
+            slopes = (ys[1:] - ys[:-1]) / (xs[1:] - xs[:-1])
+            inside = (weights >= 0) & (weights <= 1)
+            grad_tensor = torch.where(inside, grad_output * slopes[segments], torch.zeros_like(grad_output))
 
+        if ctx.needs_input_grad[2]:
+            clamped_weights = torch.clamp(weights, 0, 1)
+            flat_segments = segments.reshape(-1)
+            grad_ys = torch.zeros_like(ys)
+            grad_ys.index_add_(0, flat_segments, (grad_output * (1 - clamped_weights)).reshape(-1))
+            grad_ys.index_add_(0, flat_segments + 1, (grad_output * clamped_weights).reshape(-1))
+
+        return grad_tensor, None, grad_ys
+
+
+def _nonlinearity_loop(tensor, xs, ys):
     output = torch.ones_like(tensor, device=tensor.device) * ys[0]
 
     for (x1, x2), (y1, y2) in zip(windowed(xs, 2), windowed(ys, 2)):
@@ -198,6 +353,21 @@ def nonlinearity(tensor, xs, ys):
     return output
 
 
+def nonlinearity(tensor, xs, ys):
+    """piecewise linear function through the points (xs, ys) which is constant outside of xs.
+
+    The segment of each value is found with `torch.bucketize`, so the tensor is processed
+    only a constant number of times independent of the number of points. Gradients are
+    supported for the tensor and `ys`, but not for `xs`.
+    """
+    assert len(xs) == len(ys)
+
+    if xs.requires_grad:
+        return _nonlinearity_loop(tensor, xs, ys)
+
+    return _PiecewiseLinear.apply(tensor, xs.to(tensor.dtype), ys.to(tensor.dtype))
+
+
 class Nonlinearity(nn.Module):
     def __init__(self, xs=None, ys=None, num_values=20, value_scale='linear'):
         super().__init__()
@@ -236,12 +406,59 @@ def zero_grad(model):
             param.grad.zero_()
 
 
+def _average_log_likelihood(log_density, lls, weights=None, valid_shapes=None):
+    # weighted average of per image log likelihoods in bit relative to a uniform model
+    if weights is None:
+        weights = torch.ones_like(lls)
+    weights = len(weights) * weights.view(-1) / weights.sum()
+
+    if valid_shapes is None:
+        ll = torch.mean(weights * lls) + np.log(log_density.shape[-1] * log_density.shape[-2])
+    else:
+        log_areas = torch.log(valid_shapes.to(log_density.dtype)).sum(dim=1)
+        ll = torch.mean(weights * (lls + log_areas))
+
+    return ll / np.log(2)
+
+
 def log_likelihood(log_density, fixation_mask, weights=None):
-    weights = len(weights) * weights.view(-1, 1, 1) / weights.sum()
+    """Average log likelihood of fixations given as a mask of shape (batch_size, height, width)
+    which counts the fixations in each pixel.
 
-    dense_mask = fixation_mask.to_dense()
-    fixation_count = dense_mask.sum(dim=(-1, -2), keepdim=True)
-    ll = torch.mean(
-        weights * torch.sum(log_density * dense_mask, dim=(-1, -2), keepdim=True) / fixation_count
-    )
-    return (ll + np.log(log_density.shape[-1] * log_density.shape[-2])) / np.log(2)
+    For sparse masks, the log densities are only evaluated at the fixated pixels
+    instead of multiplying them with a dense mask.
+    """
+    if fixation_mask.is_sparse:
+        fixation_mask = fixation_mask.coalesce()
+        batch_inds, y_inds, x_inds = fixation_mask.indices()
+        counts = fixation_mask.values().to(log_density.dtype)
+
+        zeros = log_density.new_zeros(log_density.shape[0])
+        ll_sums = zeros.index_add(0, batch_inds, log_density[batch_inds, y_inds, x_inds] * counts)
+        fixation_counts = zeros.index_add(0, batch_inds, counts)
+    else:
+        fixation_mask = fixation_mask.to(log_density.dtype)
+        ll_sums = torch.sum(log_density * fixation_mask, dim=(-1, -2))
+        fixation_counts = fixation_mask.sum(dim=(-1, -2))
+
+    return _average_log_likelihood(log_density, ll_sums / fixation_counts, weights=weights)
+
+
+def log_likelihood_from_indices(log_density, fixation_indices, fixation_counts, weights=None, valid_shapes=None):
+    """Same as `log_likelihood`, but with fixations given as padded flat indices
+
+    `fixation_indices` has shape (batch_size, max_fixations) and contains the
+    flat pixel indices `y * width + x` of the fixations of each image, of which
+    only the first `fixation_counts` entries per image are used.
+
+    For padded batches, `valid_shapes` of shape (batch_size, 2) contains the
+    unpadded height and width of each image, which determine the uniform baseline.
+    """
+    flat_log_density = log_density.reshape(log_density.shape[0], -1)
+    fixation_log_densities = torch.gather(flat_log_density, 1, fixation_indices)
+    valid = torch.arange(fixation_indices.shape[1], device=fixation_indices.device)[None, :] < fixation_counts[:, None]
+    fixation_log_densities = torch.where(valid, fixation_log_densities, torch.zeros_like(fixation_log_densities))
+
+    lls = fixation_log_densities.sum(dim=1) / fixation_counts.to(log_density.dtype)
+
+    return _average_log_likelihood(log_density, lls, weights=weights, valid_shapes=valid_shapes)
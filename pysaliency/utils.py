@@ -1,4 +1,5 @@
 from __future__ import print_function, absolute_import, division
+from collections import OrderedDict, namedtuple
 from collections.abc import Sequence, MutableMapping
 from itertools import chain
 from glob import iglob
@@ -17,6 +18,8 @@ from tempfile import mkdtemp
 
 import numpy as np
 from scipy.interpolate import griddata
+import scipy.sparse
+from scipy.special import logsumexp
 
 from boltons.cacheutils import LRU
 import deprecation
@@ -84,6 +87,208 @@ def lazy_property(fn):
     return _lazyprop
 
 
+def get_nbytes(value):
+    """ memory size of a value in bytes, using `nbytes` for arrays and tensors """
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is None:
+        return _sys.getsizeof(value)
+    return int(nbytes)
+
+
+class SizeBoundedLRU(MutableMapping):
+    """
+    A least recently used mapping that is bounded by the total size
+    of its values in bytes instead of the number of items.
+
+    Values larger than `max_bytes` are not stored at all. The number of
+    hits, misses and evictions is counted in `hit_count`, `miss_count`
+    and `eviction_count`, the current size in `current_bytes`.
+    """
+    def __init__(self, max_bytes, get_size=get_nbytes):
+        self.max_bytes = max_bytes
+        self.get_size = get_size
+        self._data = OrderedDict()
+        self._sizes = {}
+        self.current_bytes = 0
+        self.hit_count = 0
+        self.miss_count = 0
+        self.eviction_count = 0
+
+    def __getitem__(self, key):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.miss_count += 1
+            raise
+        self.hit_count += 1
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            del self[key]
+
+        size = self.get_size(value)
+        if size > self.max_bytes:
+            return
+
+        self._data[key] = value
+        self._sizes[key] = size
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            old_key, _ = self._data.popitem(last=False)
+            self.current_bytes -= self._sizes.pop(old_key)
+            self.eviction_count += 1
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self.current_bytes -= self._sizes.pop(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self.current_bytes = 0
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'items', 'bytes'])
+
+
+class LogSumExpAccumulator(object):
+    """
+    Computes the logsumexp over many arrays without keeping them in memory.
+
+    The accumulator keeps a running maximum and the sum of all added arrays
+    scaled by this maximum, so only two buffers of the size of a single
+    array (plus one temporary buffer while adding) are needed.
+
+    >>> accumulator = LogSumExpAccumulator()
+    >>> for log_density in log_densities:
+    ...     accumulator.add(log_density, log_weight=np.log(0.5))
+    >>> accumulator.result()
+    """
+    def __init__(self):
+        self.maximum = None
+        self.scaled_sum = None
+        self.count = 0
+
+    def add(self, values, log_weight=0.0):
+        """ add `values + log_weight` to the accumulated logsumexp """
+        delta = np.asarray(values, dtype=float) + log_weight
+        if self.maximum is None:
+            self.maximum = np.zeros(delta.shape)
+            self.scaled_sum = np.zeros(delta.shape)
+
+        delta -= self.maximum
+
+        # where nothing finite has been accumulated yet, the values become the new maximum
+        empty = (self.scaled_sum == 0) & (delta > -np.inf)
+        np.add(self.maximum, delta, out=self.maximum, where=empty)
+        np.copyto(self.scaled_sum, 1, where=empty)
+
+        # where the values are larger than the maximum, the sum is rescaled to the new maximum
+        larger = (delta > 0) & ~empty
+        np.add(self.maximum, delta, out=self.maximum, where=larger)
+        np.negative(delta, out=delta, where=larger)
+        with np.errstate(over='ignore'):
+            np.exp(delta, out=delta)
+        np.multiply(self.scaled_sum, delta, out=self.scaled_sum, where=larger)
+        np.add(self.scaled_sum, 1, out=self.scaled_sum, where=larger)
+
+        np.add(self.scaled_sum, delta, out=self.scaled_sum, where=~(larger | empty))
+
+        self.count += 1
+
+    def result(self):
+        """ the logsumexp of all values added so far """
+        with np.errstate(divide='ignore'):
+            return self.maximum + np.log(self.scaled_sum)
+
+
+def _linear_interpolation_matrix(size, target_size):
+    """ sparse matrix of shape (target_size, size) implementing linear interpolation
+    at the same sample positions as `scipy.ndimage.zoom` (with `grid_mode=False`) """
+    if target_size > 1:
+        coordinates = np.arange(target_size) * ((size - 1) / (target_size - 1))
+    else:
+        coordinates = np.zeros(target_size)
+    lower = np.minimum(np.floor(coordinates).astype(int), size - 1)
+    upper = np.minimum(lower + 1, size - 1)
+    weights = coordinates - lower
+
+    rows = np.arange(target_size)
+    return scipy.sparse.csr_matrix(
+        (np.concatenate((1 - weights, weights)), (np.concatenate((rows, rows)), np.concatenate((lower, upper)))),
+        shape=(target_size, size)
+    )
+
+
+def resize_map(value, target_shape):
+    """ Resize a 2d map with separable bilinear interpolation.
+
+    The result is the same as `scipy.ndimage.zoom(value, factors, order=1, mode='nearest')`
+    for the factors resulting in `target_shape`, but faster.
+    """
+    value = np.asarray(value, dtype=float)
+    height, width = value.shape
+    target_height, target_width = target_shape
+    if target_width != width:
+        value = value @ _linear_interpolation_matrix(width, target_width).T.tocsr()
+    if target_height != height:
+        value = _linear_interpolation_matrix(height, target_height) @ value
+    return np.ascontiguousarray(value)
+
+
+def cached_resize(cache, get_key, resize):
+    """ Compute `resize()` or take the result from `cache`.
+
+    `cache` is a mapping, e.g. a `SizeBoundedLRU` which can be shared by several models,
+    or `None` to disable caching. `get_key()` is only called if a cache is used. The
+    cache keeps its own copy of the result, so the returned array can be modified.
+    """
+    if cache is None:
+        return resize()
+
+    key = get_key()
+    try:
+        return cache[key].copy()
+    except KeyError:
+        pass
+
+    value = resize()
+    cache[key] = value.copy()
+    return value
+
+
+def _resize_log_density(log_density, target_shape):
+    log_density = resize_map(log_density, target_shape)
+    log_density -= logsumexp(log_density)
+    return log_density
+
+
+def resize_log_density(log_density, target_shape):
+    """ Resize a log density with `resize_map` and renormalize it. """
+    if tuple(log_density.shape[:2]) == tuple(target_shape):
+        return log_density
+    return _resize_log_density(log_density, target_shape)
+
+
+def resize_saliency_map(saliency_map, target_shape):
+    """ Resize a saliency map with `resize_map`. """
+    if tuple(saliency_map.shape[:2]) == tuple(target_shape):
+        return saliency_map
+    return resize_map(saliency_map, target_shape)
+
+
 class LazyList(Sequence):
     """
     A list-like class that is able to generate it's entries only
@@ -97,7 +302,7 @@ class LazyList(Sequence):
         As `LazyList` stores the generator function, pickling it
         will usually fail. To pickle a `LazyList`, use `dill`.
     """
-    def __init__(self, generator, length, cache=True, pickle_cache=False):
+    def __init__(self, generator, length, cache=True, pickle_cache=False, max_cache_bytes=None):
         """
         Parameters
         ----------
@@ -115,12 +320,34 @@ class LazyList(Sequence):
         @type  pickle_cache: bool, defaults to `False`
         @param pickle_cache: Whether the cache should be saved when
                              pickling the object.
+
+        @type  max_cache_bytes: int, defaults to `None`
+        @param max_cache_bytes: If given, the cache keeps only the least recently
+                                used items up to this total size in bytes.
         """
         self.generator = generator
         self.length = length
         self.cache = cache
         self.pickle_cache = pickle_cache
-        self._cache = {}
+        self.max_cache_bytes = max_cache_bytes
+        self._cache = self._create_cache()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def _create_cache(self):
+        if self.max_cache_bytes is None:
+            return {}
+        return SizeBoundedLRU(self.max_cache_bytes)
+
+    def cache_info(self):
+        """ Return hit, miss and eviction counts and the current number and size of cached items. """
+        return CacheInfo(
+            hits=self.hit_count,
+            misses=self.miss_count,
+            evictions=getattr(self._cache, 'eviction_count', 0),
+            items=len(self._cache),
+            bytes=sum(get_nbytes(value) for value in self._cache.values()) if isinstance(self._cache, dict) else self._cache.current_bytes,
+        )
 
     def __len__(self):
         return self.length
@@ -137,7 +364,9 @@ class LazyList(Sequence):
         if not 0 <= index < self.length:
             raise IndexError(index)
         if index in self._cache:
+            self.hit_count += 1
             return self._cache[index]
+        self.miss_count += 1
         value = self.generator(index)
         if self.cache:
             self._cache[index] = value
@@ -151,9 +380,12 @@ class LazyList(Sequence):
         return state
 
     def __setstate__(self, state):
-        if not '_cache' in state:
-            state['_cache'] = {}
+        state.setdefault('max_cache_bytes', None)
+        state.setdefault('hit_count', 0)
+        state.setdefault('miss_count', 0)
         self.__dict__ = dict(state)
+        if not '_cache' in state:
+            self._cache = self._create_cache()
 
 
 class TemporaryDirectory(object):
@@ -357,19 +589,27 @@ class Cache(MutableMapping):
         Items that have been set before setting `cache_location` won't
         be saved to files!
 
+    `on_change` is called with the key of items that are set or deleted,
+    and with `None` when the cache is cleared.
     """
     def __init__(self, cache_location=None, pickle_cache=False,
-                 memory_cache_size=None):
+                 memory_cache_size=None, on_change=None):
         if memory_cache_size:
             self._cache = LRU(max_size=memory_cache_size)
         else:
             self._cache = {}
         self.cache_location = cache_location
         self.pickle_cache = pickle_cache
+        self.on_change = on_change
+
+    def _changed(self, key):
+        if self.on_change is not None:
+            self.on_change(key)
 
     def clear(self):
         """ Clear memory cache"""
         self._cache = {}
+        self._changed(None)
 
     def filename(self, key):
         return os.path.join(self.cache_location, '{}.npy'.format(key))
@@ -394,6 +634,7 @@ class Cache(MutableMapping):
             filename = self.filename(key)
             np.save(filename, value)
         self._cache[key] = value
+        self._changed(key)
 
     def __delitem__(self, key):
         if self.cache_location is not None:
@@ -401,6 +642,7 @@ class Cache(MutableMapping):
             if os.path.exists(filename):
                 os.remove(filename)
         del self._cache[key]
+        self._changed(key)
 
     def __iter__(self):
         if self.cache_location is not None:
@@ -420,9 +662,12 @@ class Cache(MutableMapping):
         state = dict(self.__dict__)
         if not self.pickle_cache:
             state.pop('_cache')
+        # the owner of the cache sets up the callback again
+        state.pop('on_change', None)
         return state
 
     def __setstate__(self, state):
+        state.setdefault('on_change', None)
         if not '_cache' in state:
             if state.get('memory_cache_size'):
                 state['_cache'] = LRU(max_size=memory_cache_size)
@@ -3,8 +3,11 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import pytest
 import numpy as np
 
+from scipy.special import logsumexp
+
 import pysaliency
-from pysaliency.baseline_utils import fill_fixation_map, KDEGoldModel
+from pysaliency.baseline_utils import (fill_fixation_map, blur_fixation_maps, binned_kde_log_density, bandwidth_sweep,
+                                      GoldModel, KDEGoldModel, CrossvalidatedBaselineModel)
 
 
 @pytest.fixture
@@ -63,3 +66,120 @@ def test_kde_gold_model(stimuli, fixation_trains):
 
     assert kl_div1 < 0.002
     assert kl_div2 < 0.002
+
+
+@pytest.mark.parametrize('sigmas', [(3.0, 3.0), (10.0, 0.0), (9.0, 12.5)])
+def test_blur_fixation_maps_fft(sigmas):
+    rst = np.random.RandomState(42)
+    fixation_maps = np.zeros((3, 50, 60))
+    fixation_maps[0, 10, 20] = 1
+    fixation_maps[1, rst.randint(0, 50, size=20), rst.randint(0, 60, size=20)] = 1
+    fixation_maps[2, 49, 0] = 2
+
+    direct = blur_fixation_maps(fixation_maps, sigmas, method='direct')
+    fft = blur_fixation_maps(fixation_maps, sigmas, method='fft')
+
+    np.testing.assert_allclose(fft, direct, rtol=1e-8, atol=1e-14)
+    np.testing.assert_array_equal(fft == 0, direct == 0)
+
+    np.testing.assert_allclose(blur_fixation_maps(fixation_maps[1], sigmas, method='fft'), direct[1], rtol=1e-8, atol=1e-14)
+
+
+@pytest.mark.parametrize('blur_method', ['direct', 'fft'])
+def test_gold_model_log_densities(stimuli, fixation_trains, blur_method):
+    stimuli = pysaliency.Stimuli(list(stimuli.stimuli) + [np.random.randn(30, 40, 3)])
+    gold_model = GoldModel(stimuli, fixation_trains, bandwidth=0.1, blur_method=blur_method)
+    log_densities = gold_model.log_densities(stimuli, batch_size=1)
+
+    uncached_gold_model = GoldModel(stimuli, fixation_trains, bandwidth=0.1, caching=False)
+    for stimulus, log_density in zip(stimuli, log_densities):
+        np.testing.assert_allclose(log_density, uncached_gold_model.log_density(stimulus), rtol=1e-8)
+        np.testing.assert_allclose(np.exp(log_density).sum(), 1.0)
+        assert log_density is gold_model.log_density(stimulus)
+
+
+@pytest.mark.parametrize('bandwidth', [0.02, 0.1, 0.5])
+def test_crossvalidated_baseline_model(bandwidth):
+    rst = np.random.RandomState(23)
+    stimuli = pysaliency.Stimuli([rst.randn(40, 50, 3) for _ in range(3)] + [rst.randn(30, 20)])
+    fixations = pysaliency.Fixations.FixationsWithoutHistory(
+        x=rst.uniform(0, 19, size=60),
+        y=rst.uniform(0, 29, size=60),
+        t=np.zeros(60),
+        n=rst.randint(0, 4, size=60),
+        subjects=np.zeros(60),
+    )
+
+    model = CrossvalidatedBaselineModel(stimuli, fixations, bandwidth=bandwidth, eps=1e-20)
+    xs, ys = pysaliency.baseline_utils.normalize_fixations(stimuli, fixations)
+
+    for n, stimulus in enumerate(stimuli):
+        height, width = stimulus.size
+        inds = fixations.n != n
+        fixation_map = np.zeros((height, width))
+        fill_fixation_map(fixation_map, np.array([ys[inds]*height, xs[inds]*width]).T)
+        expected_log_density = pysaliency.baseline_utils._fixation_maps_to_log_densities(
+            fixation_map, [bandwidth*height, bandwidth*width], eps=1e-20, method='direct')
+
+        log_density = model.log_density(stimulus)
+        np.testing.assert_array_equal(np.exp(log_density) > 1e-15, np.exp(expected_log_density) > 1e-15)
+        np.testing.assert_allclose(np.exp(log_density), np.exp(expected_log_density), rtol=1e-6, atol=1e-12)
+
+
+@pytest.mark.parametrize('keep_aspect', [False, True])
+def test_kde_gold_model_binned(stimuli, fixation_trains, keep_aspect):
+    stimuli = pysaliency.Stimuli([np.random.randn(40, 40, 3), np.random.randn(40, 60, 3)])
+    bandwidth = 0.1
+    kde_gold_model = KDEGoldModel(stimuli, fixation_trains, bandwidth=bandwidth, keep_aspect=keep_aspect)
+    binned_kde_gold_model = KDEGoldModel(stimuli, fixation_trains, bandwidth=bandwidth, keep_aspect=keep_aspect, method='binned')
+
+    for stimulus in stimuli:
+        log_density = kde_gold_model.log_density(stimulus)
+        binned_log_density = binned_kde_gold_model.log_density(stimulus)
+
+        np.testing.assert_allclose(np.exp(binned_log_density).sum(), 1.0)
+        # few fixations: the kernel is evaluated exactly
+        np.testing.assert_allclose(binned_log_density, log_density, rtol=1e-8)
+
+
+def test_binned_kde_log_density():
+    rst = np.random.RandomState(42)
+    xs = rst.uniform(0, 60, size=200)
+    ys = rst.uniform(0, 40, size=200)
+
+    exact = binned_kde_log_density(xs, ys, (40, 60), [5.0, 6.0], binning=False)
+    binned = binned_kde_log_density(xs, ys, (40, 60), [5.0, 6.0], binning=True)
+
+    exact_density = np.exp(exact - logsumexp(exact))
+    binned_density = np.exp(binned - logsumexp(binned))
+    np.testing.assert_allclose(binned_density, exact_density, rtol=1e-2)
+
+
+def test_bandwidth_sweep():
+    rst = np.random.RandomState(42)
+    stimuli = pysaliency.Stimuli([rst.randn(40, 50, 3) for _ in range(3)] + [rst.randn(30, 20)])
+    fixations = pysaliency.Fixations.FixationsWithoutHistory(
+        x=rst.uniform(0, 19, size=80),
+        y=rst.uniform(0, 29, size=80),
+        t=np.zeros(80),
+        n=rst.randint(0, 4, size=80),
+        subjects=rst.randint(0, 3, size=80),
+    )
+    bandwidths = [0.01, 0.05, 0.3]
+
+    log_likelihoods = bandwidth_sweep(stimuli, fixations, bandwidths, model='baseline', average=None, num_workers=2)
+    for bandwidth, _log_likelihoods in zip(bandwidths, log_likelihoods):
+        model = CrossvalidatedBaselineModel(stimuli, fixations, bandwidth=bandwidth)
+        np.testing.assert_allclose(_log_likelihoods, model.log_likelihoods(stimuli, fixations), rtol=1e-6)
+
+    average_log_likelihoods = bandwidth_sweep(stimuli, fixations, bandwidths, model='gold', average='image')
+    for bandwidth, average_log_likelihood in zip(bandwidths, average_log_likelihoods):
+        expected_log_likelihoods = np.empty(len(fixations))
+        for subject in range(3):
+            inds = fixations.subjects == subject
+            model = GoldModel(stimuli, fixations[~inds], bandwidth=bandwidth)
+            expected_log_likelihoods[inds] = model.log_likelihoods(stimuli, fixations[inds])
+        np.testing.assert_allclose(
+            average_log_likelihood,
+            pysaliency.utils.average_values(expected_log_likelihoods, fixations, average='image'),
+            rtol=1e-6)
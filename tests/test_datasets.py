@@ -488,6 +488,61 @@ def test_file_stimuli_attributes(file_stimuli_with_attributes, tmp_path):
     assert file_stimuli_with_attributes.attributes['some_strings'][:5] == partial_stimuli.attributes['some_strings']
 
 
+def test_file_stimuli_shape_manifest(tmpdir, monkeypatch):
+    filenames = []
+    for i, shape in enumerate([(40, 50, 3), (60, 30), (20, 20, 3)]):
+        filename = tmpdir.join('stimulus_{:04d}.png'.format(i))
+        imwrite(str(filename), np.random.randint(low=0, high=255, size=shape, dtype=np.uint8))
+        filenames.append(str(filename))
+    manifest = str(tmpdir.join('shapes.json'))
+
+    stimuli = pysaliency.FileStimuli(filenames, shape_manifest=manifest, num_workers=2)
+    assert stimuli.shapes == [(40, 50, 3), (60, 30), (20, 20, 3)]
+    assert os.path.exists(manifest)
+
+    def fail(filename):
+        raise AssertionError("image should not be opened")
+
+    monkeypatch.setattr(pysaliency.datasets, 'get_image_shape', fail)
+    cached_stimuli = pysaliency.FileStimuli(filenames, shape_manifest=manifest)
+    assert cached_stimuli.shapes == stimuli.shapes
+
+    # changing a file invalidates its manifest entry
+    monkeypatch.undo()
+    imwrite(filenames[1], np.random.randint(low=0, high=255, size=(10, 70), dtype=np.uint8))
+    updated_stimuli = pysaliency.FileStimuli(filenames, shape_manifest=manifest)
+    assert updated_stimuli.shapes[1] == (10, 70)
+
+
+def test_file_stimuli_lazy_shapes(file_stimuli_with_attributes):
+    lazy_stimuli = pysaliency.FileStimuli(file_stimuli_with_attributes.filenames, lazy_shapes=True)
+    assert list(lazy_stimuli.shapes) == file_stimuli_with_attributes.shapes
+    assert list(lazy_stimuli[2:5].sizes) == file_stimuli_with_attributes.sizes[2:5]
+
+
+@pytest.mark.parametrize('compression', [None, 'lzf'])
+def test_packed_stimuli(stimuli_with_attributes, tmp_path, compression):
+    filename = tmp_path / 'stimuli.hdf5'
+    stimuli_with_attributes.to_packed_hdf5(str(filename), compression=compression, chunk_size=1000)
+
+    new_stimuli = pysaliency.read_hdf5(str(filename))
+
+    assert isinstance(new_stimuli, pysaliency.PackedStimuli)
+    assert (new_stimuli.data_offset is not None) == (compression is None)
+    assert new_stimuli.shapes == stimuli_with_attributes.shapes
+    for stimulus, new_stimulus in zip(stimuli_with_attributes.stimuli, new_stimuli.stimuli):
+        np.testing.assert_array_equal(stimulus, new_stimulus)
+    assert new_stimuli.stimulus_ids[3] == stimuli_with_attributes.stimulus_ids[3]
+    np.testing.assert_array_equal(stimuli_with_attributes.attributes['dva'], new_stimuli.attributes['dva'])
+    np.testing.assert_array_equal(stimuli_with_attributes.attributes['some_strings'], new_stimuli.attributes['some_strings'])
+
+    reloaded_stimuli = pickle.loads(dill.dumps(new_stimuli))
+    np.testing.assert_array_equal(reloaded_stimuli.stimuli[5], stimuli_with_attributes.stimuli[5])
+
+    partial_stimuli = new_stimuli[2:4]
+    np.testing.assert_array_equal(partial_stimuli.stimuli[1], stimuli_with_attributes.stimuli[3])
+
+
 def test_concatenate_stimuli_with_attributes(stimuli_with_attributes, file_stimuli_with_attributes):
     concatenated_stimuli = pysaliency.datasets.concatenate_stimuli([stimuli_with_attributes, file_stimuli_with_attributes])
 
@@ -516,5 +571,95 @@ def test_create_subset_fixations(file_stimuli_with_attributes, fixation_trains,
     np.testing.assert_array_equal(sub_fixations.x, fixations.x[np.isin(fixations.n, stimulus_indices)])
 
 
+def test_create_subset_remaps_indices(file_stimuli_with_attributes, fixation_trains):
+    sub_stimuli, sub_fixations = pysaliency.datasets.create_subset(file_stimuli_with_attributes, fixation_trains, [1, 0])
+
+    np.testing.assert_array_equal(sub_fixations.train_ns, 1 - fixation_trains.train_ns)
+    np.testing.assert_array_equal(sub_fixations.n, 1 - fixation_trains.n)
+    np.testing.assert_array_equal(sub_fixations.x_hist, fixation_trains.x_hist)
+    np.testing.assert_array_equal(sub_fixations.lengths, fixation_trains.lengths)
+
+
+@pytest.fixture
+def shuffling_stimuli_and_fixation_trains():
+    stimuli = pysaliency.Stimuli([np.zeros((40, 50)), np.zeros((20, 100)), np.zeros((40, 50))])
+    xs_trains = [[0, 1, 2], [2, 2], [1, 5, 3], [4, 6, 8, 10], [7]]
+    ys_trains = [[10, 11, 12], [12, 12], [1, 5, 3], [4, 6, 8, 10], [7]]
+    ts_trains = [[0, 1, 2], [0, 1], [0, 1, 2], [0, 1, 2, 3], [0]]
+    ns = [0, 0, 1, 2, 1]
+    subjects = [0, 1, 1, 0, 2]
+    fixations = pysaliency.FixationTrains.from_fixation_trains(xs_trains, ys_trains, ts_trains, ns, subjects)
+    return stimuli, fixations
+
+
+def test_shuffle_fixations(shuffling_stimuli_and_fixation_trains):
+    stimuli, fixations = shuffling_stimuli_and_fixation_trains
+    shuffled = fixations.shuffle_fixations(stimuli)
+
+    virtual = pysaliency.datasets.ShuffledNonfixations(fixations, stimuli)
+    offset = 0
+    for n in range(len(stimuli)):
+        inds = np.nonzero(fixations.n != n)[0]
+        x_factors = stimuli.sizes[n][1] / np.array([stimuli.sizes[k][1] for k in fixations.n[inds]])
+        y_factors = stimuli.sizes[n][0] / np.array([stimuli.sizes[k][0] for k in fixations.n[inds]])
+
+        np.testing.assert_array_equal(shuffled.n[offset:offset + len(inds)], n)
+        np.testing.assert_allclose(shuffled.x[offset:offset + len(inds)], fixations.x[inds] * x_factors)
+        np.testing.assert_allclose(shuffled.y_hist[offset:offset + len(inds)], fixations.y_hist[inds] * y_factors[:, np.newaxis])
+
+        xs, ys = virtual.coordinates_for_image(n)
+        np.testing.assert_allclose(xs, fixations.x[inds] * x_factors)
+        np.testing.assert_allclose(ys, fixations.y[inds] * y_factors)
+        np.testing.assert_allclose(virtual.nonfixations_for_image(n).x_hist, shuffled.x_hist[offset:offset + len(inds)])
+        offset += len(inds)
+
+    assert offset == len(shuffled.x)
+
+
+def test_shuffle_fixations_images_without_fixations():
+    stimuli = pysaliency.Stimuli([np.zeros((40, 50)), np.zeros((20, 25)), np.zeros((30, 30))])
+    fixations = pysaliency.FixationTrains.from_fixation_trains(
+        [[1, 2], [3, 4]], [[5, 6], [7, 8]], [[0, 1], [0, 1]], ns=[0, 1], subjects=[0, 0],
+    )
+
+    # images after the last image with fixations don't get nonfixations, as before
+    for shuffled in [fixations.shuffle_fixations(), fixations.shuffle_fixations(stimuli)]:
+        np.testing.assert_array_equal(shuffled.n, [0, 0, 1, 1])
+    np.testing.assert_allclose(fixations.shuffle_fixations(stimuli).x, [6.0, 8.0, 0.5, 1.0])
+
+
+def test_generate_full_nonfixations(shuffling_stimuli_and_fixation_trains):
+    stimuli, fixations = shuffling_stimuli_and_fixation_trains
+    nonfixations = fixations.generate_full_nonfixations()
+
+    expected_train_indices = [2, 3, 4, 0, 1, 3, 0, 1, 2, 4]
+    np.testing.assert_array_equal(nonfixations.train_ns, [0, 0, 0, 1, 1, 1, 2, 2, 2, 2])
+    np.testing.assert_array_equal(nonfixations.train_xs, fixations.train_xs[expected_train_indices])
+    np.testing.assert_array_equal(nonfixations.train_subjects, fixations.train_subjects[expected_train_indices])
+    assert fixations.generate_full_nonfixations() is nonfixations
+    np.testing.assert_array_equal(fixations.shuffle_fixation_trains().train_ys, nonfixations.train_ys)
+
+
+def test_generate_nonfixation_partners(shuffling_stimuli_and_fixation_trains):
+    stimuli, fixations = shuffling_stimuli_and_fixation_trains
+    partners = fixations.generate_nonfixation_partners(seed=1)
+
+    np.testing.assert_array_equal(partners.n, fixations.n)
+    np.testing.assert_array_equal(np.isnan(partners.train_xs), np.isnan(fixations.train_xs))
+    for x, y, t, n in zip(partners.x, partners.y, partners.t, partners.n):
+        other_fixations = np.nonzero(fixations.n != n)[0]
+        matches = (fixations.x[other_fixations] == x) & (fixations.y[other_fixations] == y) & (fixations.t[other_fixations] == t)
+        assert matches.any()
+
+    # same random stream as drawing the partners one by one
+    rs = np.random.RandomState(1)
+    expected_xs = fixations.train_xs.copy()
+    for train_index, n in enumerate(fixations.train_ns):
+        other_fixations = np.nonzero(fixations.n != n)[0]
+        for i in range(int((~np.isnan(fixations.train_xs[train_index])).sum())):
+            expected_xs[train_index, i] = fixations.x[rs.choice(other_fixations)]
+    np.testing.assert_array_equal(partners.train_xs, expected_xs)
+
+
 if __name__ == '__main__':
     unittest.main()
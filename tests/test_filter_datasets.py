@@ -294,3 +294,21 @@ def test_stratified_crossval_splits_multiple_attributes(many_stimuli, crossval_f
     assert sum(len(f.x) for f in train_fixations) == (crossval_folds - val_folds - test_folds) * len(fixations.x)
 
     assert len(train_stimuli) == crossval_folds
+
+
+@pytest.mark.parametrize('stratified_attributes', [None, ['category']])
+def test_iterate_crossvalidation_matches_crossval_split(many_stimuli, stratified_attributes):
+    fixations = pysaliency.UniformModel().sample(many_stimuli, 10)
+
+    folds = list(filter_datasets.iterate_crossvalidation(many_stimuli, fixations, crossval_folds=10, val_folds=2, test_folds=1, stratified_attributes=stratified_attributes))
+    assert len(folds) == 10
+
+    for fold_no in [0, 7]:
+        for split_no, split in enumerate(['train', 'val', 'test']):
+            stimuli, split_fixations = filter_datasets.crossval_split(
+                many_stimuli, fixations, crossval_folds=10, fold_no=fold_no, val_folds=2, test_folds=1,
+                split=split, stratified_attributes=stratified_attributes)
+
+            assert list(folds[fold_no][2 * split_no].stimulus_ids) == list(stimuli.stimulus_ids)
+            np.testing.assert_array_equal(folds[fold_no][2 * split_no + 1].n, split_fixations.n)
+            np.testing.assert_array_equal(folds[fold_no][2 * split_no + 1].x, split_fixations.x)
@@ -1,7 +1,10 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import pickle
+
 import pytest
 import numpy as np
+from scipy.special import logsumexp
 
 import pysaliency
 
@@ -76,8 +79,230 @@ def test_shuffled_baseline_model(stimuli, library):
     assert model.log_density(stimuli[0]).shape == shuffled_model.log_density(stimuli[0]).shape
 
 
+class RandomSaliencyModel(pysaliency.Model):
+    def _log_density(self, stimulus):
+        rst = np.random.RandomState(int(abs(stimulus[0, 0, 0]) * 1000))
+        log_density = 5 * rst.randn(stimulus.shape[0], stimulus.shape[1])
+        return log_density - logsumexp(log_density)
+
+
+def test_shuffled_baseline_model_leave_one_out():
+    rst = np.random.RandomState(42)
+    stimuli = pysaliency.Stimuli([rst.randn(height, width, 3) for height, width in
+                                  [(40, 40), (30, 50), (40, 40), (20, 60), (35, 35)]])
+    model = RandomSaliencyModel()
+    shuffled_model = pysaliency.models.ShuffledBaselineModel(model, stimuli, compute_size=(30, 30), library='numpy')
+
+    resized_predictions = [shuffled_model._resize_prediction(model.log_density(s), (30, 30)) for s in stimuli]
+
+    for n, stimulus in enumerate(stimuli):
+        others = [p for k, p in enumerate(resized_predictions) if k != n]
+        expected = shuffled_model._resize_prediction(
+            logsumexp(np.array(others), axis=0) - np.log(len(others)),
+            stimulus.size,
+        )
+        np.testing.assert_allclose(shuffled_model.log_density(stimulus), expected, rtol=1e-10)
+
+    # stimuli not contained in the model stimuli get the full mixture
+    other_stimulus = rst.randn(30, 30, 3)
+    np.testing.assert_allclose(
+        shuffled_model.log_density(other_stimulus),
+        logsumexp(np.array(resized_predictions), axis=0) - np.log(len(stimuli)),
+        rtol=1e-10
+    )
+
+
+def test_resize_cache_shared_by_models():
+    rst = np.random.RandomState(42)
+    stimuli = pysaliency.Stimuli([rst.randn(height, width, 3) for height, width in [(40, 40), (30, 50), (40, 40)]])
+    model = RandomSaliencyModel()
+    resize_cache = pysaliency.utils.SizeBoundedLRU(2**20)
+
+    uncached_model = pysaliency.models.ShuffledSimpleBaselineModel(model, stimuli, compute_size=(30, 30), library='numpy')
+    cached_models = [
+        pysaliency.models.ShuffledSimpleBaselineModel(model, stimuli, compute_size=(30, 30), library='numpy',
+                                                      resize_cache=resize_cache, caching=False)
+        for _ in range(2)
+    ]
+
+    for cached_model in cached_models:
+        for stimulus in stimuli:
+            np.testing.assert_allclose(cached_model.log_density(stimulus), uncached_model.log_density(stimulus))
+
+    # the resized parent predictions are shared, the resized average predictions are specific to each model
+    assert len(resize_cache) == len(stimuli) + 2 * 2
+    assert resize_cache.hit_count >= len(stimuli)
+
+    # cached results can be modified by the caller
+    prediction = cached_models[0].log_density(stimuli[0])
+    prediction[:] = 0
+    np.testing.assert_allclose(cached_models[0].log_density(stimuli[0]), uncached_model.log_density(stimuli[0]))
+
+    shuffled_model = pysaliency.models.ShuffledBaselineModel(model, stimuli, compute_size=(30, 30), library='numpy',
+                                                             resize_cache=resize_cache)
+    hit_count = resize_cache.hit_count
+    shuffled_model.log_density(stimuli[0])
+    assert resize_cache.hit_count == hit_count + len(stimuli)
+
+    fixed_size_model = pysaliency.models.FixedStimulusSizeModel(30, model, resize_cache=resize_cache, caching=False)
+    expected = pysaliency.models.FixedStimulusSizeModel(30, model).log_density(stimuli[0])
+    for _ in range(2):
+        hit_count = resize_cache.hit_count
+        np.testing.assert_allclose(fixed_size_model.log_density(stimuli[0]), expected)
+    assert resize_cache.hit_count == hit_count + 1
+
+
+@pytest.mark.parametrize('caching', [True, False])
+def test_log_densities_ignores_unknown_kwargs(stimuli, caching):
+    model = pysaliency.UniformModel(caching=caching)
+
+    log_densities = model.log_densities(stimuli, batch_size=2)
+
+    assert len(log_densities) == len(stimuli)
+    for stimulus, log_density in zip(stimuli, log_densities):
+        np.testing.assert_allclose(log_density, model.log_density(stimulus))
+
+
 def test_sampling(stimuli):
     model = GaussianSaliencyModel()
     fixations = model.sample(stimuli, train_counts=10, lengths=3)
     assert len(fixations.train_xs) == len(stimuli) * 10
     assert len(fixations.x) == len(stimuli) * 10 * 3
+
+
+def test_sampling_matches_sampling_trains_one_by_one(stimuli):
+    model = GaussianSaliencyModel()
+    lengths = [[1, 4, 2], [3, 0, 5]]
+
+    fixations = model.sample(stimuli, train_counts=[3, 3], lengths=lengths, stimulus_indices=[1, 0],
+                             rst=np.random.RandomState(42))
+    expected_fixations = pysaliency.models.ScanpathModel.sample(
+        model, stimuli, train_counts=[3, 3], lengths=lengths, stimulus_indices=[1, 0],
+        rst=np.random.RandomState(42))
+
+    np.testing.assert_array_equal(fixations.train_xs, expected_fixations.train_xs)
+    np.testing.assert_array_equal(fixations.train_ys, expected_fixations.train_ys)
+    np.testing.assert_array_equal(fixations.train_ts, expected_fixations.train_ts)
+    np.testing.assert_array_equal(fixations.train_ns, expected_fixations.train_ns)
+    np.testing.assert_array_equal(fixations.x, expected_fixations.x)
+    np.testing.assert_array_equal(fixations.n, expected_fixations.n)
+
+
+class NextPixelScanpathModel(pysaliency.models.ScanpathModel):
+    """ deterministic scanpath model: each fixation is one pixel to the right of the last one """
+    def conditional_log_density(self, stimulus, x_hist, y_hist, t_hist, attributes=None, out=None):
+        stimulus = pysaliency.datasets.as_stimulus(stimulus)
+        log_density = np.full(stimulus.size, -np.inf)
+        if len(x_hist):
+            log_density[int(y_hist[-1]), int(x_hist[-1]) + 1] = 0
+        else:
+            log_density[3, 0] = 0
+        return log_density
+
+
+def test_sample_scanpaths_in_lockstep(stimuli):
+    model = NextPixelScanpathModel()
+
+    x_hists = [[], [5, 6], [10]]
+    y_hists = [[], [2, 7], [20]]
+    t_hists = [[], [0, 1], [0]]
+
+    log_densities = model.conditional_log_densities_batch(stimuli[0], x_hists, y_hists, t_hists)
+    assert log_densities.shape == (3, ) + stimuli[0].size
+    np.testing.assert_allclose(log_densities[1], model.conditional_log_density(stimuli[0], [5, 6], [2, 7], [0, 1]))
+
+    xs, ys, ts = model.sample_scanpaths(stimuli[0], x_hists, y_hists, t_hists, [3, 1, 2], batch_size=2)
+    assert xs == [[0, 1, 2], [5, 6, 7], [10, 11, 12]]
+    assert ys == [[3, 3, 3], [2, 7, 7], [20, 20, 20]]
+    assert ts == [[0, 1, 2], [0, 1, 2], [0, 1, 2]]
+
+    for batched in [False, True]:
+        fixations = model.sample(stimuli, train_counts=2, lengths=[3, 4], batched=batched)
+        np.testing.assert_array_equal(fixations.train_xs[2], [0, 1, 2, 3])
+        np.testing.assert_array_equal(fixations.train_ys[0], [3, 3, 3, np.nan])
+
+
+class GaussianScanpathModel(pysaliency.models.ScanpathModel):
+    """ scanpath model with the (history independent) density of `GaussianSaliencyModel` """
+    def conditional_log_density(self, stimulus, x_hist, y_hist, t_hist, attributes=None, out=None):
+        return GaussianSaliencyModel(caching=False).log_density(stimulus)
+
+
+def test_scanpath_model_sample_keeps_random_stream(stimuli):
+    model = GaussianScanpathModel()
+    fixations = model.sample(stimuli, train_counts=2, lengths=3, rst=np.random.RandomState(42))
+
+    rst = np.random.RandomState(42)
+    for train_index, n in enumerate(fixations.train_ns):
+        xs, ys, ts = model.sample_scanpath(stimuli[n], [], [], [], 3, rst=rst)
+        np.testing.assert_array_equal(fixations.train_xs[train_index], xs)
+        np.testing.assert_array_equal(fixations.train_ys[train_index], ys)
+
+    batched_fixations = model.sample(stimuli, train_counts=2, lengths=3, rst=np.random.RandomState(42), batched=True)
+    assert batched_fixations.train_xs.shape == fixations.train_xs.shape
+
+
+@pytest.mark.parametrize('sampler_class', [pysaliency.models.CDFSampler, pysaliency.models.AliasSampler])
+def test_samplers(sampler_class):
+    densities = np.array([
+        [0.0, 0.1, 0.2],
+        [0.3, 0.0, 0.4],
+    ])
+    sampler = sampler_class(densities)
+    xs, ys = sampler.sample(100000, rst=np.random.RandomState(42))
+
+    counts = np.zeros_like(densities)
+    np.add.at(counts, (ys, xs), 1)
+    assert counts[0, 0] == counts[1, 1] == 0
+    np.testing.assert_allclose(counts / counts.sum(), densities, atol=5e-3)
+
+    log_sampler = pysaliency.models.LogCDFSampler(np.log(densities))
+    xs, ys = log_sampler.sample(100000, rst=np.random.RandomState(42))
+    counts = np.zeros_like(densities)
+    np.add.at(counts, (ys, xs), 1)
+    np.testing.assert_allclose(counts / counts.sum(), densities, atol=5e-3)
+
+
+def test_model_sampler_cache(stimuli):
+    model = GaussianSaliencyModel()
+    sampler = model.sampler(stimuli[0])
+    assert model.sampler(stimuli[0]) is sampler
+    assert model.sampler(stimuli[0], method='alias') is not sampler
+
+    x, y = sampler.sample(rst=np.random.RandomState(1))
+    expected_x, expected_y = pysaliency.models.sample_from_image(np.exp(model.log_density(stimuli[0])), rst=np.random.RandomState(1))
+    assert (x, y) == (expected_x, expected_y)
+
+    fixations = model.sample(stimuli, train_counts=3, lengths=4, sampling_method='alias')
+    assert len(fixations.x) == len(stimuli) * 3 * 4
+
+    # samplers are invalidated with the log density cache and not pickled
+    model._cache.clear()
+    assert model.sampler(stimuli[0]) is not sampler
+
+    sampler = model.sampler(stimuli[0])
+    other_sampler = model.sampler(stimuli[1])
+    model._cache[stimuli.stimulus_ids[0]] = model._cache[stimuli.stimulus_ids[0]]
+    assert model.sampler(stimuli[0]) is not sampler
+    assert model.sampler(stimuli[1]) is other_sampler
+
+    model._cache = pysaliency.utils.Cache()
+    assert len(model._sampler_cache) == 0
+    assert model.sampler(stimuli[1]) is not other_sampler
+
+    unpickled_model = pickle.loads(pickle.dumps(model))
+    assert '_sampler_cache' not in model.__getstate__()
+    assert len(unpickled_model._sampler_cache) == 0
+    np.testing.assert_array_equal(unpickled_model.sampler(stimuli[0]).cumsums, model.sampler(stimuli[0]).cumsums)
+
+
+def test_model_sampler_cache_disk_backed(stimuli, tmp_path):
+    # reloading the log density from disk must not invalidate the sampler
+    model = GaussianSaliencyModel(cache_location=str(tmp_path), memory_cache_size=1)
+    sampler = model.sampler(stimuli[0])
+    model.log_density(stimuli[1])
+    assert stimuli.stimulus_ids[0] not in model._cache._cache
+    assert model.sampler(stimuli[0]) is sampler
+
+    model._cache.clear()
+    assert model.sampler(stimuli[0]) is not sampler
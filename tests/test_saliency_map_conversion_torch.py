@@ -1,8 +1,17 @@
+import pickle
+
 import numpy as np
 import pytest
+import torch
 
+from pysaliency.models import SaliencyMapNormalizingModel
 from pysaliency.saliency_map_conversion import optimize_for_information_gain
+from pysaliency.saliency_map_conversion_torch import (SaliencyMapProcessing, SaliencyMapProcessingModel, optimize_saliency_map_conversion,
+                                                        _validation_split)
+from pysaliency.torch_datasets import ImageDataset, ImageDatasetSampler, FixationIndicesTransform, collate_fixation_indices
+from pysaliency.torch_utils import log_likelihood_from_indices
 from pysaliency import Stimuli, Fixations, GaussianSaliencyMapModel
+from pysaliency.datasets import create_subset
 
 
 @pytest.mark.parametrize("optimize", [
@@ -45,3 +54,155 @@ def test_optimize_for_IG(optimize):
     ]
 
     assert smc
+
+
+def test_padded_batches_match_unpadded_images():
+    rst = np.random.RandomState(seed=42)
+    stimuli = Stimuli([rst.rand(30, 40), rst.rand(25, 35), rst.rand(28, 33)])
+    fixations = Fixations.create_without_history(
+        x=rst.randint(0, 33, size=30),
+        y=rst.randint(0, 25, size=30),
+        n=np.repeat([0, 1, 2], 10),
+    )
+    models = {'prediction_0000': GaussianSaliencyMapModel(width=0.3)}
+    dataset = ImageDataset(stimuli, fixations, models=models, transform=FixationIndicesTransform())
+
+    sampler = ImageDatasetSampler(dataset, batch_size=3, shuffle=False, bucket_granularity=64)
+    assert len(sampler) == 1
+
+    batch = collate_fixation_indices([dataset[k] for k in list(sampler)[0]])
+    assert batch['prediction_0000'].shape == (3, 30, 40)
+
+    processing = SaliencyMapProcessing(blur_radius=2.0)
+    with torch.no_grad():
+        processing.centerbias.nonlinearity.ys.copy_(torch.linspace(2.0, 0.5, 12))
+        log_density = processing(batch['prediction_0000'][:, None], valid_shapes=batch['valid_shape'])[:, 0]
+        padded_ll = log_likelihood_from_indices(
+            log_density, batch['fixation_indices'], batch['fixation_counts'],
+            weights=batch['weight'], valid_shapes=batch['valid_shape'],
+        )
+
+        lls = []
+        for row, k in enumerate(list(sampler)[0]):
+            item = collate_fixation_indices([dataset[k]])
+            single_log_density = processing(item['prediction_0000'][:, None])[:, 0]
+            height, width = single_log_density.shape[1:]
+            np.testing.assert_allclose(log_density[row, :height, :width].numpy(), single_log_density[0].numpy(), rtol=1e-5)
+            assert torch.all(torch.isinf(log_density[row, height:])) and torch.all(torch.isinf(log_density[row, :, width:]))
+
+            lls.append(log_likelihood_from_indices(
+                single_log_density, item['fixation_indices'], item['fixation_counts'], weights=item['weight'],
+            ).item())
+
+    np.testing.assert_allclose(padded_ll.item(), np.mean(lls), rtol=1e-5)
+
+
+def test_saliency_map_processing_model_log_densities():
+    rst = np.random.RandomState(seed=42)
+    stimuli = Stimuli([rst.rand(30, 40), rst.rand(25, 35), rst.rand(30, 40), rst.rand(30, 40)])
+
+    model = SaliencyMapProcessingModel(
+        GaussianSaliencyMapModel(width=0.3),
+        saliency_min=0.0,
+        saliency_max=1.0,
+        blur_radius=3.0,
+        device=torch.device('cpu'),
+        num_threads=1,
+        caching=False,
+    )
+    with torch.no_grad():
+        model.saliency_map_processing.centerbias.nonlinearity.ys.copy_(torch.linspace(2.0, 0.5, 12))
+
+    num_threads = torch.get_num_threads()
+    log_densities = model.log_densities(stimuli, batch_size=2)
+    assert torch.get_num_threads() == num_threads
+
+    for stimulus, log_density in zip(stimuli, log_densities):
+        saliency_map = model.normalized_saliency_map_model.saliency_map(stimulus)
+        expected = model.saliency_map_processing(torch.tensor(saliency_map[np.newaxis, np.newaxis]))[0, 0].detach().numpy()
+        np.testing.assert_allclose(log_density, expected, rtol=1e-6)
+
+    # the cached centerbias is updated when the parameters change
+    with torch.no_grad():
+        model.saliency_map_processing.centerbias.alpha.fill_(0.5)
+    saliency_map = model.normalized_saliency_map_model.saliency_map(stimuli[0])
+    expected = model.saliency_map_processing(torch.tensor(saliency_map[np.newaxis, np.newaxis]))[0, 0].detach().numpy()
+    np.testing.assert_allclose(model.log_density(stimuli[0]), expected, rtol=1e-6)
+
+    # ... and when the centerbias module is replaced
+    centerbias = SaliencyMapProcessing(num_centerbias=12).centerbias
+    with torch.no_grad():
+        centerbias.nonlinearity.ys.copy_(torch.linspace(0.5, 2.0, 12))
+        centerbias.alpha.fill_(0.5)
+    model.saliency_map_processing.centerbias = centerbias
+    expected = model.saliency_map_processing(torch.tensor(saliency_map[np.newaxis, np.newaxis]))[0, 0].detach().numpy()
+    np.testing.assert_allclose(model.log_density(stimuli[0]), expected, rtol=1e-6)
+
+    # models pickled before the centerbias cache and `num_threads` existed
+    state = model.__getstate__()
+    assert '_centerbias_cache' not in state
+    del state['num_threads']
+    unpickled_model = SaliencyMapProcessingModel.__new__(SaliencyMapProcessingModel)
+    unpickled_model.__setstate__(pickle.loads(pickle.dumps(state)))
+    assert unpickled_model.num_threads is None
+    np.testing.assert_allclose(unpickled_model.log_density(stimuli[0]), expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('materialize_batches', [False, True])
+@pytest.mark.parametrize('method', ['adam', 'lbfgs'])
+def test_optimize_stochastic(method, materialize_batches):
+    model = GaussianSaliencyMapModel(width=0.3)
+    rst = np.random.RandomState(seed=42)
+    stimuli = Stimuli([rst.rand(40, 50, 3) for _ in range(10)])
+    fixations = SaliencyMapNormalizingModel(model).sample(stimuli, 50, rst=rst)
+
+    smc, res = optimize_saliency_map_conversion(
+        model,
+        stimuli,
+        fixations,
+        method=method,
+        blur_radius=2.0,
+        batch_size=2,
+        maxiter=4,
+        patience=2,
+        learning_rate=0.05 if method == 'adam' else 0.5,
+        materialize_batches=materialize_batches,
+        return_optimization_result=True,
+    )
+
+    assert res.status in [0, 9]
+    assert res.success == (res.status == 0)
+    assert 1 <= res.nit <= 4
+
+    # projection keeps the parameters feasible
+    processing = smc.saliency_map_processing
+    assert torch.all(processing.nonlinearity.ys[1:] >= processing.nonlinearity.ys[:-1])
+    assert 0 < processing.centerbias.alpha.item() < 1
+    np.testing.assert_allclose(processing.centerbias.nonlinearity.ys.sum().item(), np.linspace(1.1, 0.9, 12).sum(), rtol=1e-5)
+
+    # fitting improves over the initial parameters on the fit data
+    initial = optimize_saliency_map_conversion(model, stimuli, fixations, method='adam', blur_radius=2.0, maxiter=0)
+    assert smc.log_likelihood(stimuli, fixations) > initial.log_likelihood(stimuli, fixations)
+
+
+@pytest.mark.parametrize('maxiter,learning_rate,expected_status', [(1, 0.05, 9), (10, 0.0, 0)])
+def test_optimize_stochastic_result(maxiter, learning_rate, expected_status):
+    model = GaussianSaliencyMapModel(width=0.3)
+    rst = np.random.RandomState(seed=42)
+    stimuli = Stimuli([rst.rand(40, 50, 3) for _ in range(10)])
+    fixations = SaliencyMapNormalizingModel(model).sample(stimuli, 50, rst=rst)
+
+    smc, res = optimize_saliency_map_conversion(
+        model, stimuli, fixations, method='adam', blur_radius=2.0, batch_size=2,
+        maxiter=maxiter, patience=2, learning_rate=learning_rate, return_optimization_result=True,
+    )
+
+    # running out of epochs is not reported as success
+    assert res.status == expected_status
+    assert res.success == (expected_status == 0)
+
+    # `fun` is the loss (in bit relative to a uniform model) on the fit data, i.e. the stimuli not held out for validation
+    train_indices, validation_indices = _validation_split(len(stimuli), 0.1)
+    train_stimuli, train_fixations = create_subset(stimuli, fixations, train_indices)
+    log_likelihood = smc.log_likelihood(train_stimuli, train_fixations, average='image')
+    np.testing.assert_allclose(res.fun, -(log_likelihood + np.log(40 * 50)) / np.log(2), rtol=1e-4)
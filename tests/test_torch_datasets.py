@@ -0,0 +1,161 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+import pysaliency
+from pysaliency.torch_datasets import (
+    FixationIndicesTransform,
+    ImageDataset,
+    ImageDatasetSampler,
+    MaterializedBatches,
+    collate_fixation_indices,
+    x_y_to_sparse_indices,
+)
+
+
+@pytest.fixture
+def stimuli_and_fixations():
+    rst = np.random.RandomState(seed=42)
+    stimuli = pysaliency.Stimuli([
+        rst.randint(0, 255, size=(40, 30, 3)).astype(np.uint8),
+        rst.randint(0, 255, size=(40, 30)).astype(np.uint8),
+        rst.randint(0, 255, size=(20, 30, 3)).astype(np.uint8),
+    ])
+    fixations = pysaliency.Fixations.create_without_history(
+        x=rst.randint(0, 30, size=20),
+        y=rst.randint(0, 20, size=20),
+        n=np.array([0] * 8 + [2] * 12),
+    )
+    return stimuli, fixations
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'cache_max_bytes': 40000},
+    {'image_dtype': np.uint8},
+    {'image_dtype': np.float16, 'cached': False},
+    {'cache_directory': True},
+])
+def test_image_dataset_caching(stimuli_and_fixations, tmp_path, options):
+    stimuli, fixations = stimuli_and_fixations
+    models = {'prediction': pysaliency.GaussianSaliencyMapModel()}
+
+    options = dict(options)
+    if options.get('cache_directory'):
+        options['cache_directory'] = str(tmp_path / 'cache')
+
+    reference_dataset = ImageDataset(stimuli, fixations, models=models, cached=False)
+    dataset = ImageDataset(stimuli, fixations, models=models, **options)
+
+    # items can be loaded repeatedly and in any order
+    for key in [0, 1, 2, 0, 2, 1, 0]:
+        expected = reference_dataset[key]
+        item = dataset[key]
+
+        assert item['image'].dtype == np.float32
+        np.testing.assert_allclose(item['image'], expected['image'])
+        np.testing.assert_allclose(item['prediction'], expected['prediction'])
+        np.testing.assert_array_equal(item['x'], expected['x'])
+        np.testing.assert_array_equal(item['y'], expected['y'])
+        assert item['weight'] == expected['weight']
+
+    if 'cache_max_bytes' in options:
+        assert dataset._cache.current_bytes <= options['cache_max_bytes']
+        assert dataset._cache.eviction_count > 0
+
+    if 'cache_directory' in options:
+        filenames = sorted(os.listdir(options['cache_directory']))
+        second_dataset = ImageDataset(stimuli, fixations, models=models, **options)
+        np.testing.assert_allclose(second_dataset[1]['prediction'], reference_dataset[1]['prediction'])
+        assert sorted(os.listdir(options['cache_directory'])) == filenames
+
+
+def test_image_dataset_cache_directory_reuse(stimuli_and_fixations, tmp_path):
+    stimuli, fixations = stimuli_and_fixations
+    cache_directory = str(tmp_path / 'cache')
+    dataset = ImageDataset(stimuli, fixations, models={'prediction': pysaliency.GaussianSaliencyMapModel()},
+                           cache_directory=cache_directory)
+    dataset[0]
+
+    # other stimuli, models or image dtypes don't load the stored arrays
+    other_stimuli = pysaliency.Stimuli([stimuli.stimuli[1], stimuli.stimuli[0], stimuli.stimuli[2]])
+    for other_dataset in [
+        ImageDataset(other_stimuli, fixations, cache_directory=cache_directory),
+        ImageDataset(stimuli, fixations, models={'prediction': pysaliency.UniformModel()}, cache_directory=cache_directory),
+        ImageDataset(stimuli, fixations, image_dtype=np.float16, cache_directory=cache_directory),
+    ]:
+        reference_dataset = ImageDataset(other_dataset.stimuli, fixations, models=other_dataset.models,
+                                         image_dtype=other_dataset.image_dtype, cached=False)
+        item = other_dataset[0]
+        expected = reference_dataset[0]
+        for name in ['image'] + list(other_dataset.models):
+            assert item[name].shape == expected[name].shape
+            np.testing.assert_allclose(item[name], expected[name])
+
+
+def test_image_dataset_integer_image_dtype(stimuli_and_fixations):
+    stimuli, fixations = stimuli_and_fixations
+    float_stimuli = pysaliency.Stimuli([stimulus / 255.0 for stimulus in stimuli.stimuli])
+
+    with pytest.raises(ValueError):
+        ImageDataset(float_stimuli, fixations, image_dtype=np.uint8)[0]
+
+    with pytest.raises(ValueError):
+        ImageDataset(pysaliency.Stimuli([stimuli.stimuli[0].astype(int) * 2]), fixations, image_dtype=np.uint8)[0]
+
+
+def test_x_y_to_sparse_indices():
+    xs = [3, 1, 3, 0, 3, 1]
+    ys = [2, 0, 2, 5, 1, 0]
+
+    inds, values = x_y_to_sparse_indices(xs, ys)
+
+    counts = {(y, x): value for (y, x), value in zip(inds.T.tolist(), values)}
+    assert counts == {(2, 3): 2, (0, 1): 2, (5, 0): 1, (1, 3): 1}
+
+
+def test_image_dataset_fixation_grouping(stimuli_and_fixations):
+    stimuli, fixations = stimuli_and_fixations
+    fixations = fixations[np.random.RandomState(seed=1).permutation(len(fixations))]
+
+    dataset = ImageDataset(stimuli, fixations)
+
+    assert sorted(dataset._xs_cache) == [0, 2]
+    for n in range(len(stimuli)):
+        item = dataset[n]
+        inds = fixations.n == n
+        np.testing.assert_array_equal(item['x'], fixations.x_int[inds])
+        np.testing.assert_array_equal(item['y'], fixations.y_int[inds])
+
+
+@pytest.mark.parametrize('pin_memory', [
+    False,
+    pytest.param(True, marks=pytest.mark.skipif(not torch.cuda.is_available(), reason='pinned memory requires CUDA')),
+])
+def test_materialized_batches(stimuli_and_fixations, pin_memory):
+    stimuli, fixations = stimuli_and_fixations
+    dataset = ImageDataset(
+        stimuli, fixations,
+        models={'prediction': pysaliency.GaussianSaliencyMapModel()},
+        transform=FixationIndicesTransform(),
+    )
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_sampler=ImageDatasetSampler(dataset, batch_size=2, shuffle=False),
+        collate_fn=collate_fixation_indices,
+    )
+
+    batches = MaterializedBatches(loader, storage_dtype=torch.float16, drop_keys=['image'], pin_memory=pin_memory)
+    assert len(batches) == len(loader)
+    assert batches.batches[0]['prediction'].dtype == torch.float16
+
+    for _ in range(2):
+        for batch, expected_batch in zip(batches, loader):
+            assert 'image' not in batch
+            assert batch['prediction'].is_pinned() == pin_memory
+            assert batch['fixation_indices'].is_pinned() == pin_memory
+            assert batch['prediction'].dtype == expected_batch['prediction'].dtype
+            np.testing.assert_allclose(batch['prediction'].numpy(), expected_batch['prediction'].numpy(), atol=1e-3)
+            np.testing.assert_array_equal(batch['fixation_indices'].numpy(), expected_batch['fixation_indices'].numpy())
@@ -1,3 +1,5 @@
+import pickle
+
 import numpy as np
 from packaging import version
 from scipy.ndimage import gaussian_filter as scipy_filter
@@ -8,7 +10,18 @@ from hypothesis import given, strategies as st
 from hypothesis.extra import numpy as hypothesis_np
 import pytest
 
-from pysaliency.torch_utils import gaussian_filter, gaussian_filter_1d_new_torch, gaussian_filter_1d_old_torch
+import pysaliency
+from pysaliency.torch_datasets import ImageDataset, FixationMaskTransform, FixationIndicesTransform, collate_fixation_indices
+from pysaliency.torch_utils import (
+    GaussianFilterNd,
+    gaussian_filter,
+    gaussian_filter_1d_new_torch,
+    gaussian_filter_1d_old_torch,
+    log_likelihood,
+    log_likelihood_from_indices,
+    nonlinearity,
+    _nonlinearity_loop,
+)
 
 
 @pytest.fixture(params=[20.0])
@@ -67,4 +80,124 @@ def test_compare_gaussian_1d_implementations(data, sigma, dim):
     old_data = gaussian_filter_1d_old_torch(data_tensor, sigma=sigma, dim=dim).detach().cpu().numpy()
     new_data = gaussian_filter_1d_new_torch(data_tensor, sigma=sigma, dim=dim).detach().cpu().numpy()
 
-    np.testing.assert_allclose(old_data, new_data)
\ No newline at end of file
+    np.testing.assert_allclose(old_data, new_data)
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_log_likelihood_from_indices(num_workers):
+    rst = np.random.RandomState(seed=23)
+    stimuli = pysaliency.Stimuli([rst.rand(40, 30, 3), rst.rand(40, 30, 3), rst.rand(40, 30, 3)])
+    fixations = pysaliency.Fixations.create_without_history(
+        x=rst.randint(0, 30, size=50),
+        y=rst.randint(0, 40, size=50),
+        n=np.array([0] * 10 + [1] * 3 + [2] * 37),
+    )
+
+    mask_dataset = ImageDataset(stimuli, fixations, transform=FixationMaskTransform())
+    mask_items = [mask_dataset[k] for k in range(len(stimuli))]
+
+    index_dataset = ImageDataset(stimuli, fixations, transform=FixationIndicesTransform())
+    loader = torch.utils.data.DataLoader(
+        index_dataset,
+        batch_size=3,
+        collate_fn=collate_fixation_indices,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+    )
+    batch, = list(loader)
+
+    np.testing.assert_array_equal(batch['fixation_counts'].numpy(), [10, 3, 37])
+
+    log_density = torch.log_softmax(torch.tensor(rst.randn(3, 40 * 30)), dim=1).view(3, 40, 30)
+    fixation_mask = torch.stack([item['fixation_mask'] for item in mask_items])
+
+    expected = log_likelihood(log_density, fixation_mask, weights=batch['weight'])
+    actual = log_likelihood_from_indices(log_density, batch['fixation_indices'], batch['fixation_counts'], weights=batch['weight'])
+
+    np.testing.assert_allclose(actual.numpy(), expected.numpy())
+
+
+def test_nonlinearity():
+    rst = np.random.RandomState(seed=42)
+    xs = torch.tensor(np.linspace(0, 1, 20))
+    ys = torch.tensor(np.sort(rst.rand(20)), requires_grad=True)
+    tensor = torch.tensor(rst.rand(2, 1, 30, 40) * 1.4 - 0.2, requires_grad=True)
+
+    output = nonlinearity(tensor, xs, ys)
+    expected_output = _nonlinearity_loop(tensor, xs, ys)
+    np.testing.assert_allclose(output.detach().numpy(), expected_output.detach().numpy())
+
+    grad_output = torch.tensor(rst.randn(*output.shape))
+    gradients = torch.autograd.grad(output, [tensor, ys], grad_output)
+    expected_gradients = torch.autograd.grad(expected_output, [tensor, ys], grad_output)
+    for gradient, expected_gradient in zip(gradients, expected_gradients):
+        np.testing.assert_allclose(gradient.numpy(), expected_gradient.numpy())
+
+    assert torch.autograd.gradcheck(lambda tensor, ys: nonlinearity(tensor, xs, ys), (tensor[0, 0, :3, :4], ys))
+
+
+@pytest.mark.parametrize('sigma', [1.0, 5.0, 20.0])
+@pytest.mark.parametrize('method', ['fft', 'downsample'])
+def test_gaussian_filter_methods(sigma, method):
+    rst = np.random.RandomState(seed=42)
+    data = torch.tensor(scipy_filter(rst.rand(2, 1, 160, 200), sigma=[0, 0, 3, 3]))
+
+    direct_filter = GaussianFilterNd(dims=(2, 3), sigma=sigma, trainable=True, method='direct')
+    other_filter = GaussianFilterNd(dims=(2, 3), sigma=sigma, trainable=True, method=method)
+
+    direct_output = direct_filter(data)
+    output = other_filter(data)
+
+    if method == 'fft' or sigma < 2 * other_filter.downsample_sigma:
+        np.testing.assert_allclose(output.detach().numpy(), direct_output.detach().numpy(), rtol=1e-6)
+        rtol = 1e-6
+    else:
+        # approximation: compare only away from the borders
+        direct_output = direct_output[:, :, 40:-40, 40:-40]
+        output = output[:, :, 40:-40, 40:-40]
+        np.testing.assert_allclose(
+            output.detach().numpy(),
+            direct_output.detach().numpy(),
+            atol=0.1 * float(direct_output.std()),
+        )
+        rtol = 0.1
+
+    (direct_output ** 2).sum().backward()
+    (output ** 2).sum().backward()
+    np.testing.assert_allclose(other_filter.sigma.grad.numpy(), direct_filter.sigma.grad.numpy(), rtol=rtol)
+
+
+def test_gaussian_filter_old_pickle():
+    gaussian_filter_nd = GaussianFilterNd(dims=(2, 3), sigma=5.0)
+    # filters pickled by older versions lack the new attributes
+    del gaussian_filter_nd.method
+    del gaussian_filter_nd.downsample_sigma
+
+    unpickled_filter = pickle.loads(pickle.dumps(gaussian_filter_nd))
+    assert unpickled_filter.method == 'auto'
+    assert unpickled_filter.downsample_sigma == 4.0
+
+    data = torch.tensor(np.random.RandomState(seed=42).rand(1, 1, 30, 40))
+    expected = GaussianFilterNd(dims=(2, 3), sigma=5.0, method='direct')(data)
+    np.testing.assert_allclose(unpickled_filter(data).detach().numpy(), expected.detach().numpy(), rtol=1e-6)
+
+
+def test_log_likelihood_sparse_mask():
+    rst = np.random.RandomState(seed=42)
+    log_density = torch.log_softmax(torch.tensor(rst.randn(3, 20 * 30)), dim=1).view(3, 20, 30).requires_grad_()
+    weights = torch.tensor([1.0, 2.0, 3.0], dtype=torch.float64)
+
+    xs = rst.randint(0, 30, size=40)
+    ys = rst.randint(0, 20, size=40)
+    ns = np.repeat([0, 1, 2], [5, 15, 20])
+    # duplicated fixations are summed when coalescing
+    sparse_mask = torch.sparse_coo_tensor(torch.tensor(np.array([ns, ys, xs])), torch.ones(40, dtype=torch.int64), (3, 20, 30))
+
+    ll = log_likelihood(log_density, sparse_mask, weights=weights)
+    gradient, = torch.autograd.grad(ll, log_density)
+
+    expected_ll = log_likelihood(log_density, sparse_mask.to_dense(), weights=weights)
+    expected_gradient, = torch.autograd.grad(expected_ll, log_density)
+
+    np.testing.assert_allclose(ll.item(), expected_ll.item())
+    np.testing.assert_allclose(gradient.numpy(), expected_gradient.numpy())
@@ -6,8 +6,12 @@ import glob
 import os
 
 import numpy as np
+import pytest
+from scipy.ndimage import zoom
+from scipy.special import logsumexp
 
-from pysaliency.utils import LazyList, TemporaryDirectory, Cache, get_minimal_unique_filenames, atomic_directory_setup, build_padded_2d_array
+from pysaliency.utils import (LazyList, TemporaryDirectory, Cache, get_minimal_unique_filenames, atomic_directory_setup, build_padded_2d_array,
+                              LogSumExpAccumulator, SizeBoundedLRU, cached_resize, resize_map, resize_log_density)
 from test_helpers import TestWithData
 
 
@@ -73,6 +77,31 @@ class TestLazyList(TestWithData):
         self.assertEqual(lazy_list._cache, {i: i**2 for i in range(length)})
         self.assertEqual(list(lazy_list), [i**2 for i in range(length)])
 
+    def test_bounded_cache(self):
+        calls = []
+
+        def gen(i):
+            calls.append(i)
+            return np.zeros(10, dtype=np.uint8) + i
+
+        lazy_list = LazyList(gen, 10, max_cache_bytes=25)
+
+        for i in [0, 1, 0, 2, 0, 1]:
+            np.testing.assert_array_equal(lazy_list[i], i)
+
+        # 1 got evicted when 2 was added since 0 was used more recently
+        self.assertEqual(calls, [0, 1, 2, 1])
+        info = lazy_list.cache_info()
+        self.assertEqual(info.hits, 2)
+        self.assertEqual(info.misses, 4)
+        self.assertEqual(info.evictions, 2)
+        self.assertEqual(info.items, 2)
+        self.assertEqual(info.bytes, 20)
+
+        lazy_list = self.pickle_and_reload(lazy_list, pickler=dill)
+        self.assertEqual(lazy_list.cache_info().items, 0)
+        self.assertEqual(lazy_list.max_cache_bytes, 25)
+
 
 class TestTemporaryDirectory(unittest.TestCase):
     def test_temporary_directory(self):
@@ -251,5 +280,61 @@ def test_build_padded_2d_array():
     np.testing.assert_allclose(actual, expected)
 
 
+@pytest.mark.parametrize('source_shape,target_shape', [((30, 40), (75, 100)), ((108, 192), (76, 102)), ((1, 5), (3, 1)), ((7, 9), (7, 20))])
+def test_resize_map(source_shape, target_shape):
+    value = np.random.RandomState(42).randn(*source_shape)
+    expected = zoom(value, [target_shape[0] / source_shape[0], target_shape[1] / source_shape[1]], order=1, mode='nearest')
+    np.testing.assert_allclose(resize_map(value, target_shape), expected, rtol=1e-12, atol=1e-12)
+
+
+def test_resize_log_density():
+    log_density = np.random.RandomState(42).randn(20, 30)
+    resized = resize_log_density(log_density, (40, 60))
+    np.testing.assert_allclose(logsumexp(resized), 0, atol=1e-12)
+    assert resize_log_density(log_density, (40, 60)) is not resized
+    assert resize_log_density(log_density, (20, 30)) is log_density
+
+
+def test_logsumexp_accumulator():
+    rst = np.random.RandomState(42)
+    arrays = [100 * rst.randn(20, 30) for i in range(10)]
+    arrays[0][0, :] = -np.inf
+    arrays[1][:, 0] = -np.inf
+    arrays[2][0, 0] = -1000
+    for array in arrays[3:]:
+        array[0, 0] = -np.inf
+    weights = rst.rand(len(arrays))
+
+    accumulator = LogSumExpAccumulator()
+    for array, weight in zip(arrays, weights):
+        accumulator.add(array, log_weight=np.log(weight))
+
+    expected = logsumexp(np.array(arrays) + np.log(weights)[:, np.newaxis, np.newaxis], axis=0)
+    np.testing.assert_allclose(accumulator.result(), expected, rtol=1e-12)
+    assert accumulator.count == len(arrays)
+
+    accumulator = LogSumExpAccumulator()
+    accumulator.add(np.full(3, -np.inf))
+    np.testing.assert_array_equal(accumulator.result(), -np.inf)
+
+
+def test_cached_resize():
+    cache = SizeBoundedLRU(2**20)
+    calls = []
+
+    def resize():
+        calls.append(1)
+        return np.ones((2, 3))
+
+    assert cached_resize(None, lambda: 1 / 0, resize).shape == (2, 3)
+
+    first = cached_resize(cache, lambda: 'key', resize)
+    first[:] = 0
+    second = cached_resize(cache, lambda: 'key', resize)
+    np.testing.assert_array_equal(second, 1)
+    assert second is not cache['key']
+    assert len(calls) == 2
+
+
 if __name__ == '__main__':
     unittest.main()